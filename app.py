@@ -6,15 +6,49 @@ DeepSeek & Gemini 聊天助手 + 飞书知识库 Streamlit 应用
 import streamlit as st
 import logging
 from typing import List, Dict, Any
-from PIL import Image
 import io
 import os
+import time
+import uuid
 
 # 导入自定义模块
 from clients.deepseek_client import DeepSeekClient
 from clients.gemini_client import GeminiClient
 from clients.feishu_client import FeishuClient
 from utils.router import Router
+from utils.retrieval import KnowledgeIndex
+from utils.archive_ledger import ArchiveLedger
+from utils.outbox import FeishuOutbox
+from utils.singleflight import SingleFlight
+from utils.routing_policy import AdaptiveRoutingPolicy, StaticRoutingPolicy, ProviderStats
+from utils.governor import RequestGovernor, key_fingerprint
+from utils.cancellation import CancelToken, partial_usage
+from utils.tokens import estimate_tokens
+from utils.prompt_cache import GeminiCacheManager
+from utils.documents import DocumentSummarizer, SummaryCache
+from utils.images import ImagePrefetcher, make_thumbnail
+from utils.session_store import SessionStore
+from utils.recorder import ProviderRecorder
+from utils.transport import PoolSettings, TransportRegistry
+from utils.warmup import WarmupManager, MODES as WARMUP_MODES
+from utils.health import HealthMonitor
+from utils.shared_cache import open_shared_cache
+from utils.output_length import OutputLengthPredictor
+from utils.usage_ledger import UsageLedger, today
+from utils.profiling import Profiler, ENGINES as PROFILE_ENGINES
+from utils.memory import MemoryAccountant, MB, estimate_size, message_size, messages_size, trim_messages
+
+# 本地数据目录（台账等运行时文件，可用环境变量 ASSISTANT_DATA_DIR 指定）
+DATA_DIR = os.environ.get("ASSISTANT_DATA_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+# 聊天记录每页显示的消息数，更早的消息折叠，避免每次重新运行都渲染全部历史
+HISTORY_PAGE_SIZE = 20
+
+# 服务状态面板的自动刷新间隔（秒），只读取缓存的健康检查结果
+HEALTH_PANEL_REFRESH = 15
+
+# 除聊天记录和上传图片外的会话状态每隔该时间（秒）重新估算一次内存，聊天记录按消息缓存估算结果
+MEMORY_ESTIMATE_INTERVAL = 30
 
 # ==================== 页面配置 ====================
 st.set_page_config(
@@ -24,6 +58,168 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# ==================== 进程内共享资源 ====================
+# 所有会话共用，Streamlit 重新运行脚本时不会重建
+@st.cache_resource
+def get_shared_cache():
+    """
+    跨进程共享缓存（多个工作进程共用文档摘要、飞书访问令牌和图片处理结果）
+    
+    CACHE_URL 为 redis://... 时使用 Redis（多台机器），为空时使用本地 SQLite 文件（同一台机器），off 表示不共享
+    """
+    return open_shared_cache(st.secrets.get("CACHE_URL", ""), os.path.join(DATA_DIR, "shared_cache.db"))
+
+@st.cache_resource
+def get_archive_ledger():
+    """进程内共享的归档台账（所有会话共用，重启后从文件恢复）"""
+    return ArchiveLedger(os.path.join(DATA_DIR, "feishu_archive_ledger.jsonl"))
+
+@st.cache_resource
+def get_feishu_outbox():
+    """进程内共享的飞书发件箱（本地落盘，后台按批次投递；启动时按 secrets 中的飞书配置继续投递重启前积压的记录）"""
+    outbox = FeishuOutbox(os.path.join(DATA_DIR, "feishu_outbox.db"))
+    app_id, app_secret, app_token = (
+        str(st.secrets.get(name, "")).strip() for name in ("FEISHU_APP_ID", "FEISHU_APP_SECRET", "FEISHU_APP_TOKEN")
+    )
+    if app_id and app_secret and app_token:
+        outbox.register_client(get_feishu_client(app_id, app_secret, app_token, ""))
+    outbox.start()
+    return outbox
+
+@st.cache_resource
+def get_request_coalescer():
+    """进程内共享的请求合并器，多个会话的相同并发请求只调用一次上游"""
+    return SingleFlight(name="router")
+
+@st.cache_resource
+def get_provider_stats():
+    """进程内共享的模型延迟与错误率统计，供路由策略参考"""
+    return ProviderStats()
+
+@st.cache_resource
+def get_request_governor():
+    """进程内共享的配额与并发控制器，防止单个用户耗尽共享 API Key 的速率限制"""
+    return RequestGovernor(
+        per_session_concurrency=int(st.secrets.get("SESSION_CONCURRENCY", 1)),
+        per_key_concurrency=int(st.secrets.get("KEY_CONCURRENCY", 4)),
+        session_token_budget=int(st.secrets.get("SESSION_TOKEN_BUDGET", 200_000)),
+        key_token_budget=int(st.secrets.get("KEY_TOKEN_BUDGET", 2_000_000)),
+        max_queue_wait=float(st.secrets.get("MAX_QUEUE_WAIT", 60))
+    )
+
+@st.cache_resource
+def get_gemini_cache_manager(key_id):
+    """按 API Key（指纹）共享的 Gemini 上下文缓存管理器，同一 Key 的各会话复用服务端缓存，避免重复创建和计费"""
+    return GeminiCacheManager()
+
+@st.cache_resource
+def get_summary_cache():
+    """进程内共享的文档分块摘要缓存（落盘，重复导入同一文档时直接复用）"""
+    return SummaryCache(os.path.join(DATA_DIR, "document_summaries.jsonl"), shared=get_shared_cache())
+
+@st.cache_resource
+def get_session_store():
+    """进程内共享的会话存储（刷新页面或重启后按会话 ID 恢复聊天记录）"""
+    return SessionStore(os.path.join(DATA_DIR, "sessions.db"))
+
+@st.cache_resource
+def get_usage_ledger():
+    """进程内共享的用量台账（按请求记录 token、延迟和估算费用，落盘后重启可恢复）"""
+    return UsageLedger(os.path.join(DATA_DIR, "usage.db"))
+
+@st.cache_resource
+def get_provider_recorder():
+    """进程内共享的录制/回放控制器（PROVIDER_RECORD_MODE 为 record / replay 时启用，用于离线演示和基准测试）"""
+    mode = st.secrets.get("PROVIDER_RECORD_MODE", os.environ.get("PROVIDER_RECORD_MODE", "off"))
+    if mode == "off":
+        return None
+    return ProviderRecorder(
+        st.secrets.get("PROVIDER_CASSETTE", os.environ.get("PROVIDER_CASSETTE", os.path.join(DATA_DIR, "cassette.jsonl"))),
+        mode=mode,
+        timing=st.secrets.get("PROVIDER_REPLAY_TIMING", os.environ.get("PROVIDER_REPLAY_TIMING", "compressed"))
+    )
+
+@st.cache_resource
+def get_transport_registry():
+    """进程内共享的传输层注册表，按代理地址复用连接池（不同会话的代理设置互不影响）"""
+    settings = PoolSettings(
+        http2=str(st.secrets.get("HTTP2", "true")).lower() in ("1", "true", "yes"),
+        max_connections=int(st.secrets.get("HTTP_MAX_CONNECTIONS", 20)),
+        max_keepalive_connections=int(st.secrets.get("HTTP_MAX_KEEPALIVE", 10)),
+        keepalive_expiry=float(st.secrets.get("HTTP_KEEPALIVE_EXPIRY", 60)),
+        connect_timeout=float(st.secrets.get("HTTP_CONNECT_TIMEOUT", 5)),
+        read_timeout=float(st.secrets.get("HTTP_READ_TIMEOUT", 300)),
+        stream_read_timeout=float(st.secrets.get("HTTP_STREAM_READ_TIMEOUT", 60))
+    )
+    return TransportRegistry(recorder=get_provider_recorder(), settings=settings)
+
+@st.cache_resource
+def get_profiler():
+    """进程内共享的性能分析器（PROFILE_SAMPLE_RATE 为采样率，默认只分析侧边栏开关或 ?profile=1 强制的请求）"""
+    engine = str(st.secrets.get("PROFILE_ENGINE", "cprofile")).lower()
+    return Profiler(
+        directory=st.secrets.get("PROFILE_DIR", os.path.join(DATA_DIR, "profiles")),
+        sample_rate=float(st.secrets.get("PROFILE_SAMPLE_RATE", 0.0)),
+        engine=engine if engine in PROFILE_ENGINES else "cprofile"
+    )
+
+@st.cache_resource
+def get_memory_accountant():
+    """进程内共享的内存统计（MEMORY_SESSION_BUDGET_MB / MEMORY_WORKER_BUDGET_MB 为 0 时不限制）"""
+    session_budget = float(st.secrets.get("MEMORY_SESSION_BUDGET_MB", 64))
+    worker_budget = float(st.secrets.get("MEMORY_WORKER_BUDGET_MB", 0))
+    return MemoryAccountant(
+        session_budget=int(session_budget * MB) or None,
+        worker_budget=int(worker_budget * MB) or None,
+        trace=str(st.secrets.get("MEMORY_TRACE", "false")).lower() in ("1", "true", "yes"),
+        sample_interval=float(st.secrets.get("MEMORY_SAMPLE_INTERVAL", 60))
+    )
+
+@st.cache_resource
+def get_health_monitor():
+    """进程内共享的健康检查（结果按 HEALTH_TTL 缓存，过期后在后台刷新）"""
+    return HealthMonitor(
+        ttl=float(st.secrets.get("HEALTH_TTL", 60)),
+        error_ttl=float(st.secrets.get("HEALTH_ERROR_TTL", 15))
+    )
+
+@st.cache_resource
+def get_output_length_predictor():
+    """进程内共享的输出长度预测器（按历史输出长度为 DeepSeek 请求估算 max_tokens，样本通过共享缓存在工作进程之间共用）"""
+    return OutputLengthPredictor(cache=get_shared_cache())
+
+@st.cache_resource
+def get_warmup_manager():
+    """进程内共享的预热管理器（每个服务商 / Key / 代理组合只预热一次）"""
+    return WarmupManager()
+
+@st.cache_resource
+def get_image_prefetcher():
+    """进程内共享的图片预取器（选择图片后在后台预处理和预上传）"""
+    return ImagePrefetcher(cache=get_shared_cache())
+
+@st.cache_resource
+def get_feishu_client(app_id, app_secret, app_token, proxy):
+    """按飞书配置和代理共享的飞书客户端（复用访问令牌缓存和连接）"""
+    return FeishuClient(
+        app_id=app_id,
+        app_secret=app_secret,
+        app_token=app_token,
+        ledger=get_archive_ledger(),
+        transport=get_transport_registry().get(proxy),
+        base_url=st.secrets.get("FEISHU_BASE_URL") or None,
+        token_cache=get_shared_cache()
+    )
+
+@st.cache_resource
+def get_knowledge_index(app_token, table_id):
+    """按飞书表格共享的知识库索引"""
+    return KnowledgeIndex()
+
+def current_knowledge_index():
+    """当前飞书配置对应的知识库索引"""
+    return get_knowledge_index(st.session_state.feishu_app_token, st.session_state.feishu_table_id)
+
 # ==================== Session State 初始化 ====================
 # 这里不仅初始化 Session，还会优先尝试从 Secrets 获取默认值
 def init_session_state(key, secret_name, default_value=""):
@@ -44,35 +240,59 @@ init_session_state("feishu_app_token", "FEISHU_APP_TOKEN", base_token)
 if "proxy_url" not in st.session_state:
     st.session_state.proxy_url = ""
 
+init_session_state("system_prompt", "SYSTEM_PROMPT")
+
 if "gemini_model" not in st.session_state:
     st.session_state.gemini_model = "gemini-1.5-flash"
 
+if "adaptive_routing" not in st.session_state:
+    st.session_state.adaptive_routing = True
+
+if "chat_session_id" not in st.session_state:
+    # 会话 ID 保存在 URL 参数 sid 中，刷新页面后可恢复同一会话
+    sid = st.query_params.get("sid", "")
+    if not (len(sid) == 32 and all(c in "0123456789abcdef" for c in sid)):
+        sid = uuid.uuid4().hex
+        st.query_params["sid"] = sid
+    st.session_state.chat_session_id = sid
+
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    # 只恢复最近一页消息，更早的消息在展开时按需加载
+    store = get_session_store()
+    store.flush(timeout=1.0)
+    st.session_state.messages = store.load_page(st.session_state.chat_session_id, limit=HISTORY_PAGE_SIZE * 2)
+    # 尚未加载的更早消息数（即已加载消息中第一条的序号）
+    st.session_state.history_offset = st.session_state.messages[0]["seq"] if st.session_state.messages else 0
+
+if "history_visible" not in st.session_state:
+    st.session_state.history_visible = HISTORY_PAGE_SIZE
 
-if "current_image" not in st.session_state:
-    st.session_state.current_image = None
+if "current_images" not in st.session_state:
+    st.session_state.current_images = []
+
+if "message_sizes" not in st.session_state:
+    # 每条消息的内存估算（seq -> (id, 字节数)）
+    st.session_state.message_sizes = {}
 
 if "router" not in st.session_state:
-    st.session_state.router = Router()
+    st.session_state.router = Router(
+        singleflight=get_request_coalescer(),
+        stats=get_provider_stats(),
+        governor=get_request_governor(),
+        ledger=get_usage_ledger(),
+        profiler=get_profiler()
+    )
+
+# 飞书配置可能在侧边栏中修改，每次运行都同步知识库索引
+st.session_state.router.set_knowledge_index(current_knowledge_index())
 
 if "ai_clients_initialized" not in st.session_state:
     st.session_state.ai_clients_initialized = False
 
 # ==================== 辅助函数 ====================
-def initialize_proxy_settings():
-    """初始化代理设置"""
-    proxy_url = st.session_state.get('proxy_url', '').strip()
-    if proxy_url:
-        os.environ['http_proxy'] = proxy_url
-        os.environ['https_proxy'] = proxy_url
-    else:
-        # 🟢 关键修改：如果为空，必须显式删除环境变量！
-        # 否则之前设置的 127.0.0.1 还会一直残留，导致连接错误
-        os.environ.pop('http_proxy', None)
-        os.environ.pop('https_proxy', None)
-
-initialize_proxy_settings()
+def current_transport():
+    """当前会话代理设置对应的传输层（按代理地址共享连接池，不修改进程环境变量）"""
+    return get_transport_registry().get(st.session_state.get('proxy_url', ''))
 
 def get_config_status():
     """检查配置是否完整"""
@@ -89,51 +309,369 @@ def get_config_status():
 def get_status_emoji(status):
     return "🟢" if status else "🔴"
 
+def current_feishu_client():
+    """当前飞书配置对应的共享客户端"""
+    return get_feishu_client(
+        st.session_state.feishu_app_id.strip(),
+        st.session_state.feishu_app_secret.strip(),
+        st.session_state.feishu_app_token.strip(),
+        current_transport().proxy
+    )
+
+def warmup_mode():
+    """预热模式：off（默认）/ connect（建立连接、预取令牌）/ probe（另发送一次极小的模型请求）"""
+    mode = str(st.secrets.get("WARMUP", "off")).lower()
+    return mode if mode in WARMUP_MODES else "off"
+
+def submit_warmup(name, credential, warm_up):
+    """提交后台预热任务（同一服务商、凭证和代理只预热一次）"""
+    key = f"{name}:{key_fingerprint(credential)}:{current_transport().proxy}"
+    get_warmup_manager().submit(name, key, warm_up)
+
+def warm_up_clients():
+    """客户端注册后在后台并发预热 DeepSeek、Gemini 和飞书"""
+    mode = warmup_mode()
+    if mode == "off":
+        return
+    status = get_config_status()
+    if status["deepseek"] or status["gemini"]:
+        initialize_ai_clients()
+    if status["feishu"]:
+        client = current_feishu_client()
+        submit_warmup("feishu", client.app_id, client.warm_up)
+
+def image_upload_key():
+    """预上传文件的归属（Gemini Key 指纹），未开启预上传或未配置 Gemini 时为空字符串"""
+    enabled = str(st.secrets.get("IMAGE_PREUPLOAD", "true")).lower() in ("1", "true", "yes")
+    if not enabled or not get_config_status()["gemini"]:
+        return ""
+    return key_fingerprint(st.session_state.gemini_api_key)
+
+def prefetch_images(images):
+    """
+    选择图片后立即提交后台预处理，并通过 Gemini Files API 预上传（IMAGE_PREUPLOAD，默认开启）
+    
+    用户输入问题期间完成解码、缩放和上传，提问时只发送文件引用
+    """
+    upload_key = image_upload_key()
+    uploader = None
+    if upload_key and initialize_ai_clients():
+        gemini_client = st.session_state.router.clients.get('gemini')
+        uploader = gemini_client.upload_image if gemini_client is not None else None
+    submitted = st.session_state.setdefault("prefetched_images", set())
+    for image in images:
+        # 每次重新运行都会执行到这里，已提交的文件不再重复计算摘要
+        marker = (image.file_id, upload_key)
+        if marker not in submitted:
+            get_image_prefetcher().submit(image, uploader=uploader, upload_key=upload_key)
+            submitted.add(marker)
+
+def prefetched_image(image):
+    """预处理（及预上传）结果，未完成预取时退回原始数据"""
+    prepared = get_image_prefetcher().get(image, upload_key=image_upload_key())
+    return prepared if prepared is not None else image.getvalue()
+
+def service_health(status):
+    """
+    已配置服务的健康状态（读取缓存，过期时在后台并发探测，不阻塞本次运行）
+    
+    Returns:
+        Dict: 服务名称 -> HealthMonitor.check 的结果
+    """
+    monitor = get_health_monitor()
+    # 探测在后台线程中运行，不能在其中读取 st.secrets
+    timeout = float(st.secrets.get("HEALTH_TIMEOUT", 5))
+    proxy = current_transport().proxy
+    clients = {}
+    if (status["deepseek"] or status["gemini"]) and initialize_ai_clients():
+        clients.update(st.session_state.router.clients)
+    if status["feishu"]:
+        clients["feishu"] = current_feishu_client()
+    
+    health = {}
+    for name, client in clients.items():
+        if not status.get(name):
+            continue
+        credential = client.app_id if name == "feishu" else client.api_key
+        key = f"{name}:{key_fingerprint(credential)}:{proxy}"
+        health[name] = monitor.check(name, key, lambda client=client: client.health_check(timeout=timeout))
+    return health
+
 def initialize_ai_clients():
-    if st.session_state.ai_clients_initialized:
+    # 代理地址变化后需要用新的传输层重新创建客户端
+    transport = current_transport()
+    if st.session_state.ai_clients_initialized and st.session_state.get("ai_clients_proxy") == transport.proxy:
         return True
+    # 开启预热时，注册客户端后立即在后台建立连接
+    mode = warmup_mode()
     try:
-        # 应用代理
-        initialize_proxy_settings()
-        
         if st.session_state.deepseek_api_key:
-            deepseek_client = DeepSeekClient(st.session_state.deepseek_api_key)
+            deepseek_client = DeepSeekClient(
+                st.session_state.deepseek_api_key,
+                base_url=st.secrets.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com"),
+                transport=transport,
+                length_predictor=get_output_length_predictor(),
+                max_continuations=int(st.secrets.get("DEEPSEEK_MAX_CONTINUATIONS", 2))
+            )
             st.session_state.router.register_client('deepseek', deepseek_client)
+            if mode != "off":
+                submit_warmup("deepseek", deepseek_client.api_key,
+                              lambda: deepseek_client.warm_up(probe=mode == "probe"))
         
         if st.session_state.gemini_api_key:
             gemini_client = GeminiClient(
                 api_key=st.session_state.gemini_api_key,
-                model_name=st.session_state.gemini_model
+                model_name=st.session_state.gemini_model,
+                transport=transport,
+                base_url=st.secrets.get("GEMINI_BASE_URL") or None,
+                cache_manager=get_gemini_cache_manager(key_fingerprint(st.session_state.gemini_api_key))
             )
             st.session_state.router.register_client('gemini', gemini_client)
+            if mode != "off":
+                submit_warmup("gemini", gemini_client.api_key,
+                              lambda: gemini_client.warm_up(probe=mode == "probe"))
         
         st.session_state.ai_clients_initialized = True
+        st.session_state.ai_clients_proxy = transport.proxy
         return True
     except Exception as e:
         st.error(f"AI客户端初始化失败: {e}")
         return False
 
-def process_message(message: str, image_data=None):
+def build_routing_policy():
+    """根据侧边栏设置构建路由策略"""
+    # 按实际请求的模型名路由（GeminiClient 会把 1.5 系列模型改写为 gemini-2.0-flash），价格和延迟统计才能对应
+    gemini_model = GeminiClient.normalize_model(st.session_state.gemini_model)
+    if not st.session_state.adaptive_routing:
+        return StaticRoutingPolicy(gemini_model=gemini_model)
+    # 以选择的 Gemini 模型为默认模型，复杂的图片问题升级到 pro（pro 模型需使用 2.x 及以上版本）
+    return AdaptiveRoutingPolicy(
+        gemini_fast_model=gemini_model,
+        gemini_pro_model=st.secrets.get("GEMINI_PRO_MODEL", "gemini-2.5-pro")
+    )
+
+def render_model_caption(message):
+    """显示生成该回复的模型及路由原因"""
+    label = message.get("model", "unknown")
+    if message.get("model_name"):
+        label = f"{label} ({message['model_name']})"
+    text = f"使用 {label} 生成"
+    if message.get("stopped"):
+        usage = message.get("usage") or {}
+        text += f"（已停止，约消耗 {usage.get('total_tokens', 0)} tokens）"
+    if message.get("queue_wait"):
+        text += f"（排队 {message['queue_wait']:.1f} 秒）"
+    st.caption(text, help=message.get("route_reason"))
+
+def render_message(message):
+    """渲染单条消息（图片预览为提前生成的缩略图，不会在每次运行时重新编码原图）"""
+    with st.chat_message(message["role"]):
+        if message.get("image_preview"):
+            st.image(message["image_preview"], width=200)
+        elif message.get("image_evicted"):
+            st.caption("🖼️ 图片预览已释放（会话内存超出预算）")
+        st.markdown(message["content"])
+        if message.get("model"):
+            render_model_caption(message)
+
+def append_message(message):
+    """追加一条消息到聊天记录，并异步持久化（消息追加后不再修改，同时缓存其内存估算）"""
+    message["seq"] = st.session_state.history_offset + len(st.session_state.messages)
+    st.session_state.messages.append(message)
+    message_size(message, st.session_state.message_sizes)
+    get_session_store().append(st.session_state.chat_session_id, message["seq"], message)
+
+def load_older_messages(count):
+    """从会话存储中加载更早的消息"""
+    offset = st.session_state.history_offset
+    if offset <= 0:
+        return
+    older = get_session_store().load_page(st.session_state.chat_session_id, before=offset, limit=count)
+    st.session_state.messages[:0] = older
+    st.session_state.history_offset = older[0]["seq"] if older else 0
+
+@st.fragment
+def render_chat_history():
+    """
+    渲染聊天记录：只渲染最近的若干条消息，更早的消息折叠，按需分页展开
+
+    作为 fragment 运行，展开更早消息时只重新运行这一部分
+    """
+    messages = st.session_state.messages
+    if not messages:
+        st.info("👋 你好！我是你的 AI 助手。你可以问我问题，或者上传图片让我分析。")
+        return
+    
+    hidden = max(0, len(messages) - st.session_state.history_visible)
+    folded = hidden + st.session_state.history_offset
+    if folded or st.session_state.history_visible > HISTORY_PAGE_SIZE:
+        col_older, col_latest = st.columns([3, 1])
+        if folded and col_older.button(f"⬆️ 显示更早的消息（已折叠 {folded} 条）", key="show_older_messages",
+                                       use_container_width=True):
+            st.session_state.history_visible += HISTORY_PAGE_SIZE
+            if len(messages) < st.session_state.history_visible:
+                load_older_messages(st.session_state.history_visible - len(messages))
+            st.rerun(scope="fragment")
+        if st.session_state.history_visible > HISTORY_PAGE_SIZE and col_latest.button(
+                "只看最近", key="collapse_history", use_container_width=True):
+            st.session_state.history_visible = HISTORY_PAGE_SIZE
+            st.rerun(scope="fragment")
+    
+    for message in messages[hidden:]:
+        render_message(message)
+
+def get_chat_history():
+    """获取作为上下文的历史消息（不含当前这条用户消息和错误回复）"""
+    return [
+        {"role": msg["role"], "content": msg["content"]}
+        for msg in st.session_state.messages[:-1]
+        if msg.get("model") != "error"
+    ]
+
+def process_message(message: str, images=None, on_wait=None, cancel_token=None):
+    """
+    流式处理消息
+
+    Yields:
+        Dict 事件：delta、done、cancelled 或 error（格式见 Router.route_stream）
+    """
     status = get_config_status()
     if not status["deepseek"] and not status["gemini"]:
-        return {"success": False, "error": "请至少配置一个 AI 服务的 API Key", "content": None}
+        yield {"type": "error", "error": "请至少配置一个 AI 服务的 API Key"}
+        return
+    
+    # 命中采样或强制分析时，界面线程和调用上游的线程各写一个分析文件（文件名中的请求标识相同）
+    profiler = get_profiler()
+    force = st.session_state.get("profile_requests", False) or st.query_params.get("profile") == "1"
+    profile_id = profiler.new_request_id() if profiler.should_profile(force) else None
+    with profiler.profile("process_message", active=profile_id is not None, request_id=profile_id):
+        # 每次处理前确保客户端已初始化
+        initialize_ai_clients()
+        st.session_state.router.policy = build_routing_policy()
+    
+        # 系统提示词与历史消息原样传递，保证请求前缀稳定以命中上下文缓存
+        # session_id 用于按会话限流；on_wait 在排队时更新界面上的排队位置；cancel_token 用于停止生成
+        options = {"session_id": st.session_state.chat_session_id, "on_wait": on_wait, "cancel_token": cancel_token,
+                   "profile": profile_id or False}
+        if st.session_state.system_prompt.strip():
+            options["system_prompt"] = st.session_state.system_prompt
+    
+        try:
+            if images:
+                # 多张图片放在同一个请求中；选择图片时已在后台预处理和预上传，这里只取结果
+                image_input = [prefetched_image(image) for image in images]
+                yield from st.session_state.router.route_stream(message=message, image_input=image_input, **options)
+            else:
+                yield from st.session_state.router.route_stream(message=message, history=get_chat_history(), **options)
+        except Exception as e:
+            yield {"type": "error", "error": f"处理消息时出错: {str(e)}"}
+
+def stop_generation():
+    """停止按钮回调：取消进行中的生成"""
+    cancel_token = st.session_state.get("cancel_token")
+    if cancel_token is not None:
+        cancel_token.cancel()
+
+def assistant_message(result, stopped=False):
+    """根据生成结果构造助手消息"""
+    return {
+        "role": "assistant",
+        "content": result["content"],
+        "model": result.get("model", "unknown"),
+        "model_name": result.get("model_name"),
+        "route_reason": (result.get("route") or {}).get("reason"),
+        "queue_wait": (result.get("queue") or {}).get("waited"),
+        "usage": result.get("usage"),
+        "stopped": stopped
+    }
+
+def summarize_document(document, instruction=""):
+    """分块并发摘要上传的文档，并将结果加入聊天记录"""
+    status = get_config_status()
+    if not status["deepseek"]:
+        st.error("文档摘要需要配置 DeepSeek API Key")
+        return False
     
-    # 每次处理前确保客户端已初始化
     initialize_ai_clients()
+    client = st.session_state.router.clients.get("deepseek")
+    if client is None:
+        st.error("DeepSeek 客户端未初始化")
+        return False
+    
+    progress = st.progress(0.0, text="正在读取文档...")
+    
+    def on_progress(state):
+        label = "分块摘要" if state["stage"] == "map" else f"第 {state['level']} 层合并"
+        progress.progress(state["done"] / state["total"], text=f"{label}: {state['done']}/{state['total']}")
+    
+    document.seek(0)
+    summarizer = DocumentSummarizer(
+        client,
+        cache=get_summary_cache(),
+        governor=get_request_governor(),
+        session_id=st.session_state.chat_session_id
+    )
+    result = summarizer.summarize(document, document.name, instruction=instruction.strip() or None,
+                                  on_progress=on_progress)
+    progress.empty()
+    get_usage_ledger().record(
+        st.session_state.chat_session_id, "deepseek", summarizer.model, result.get("usage"),
+        latency=result.get("elapsed", 0.0), status="ok" if result["success"] else "error"
+    )
+    
+    if not result["success"]:
+        st.error(result["error"])
+        return False
+    
+    request = f"📄 请总结文档《{document.name}》" + (f"：{instruction.strip()}" if instruction.strip() else "")
+    append_message({"role": "user", "content": request, "image_preview": None})
+    append_message({
+        "role": "assistant",
+        "content": result["content"],
+        "model": "deepseek",
+        "model_name": result["model"],
+        "usage": result["usage"]
+    })
+    st.success(f"摘要完成：{result['chunks']} 块，缓存命中 {result['cached']} 次，耗时 {result['elapsed']:.1f} 秒")
+    if result.get("truncated"):
+        st.warning(f"{result['truncated']} 段摘要因长度限制被截断，可能不完整（未写入缓存，重新导入时会重新生成）")
+    return True
+
+def sync_knowledge_index():
+    """从飞书多维表格加载已归档的问答，构建本地知识库索引"""
+    status = get_config_status()
+    if not status["feishu"]:
+        st.error("请先在左侧配置完整的飞书 App ID, Secret, Token 和 Table ID")
+        return False
     
     try:
-        if image_data:
-            image_bytes = image_data.getvalue()
-            result = st.session_state.router.route(message=message, image_input=image_bytes)
-        else:
-            result = st.session_state.router.route(message=message)
-        return result
+        client = current_feishu_client()
+        
+        with st.spinner("正在从飞书加载知识库..."):
+            result = client.list_records(table_id=st.session_state.feishu_table_id)
+        
+        if not result["success"]:
+            st.error(f"同步失败: {result['error']}")
+            return False
+        
+        added = current_knowledge_index().add_records(result["records"])
+        st.success(f"✅ 知识库已同步，新增 {added} 条问答（共 {len(current_knowledge_index())} 条）")
+        return True
+    
     except Exception as e:
-        return {"success": False, "error": f"处理消息时出错: {str(e)}", "content": None}
+        st.error(f"同步过程中发生错误: {str(e)}")
+        return False
 
 def clear_chat_history():
+    # 删除已保存的记录，并开始一个新会话
+    get_session_store().delete_session(st.session_state.chat_session_id)
+    get_memory_accountant().forget_session(st.session_state.chat_session_id)
+    st.session_state.chat_session_id = uuid.uuid4().hex
+    st.query_params["sid"] = st.session_state.chat_session_id
     st.session_state.messages = []
-    st.session_state.current_image = None
+    st.session_state.history_offset = 0
+    st.session_state.history_visible = HISTORY_PAGE_SIZE
+    st.session_state.current_images = []
     st.success("聊天历史已清空")
 
 def save_to_feishu():
@@ -167,46 +705,228 @@ def save_to_feishu():
         return False
     
     try:
-        client = FeishuClient(
-            app_id=st.session_state.feishu_app_id,
-            app_secret=st.session_state.feishu_app_secret,
-            app_token=st.session_state.feishu_app_token
+        client = current_feishu_client()
+        
+        records = client.format_chat_record(
+            user_question=user_question,
+            ai_answer=ai_answer,
+            model_used=model_used,
+            session_id=st.session_state.chat_session_id
         )
+        table_id = st.session_state.feishu_table_id
+        
+        if client.is_archived(table_id, records):
+            st.info("该轮对话已保存过，无需重复保存")
+            return True
+        
+        # 先写入本地发件箱，再由后台线程投递到飞书
+        outbox = get_feishu_outbox()
+        outbox.register_client(client)
+        entry = outbox.enqueue(
+            app_token=client.app_token,
+            table_id=table_id,
+            records=records,
+            client_token=client.client_token_for(table_id, records)
+        )
+        outbox.wake()
+        
+        # 新归档的问答立即加入本地知识库索引
+        current_knowledge_index().add(user_question, ai_answer)
         
         with st.spinner("正在保存到飞书多维表格..."):
-            records = client.format_chat_record(
-                user_question=user_question,
-                ai_answer=ai_answer,
-                model_used=model_used
-            )
-            result = client.add_record_to_bitable(
-                table_id=st.session_state.feishu_table_id,
-                fields=records
-            )
+            delivered = outbox.wait_delivered(entry["id"], timeout=5)
         
-        if result["success"]:
+        if delivered:
             st.success(f"✅ 已成功保存到飞书！")
-            return True
         else:
-            st.error(f"保存失败: {result['error']}")
-            return False
+            st.warning(f"飞书暂时无法写入，已加入待同步队列（积压 {outbox.depth()} 条），恢复连接后将自动保存")
+        return True
             
     except Exception as e:
         st.error(f"保存过程中发生错误: {str(e)}")
         return False
 
+def render_usage_summary():
+    """侧边栏用量统计：本会话和今日（所有会话）的 token、费用和吞吐"""
+    ledger = get_usage_ledger()
+    session_usage = ledger.summary(session_id=st.session_state.chat_session_id)
+    daily_usage = ledger.summary(day=today())
+    if not daily_usage["requests"]:
+        return
+    
+    with st.expander("📈 用量统计", expanded=False):
+        c1, c2 = st.columns(2)
+        c1.metric("本会话费用", f"${session_usage['cost']:.4f}", help=f"{session_usage['requests']} 次请求")
+        c2.metric("今日费用", f"${daily_usage['cost']:.4f}", help=f"{daily_usage['requests']} 次请求（所有会话）")
+        st.caption(
+            f"本会话: 输入 {session_usage['prompt_tokens']:,}（缓存命中 {session_usage['cached_tokens']:,}，"
+            f"图片 {session_usage['image_tokens']:,}）/ 输出 {session_usage['completion_tokens']:,} tokens"
+        )
+        st.caption(
+            f"今日: {daily_usage['total_tokens']:,} tokens · 平均延迟 {daily_usage['avg_latency_ms'] / 1000:.1f}s"
+            f"（P95 {daily_usage['p95_latency_ms'] / 1000:.1f}s）· 输出 {daily_usage['output_tokens_per_second']:.0f} tokens/s"
+        )
+        by_model = ledger.group_by("model", day=today())
+        st.dataframe(
+            [
+                {"模型": model, "请求": item["requests"], "tokens": item["total_tokens"],
+                 "费用 ($)": round(item["cost"], 4), "错误": item["errors"]}
+                for model, item in sorted(by_model.items(), key=lambda kv: -kv[1]["cost"])
+            ],
+            hide_index=True,
+            use_container_width=True
+        )
+
+@st.fragment(run_every=HEALTH_PANEL_REFRESH)
+def render_service_status():
+    """
+    服务状态：配置状态 + 缓存的健康检查结果（延迟和最近的错误）
+    
+    作为 fragment 定时重新运行，后台探测完成后自动更新，不需要整页重新运行
+    """
+    status = get_config_status()
+    health = service_health(status)
+    columns = st.columns(3)
+    latencies = []
+    for column, (name, label) in zip(columns, (("deepseek", "DeepSeek"), ("gemini", "Gemini"), ("feishu", "飞书"))):
+        if not status[name]:
+            column.metric(label, get_status_emoji(False), help="未配置")
+            continue
+        result = health.get(name) or {"status": "checking", "latency_ms": None, "error": None}
+        emoji = {"ok": "🟢", "error": "🔴", "checking": "🟡"}[result["status"]]
+        if result["status"] == "checking":
+            help_text = "正在检查连接…"
+        elif result["status"] == "ok":
+            help_text = f"延迟 {result['latency_ms']:.0f}ms"
+            latencies.append(f"{label} {result['latency_ms']:.0f}ms")
+        else:
+            help_text = f"最近一次检查失败: {result['error']}"
+        column.metric(label, emoji, help=help_text)
+    if latencies:
+        st.caption("⏱️ " + " · ".join(latencies))
+
+def render_memory_panel():
+    """侧边栏内存统计：本会话、本进程和占用最多的会话"""
+    accountant = get_memory_accountant()
+    sizes = st.session_state.get("memory_sizes") or session_memory_sizes()
+    budget = accountant.budget_for()
+    snapshot = accountant.snapshot()
+    with st.expander("🧠 内存", expanded=False):
+        c1, c2 = st.columns(2)
+        c1.metric("本会话", f"{sum(sizes.values()) / MB:.1f} MB",
+                  help=f"预算 {budget / MB:.0f} MB" if budget else "未设置预算")
+        if snapshot["rss_bytes"] is not None:
+            c2.metric("本进程", f"{snapshot['rss_bytes'] / MB:.0f} MB",
+                      help=f"预算 {snapshot['worker_budget'] / MB:.0f} MB" if snapshot["worker_budget"] else "未设置预算")
+        st.caption(f"聊天记录 {sizes['messages'] / MB:.1f} MB · 上传图片 {sizes['current_images'] / MB:.1f} MB · "
+                   f"其他 {sizes['other'] / MB:.1f} MB")
+        st.caption(f"活跃会话 {snapshot['sessions']} 个，合计约 {snapshot['sessions_bytes'] / MB:.1f} MB")
+        st.dataframe(
+            [
+                {"会话": item["session_id"][:8], "MB": round(item["total"] / MB, 2),
+                 "聊天记录": round(item["sizes"].get("messages", 0) / MB, 2),
+                 "上传图片": round(item["sizes"].get("current_images", 0) / MB, 2)}
+                for item in accountant.sessions(limit=10)
+            ],
+            hide_index=True,
+            use_container_width=True
+        )
+        if snapshot.get("top_allocations"):
+            st.caption(f"tracemalloc: 当前 {snapshot['traced_bytes'] / MB:.0f} MB，峰值 {snapshot['traced_peak_bytes'] / MB:.0f} MB")
+            st.dataframe(
+                [{"文件": os.path.basename(item["file"]), "MB": round(item["size"] / MB, 2), "分配数": item["count"]}
+                 for item in snapshot["top_allocations"]],
+                hide_index=True,
+                use_container_width=True
+            )
+
+def render_profiling_panel():
+    """侧边栏性能分析：开关和最近的分析文件"""
+    profiler = get_profiler()
+    with st.expander("🔬 性能分析", expanded=False):
+        st.toggle("分析之后的每次请求", key="profile_requests",
+                  help="也可以在地址后加 ?profile=1；采样率由 PROFILE_SAMPLE_RATE 配置")
+        files = profiler.recent()
+        if not files:
+            st.caption(f"暂无分析文件（目录: {profiler.directory}）")
+            return
+        st.caption(f"目录: {profiler.directory}（.prof 可用 snakeviz / flameprof 查看，"
+                   f".speedscope.json 可拖入 speedscope.app）")
+        for item in files:
+            st.caption(f"`{item['name']}` · {item['size'] / 1024:.0f} KB")
+
+def session_memory_sizes():
+    """本会话各部分的内存估算（字节）"""
+    state = st.session_state
+    previous = state.get("memory_sizes")
+    now = time.time()
+    if previous is None or now - state.get("memory_estimated_at", 0.0) >= MEMORY_ESTIMATE_INTERVAL:
+        other = estimate_size({k: v for k, v in state.to_dict().items()
+                               if k not in ("messages", "current_images", "image_uploader")})
+        state.memory_estimated_at = now
+    else:
+        other = previous["other"]
+    return {
+        "messages": messages_size(state.messages, state.message_sizes),
+        "current_images": estimate_size(state.current_images),
+        "other": other,
+    }
+
+def account_session_memory():
+    """统计本会话占用的内存并上报；超出预算时卸载较早的消息、释放图片预览"""
+    accountant = get_memory_accountant()
+    sizes = session_memory_sizes()
+    budget = accountant.budget_for()
+    if budget is not None and sum(sizes.values()) > budget:
+        # 卸载的消息需要已经写入会话存储，展开历史时才能重新加载
+        get_session_store().flush(timeout=1.0)
+        messages = st.session_state.messages
+        result = trim_messages(
+            messages,
+            budget,
+            reserved=sizes["current_images"] + sizes["other"],
+            visible=st.session_state.history_visible,
+            size_cache=st.session_state.message_sizes
+        )
+        if result["unloaded"] and messages:
+            st.session_state.history_offset = messages[0]["seq"]
+        if result["freed"]:
+            sizes["messages"] = messages_size(messages, st.session_state.message_sizes)
+    accountant.record_session(st.session_state.chat_session_id, sizes)
+    st.session_state.memory_sizes = sizes
+
+account_session_memory()
+
+# 开启预热时，页面首次加载就注册客户端并在后台建立连接
+warm_up_clients()
+
+# 已配置飞书时注册到发件箱，继续投递该表格重启前积压的记录
+if get_config_status()["feishu"]:
+    get_feishu_outbox().register_client(current_feishu_client())
+
 # ==================== 侧边栏配置区域 ====================
 with st.sidebar:
     st.title("⚙️ 设置面板")
 
     # 1. 图片上传 (最上方)
     st.subheader("📷 图片上传")
-    uploaded_image = st.file_uploader("上传图片给 Gemini", type=['png', 'jpg', 'jpeg'], key="image_uploader")
-    if uploaded_image:
-        st.session_state.current_image = uploaded_image
-        st.image(uploaded_image, caption="已准备好发送", width=200)
-    else:
-        st.session_state.current_image = None
+    uploaded_images = st.file_uploader(
+        "上传图片给 Gemini（可多选）",
+        type=['png', 'jpg', 'jpeg', 'webp'],
+        key="image_uploader",
+        accept_multiple_files=True
+    )
+    st.session_state.current_images = uploaded_images or []
+    if uploaded_images:
+        prefetch_images(uploaded_images)
+        st.image(uploaded_images, caption=[f"已准备好发送 {i + 1}" for i in range(len(uploaded_images))], width=200)
+    
+    # 文档摘要（txt / markdown / PDF）
+    with st.expander("📄 文档摘要", expanded=False):
+        document = st.file_uploader("上传文档", type=['txt', 'md', 'markdown', 'pdf'], key="document_uploader")
+        document_instruction = st.text_input("摘要要求（可选）", key="document_instruction")
+        if st.button("📝 生成文档摘要", use_container_width=True, disabled=document is None):
+            summarize_document(document, document_instruction)
     
     st.divider()
 
@@ -218,6 +938,10 @@ with st.sidebar:
             options=['gemini-1.5-flash', 'gemini-1.5-pro'],
             key="gemini_model"
         )
+        st.checkbox("智能路由", key="adaptive_routing",
+                    help="按问题复杂度、近期延迟/错误率和价格选择模型（如 deepseek-reasoner、Gemini pro）")
+        st.text_area("系统提示词", key="system_prompt", height=120,
+                     help="较长的系统提示词会利用 DeepSeek 前缀缓存和 Gemini 上下文缓存")
     
     # 3. API Key 设置 (使用 Streamlit 原生绑定，自动读取 Secrets)
     with st.expander("🔑 API Key 设置", expanded=True):
@@ -230,15 +954,31 @@ with st.sidebar:
         st.text_input("App Secret", type="password", key="feishu_app_secret")
         st.text_input("Base ID (Token)", key="feishu_app_token")
         st.text_input("Table ID", key="feishu_table_id")
+        if st.button("📥 同步飞书知识库", use_container_width=True):
+            sync_knowledge_index()
     
     # 状态指示灯
-    status = get_config_status()
     st.divider()
     st.subheader("服务状态")
-    c1, c2, c3 = st.columns(3)
-    c1.metric("DeepSeek", get_status_emoji(status["deepseek"]))
-    c2.metric("Gemini", get_status_emoji(status["gemini"]))
-    c3.metric("飞书", get_status_emoji(status["feishu"]))
+    render_service_status()
+    quota = get_request_governor().session_status(st.session_state.chat_session_id)
+    if quota["token_budget"]:
+        st.caption(f"🎫 本会话用量: {quota['tokens_used']:,} / {quota['token_budget']:,} tokens")
+    if quota["queue_length"]:
+        st.caption(f"⏳ 当前排队请求: {quota['queue_length']} 个")
+    outbox_depth = get_feishu_outbox().depth()
+    if outbox_depth:
+        st.caption(f"📮 飞书待同步记录: {outbox_depth} 条")
+    warmup_results = get_warmup_manager().results()
+    if warmup_results:
+        st.caption("🔥 预热: " + " · ".join(
+            f"{name} {result['elapsed_ms']:.0f}ms" if result["success"] else f"{name} 失败"
+            for name, result in warmup_results.items()
+        ), help="\n".join(f"{name}: {result['error']}" for name, result in warmup_results.items() if result["error"]) or None)
+    
+    render_usage_summary()
+    render_profiling_panel()
+    render_memory_panel()
     
     if st.button("🗑️ 清空聊天", use_container_width=True):
         clear_chat_history()
@@ -250,16 +990,7 @@ st.title("🤖 DeepSeek & Gemini 智能助手")
 chat_container = st.container()
 
 with chat_container:
-    if not st.session_state.messages:
-        st.info("👋 你好！我是你的 AI 助手。你可以问我问题，或者上传图片让我分析。")
-    
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            if message.get("image_preview"):
-                st.image(message["image_preview"], width=200)
-            st.markdown(message["content"])
-            if message.get("model"):
-                st.caption(f"使用 {message['model']} 生成")
+    render_chat_history()
 
 # 输入框和底部按钮
 st.divider()
@@ -270,11 +1001,10 @@ if user_input:
     user_message = {"role": "user", "content": user_input, "image_preview": None}
     
     # 检查侧边栏是否有图片
-    if st.session_state.current_image:
-        image = Image.open(st.session_state.current_image)
-        user_message["image_preview"] = image
+    if st.session_state.current_images:
+        user_message["image_preview"] = [make_thumbnail(image) for image in st.session_state.current_images]
     
-    st.session_state.messages.append(user_message)
+    append_message(user_message)
     
     # 显示用户消息
     with chat_container:
@@ -282,22 +1012,64 @@ if user_input:
             if user_message["image_preview"]: st.image(user_message["image_preview"], width=200)
             st.markdown(user_input)
     
-    # AI 处理
-    with st.spinner("AI 正在思考..."):
-        result = process_message(message=user_input, image_data=st.session_state.current_image)
+    # AI 处理（流式输出，可随时停止）
+    queue_status = st.empty()
+    stop_placeholder = st.empty()
+    cancel_token = CancelToken()
+    st.session_state.cancel_token = cancel_token
+    stop_placeholder.button("⏹ 停止生成", on_click=stop_generation, key="stop_generation")
     
-    # 处理结果
-    if result["success"]:
-        ai_message = {"role": "assistant", "content": result["content"], "model": result.get("model", "unknown")}
-        st.session_state.messages.append(ai_message)
+    def show_queue_position(state):
+        queue_status.info(f"⏳ 排队中：第 {state['position']} 位，已等待 {state['waited']:.0f} 秒")
+    
+    parts = []
+    result = None
+    try:
         with chat_container:
             with st.chat_message("assistant"):
-                st.markdown(result["content"])
-                st.caption(f"使用 {result.get('model', 'unknown')} 生成")
-    else:
-        st.session_state.messages.append({"role": "assistant", "content": f"❌ {result['error']}", "model": "error"})
-        with chat_container:
-            with st.chat_message("assistant"): st.error(result["error"])
+                answer = st.empty()
+                with st.spinner("AI 正在思考..."):
+                    for event in process_message(
+                        message=user_input,
+                        images=st.session_state.current_images,
+                        on_wait=show_queue_position,
+                        cancel_token=cancel_token
+                    ):
+                        if event["type"] == "delta":
+                            queue_status.empty()
+                            parts.append(event["content"])
+                            answer.markdown("".join(parts) + "▌")
+                        else:
+                            result = event
+                            break
+                    else:
+                        result = {"type": "error", "error": "未收到响应"}
+                
+                if result["type"] == "error":
+                    error = result["error"]
+                    answer.error(error)
+                    append_message({"role": "assistant", "content": f"❌ {error}", "model": "error"})
+                else:
+                    stopped = result["type"] == "cancelled"
+                    ai_message = assistant_message(result, stopped=stopped)
+                    answer.markdown(ai_message["content"])
+                    render_model_caption(ai_message)
+                    append_message(ai_message)
+    finally:
+        if result is None:
+            # 停止按钮或其他交互触发了重新运行，脚本在生成途中被中断：
+            # 取消上游生成，并保留已输出的部分内容
+            cancel_token.cancel()
+            content = "".join(parts)
+            if content:
+                prompt_tokens = estimate_tokens(user_input) + estimate_tokens(st.session_state.system_prompt)
+                append_message(assistant_message(
+                    {"content": content, "usage": partial_usage(prompt_tokens, content)},
+                    stopped=True
+                ))
+        st.session_state.cancel_token = None
+    queue_status.empty()
+    stop_placeholder.empty()
 
 # 底部功能按钮
 col_btn1, col_btn2 = st.columns(2)
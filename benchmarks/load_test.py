@@ -0,0 +1,276 @@
+"""
+端到端负载测试
+启动本地桩服务（benchmarks/stub_providers.py），用 streamlit.testing 的 AppTest 驱动 app.py 模拟多个会话，
+每个会话连续提问若干轮并定期保存到飞书，测量：
+    - 每次交互（提交问题到重新运行结束）的耗时，以及扣除桩服务生成时间后的界面开销，随对话长度的变化
+    - 不提问的重新运行（点击"刷新界面"）耗时
+    - 保存到飞书的耗时
+    - 随会话数和对话长度增加的进程内存（RSS）增长和每个会话的内存估算
+
+一个工作进程内的会话同时保持打开、轮流提问（AppTest 不能在多个线程中同时运行），
+与一个 Streamlit 工作进程中的多个标签页共享 st.cache_resource 资源的方式相同；
+--processes 启动多个工作进程并行运行，对桩服务和本地存储产生并发负载；
+--cache 选择跨进程共享缓存的后端（redis 时启动 Redis 协议桩服务），可对比上游请求数（如飞书令牌）。
+运行时数据写入临时目录，不影响 .cache。
+
+用法: python benchmarks/load_test.py [--sessions 5] [--turns 20] [--processes 1] [--save-every 5]
+                                     [--cache sqlite|redis|off] [--json results.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from streamlit.testing.v1 import AppTest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "app.py")
+sys.path.insert(0, ROOT)
+
+from benchmarks.stub_providers import StubConfig, StubProviders, StubRedis  # noqa: E402
+from utils.memory import MB, process_rss  # noqa: E402
+
+# 对话长度分段（按轮数）统计交互耗时
+BUCKETS = (1, 5, 10, 20, 50, 100, 200)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def bucket_of(turn: int) -> str:
+    """轮数所在的分段，例如 6-10"""
+    lower = 1
+    for upper in BUCKETS:
+        if turn <= upper:
+            return str(upper) if lower == upper else f"{lower}-{upper}"
+        lower = upper + 1
+    return f">{BUCKETS[-1]}"
+
+
+class Worker:
+    """一个工作进程中的会话"""
+
+    def __init__(self, worker: int, sessions: List[int], secrets: Dict[str, Any], generation_seconds: float,
+                 turns: int, save_every: int):
+        self.worker = worker
+        self.sessions = sessions
+        self.secrets = secrets
+        self.generation_seconds = generation_seconds
+        self.turns = turns
+        self.save_every = save_every
+        self.result: Dict[str, List] = {"interactions": [], "refreshes": [], "saves": [], "memory": [], "errors": []}
+
+    def run(self) -> Dict[str, List]:
+        self._memory("baseline", 0, 0)
+        apps = {}
+        for index in self.sessions:
+            at = AppTest.from_file(APP_PATH, default_timeout=120)
+            for name, value in self.secrets.items():
+                at.secrets[name] = value
+            at.run()
+            self._check(at, index, "启动")
+            apps[index] = at
+            self._memory("open", len(apps), 0)
+
+        for turn in range(1, self.turns + 1):
+            for index, at in apps.items():
+                self._ask(at, index, turn)
+                if self.save_every and turn % self.save_every == 0:
+                    self._save(at, index, turn)
+                    self._refresh(at, index, turn)
+            self._memory("turn", len(apps), turn, apps)
+        return self.result
+
+    def _ask(self, at: AppTest, index: int, turn: int):
+        question = f"会话 {index} 第 {turn} 个问题：请解释一下连接池和 keep-alive 的关系？"
+        start = time.perf_counter()
+        at.chat_input[0].set_value(question).run()
+        elapsed = time.perf_counter() - start
+        self._check(at, index, f"第 {turn} 轮")
+        self.result["interactions"].append({
+            "worker": self.worker, "session": index, "turn": turn, "bucket": bucket_of(turn),
+            "ms": elapsed * 1000,
+            "overhead_ms": (elapsed - self.generation_seconds) * 1000,
+            "messages": len(at.session_state["messages"]),
+            "session_kb": self._session_bytes(at) / 1024,
+        })
+
+    def _save(self, at: AppTest, index: int, turn: int):
+        button = self._button(at, index, "保存当前对话到飞书")
+        if button is None:
+            return
+        start = time.perf_counter()
+        button.click().run()
+        elapsed = time.perf_counter() - start
+        self._check(at, index, f"第 {turn} 轮保存")
+        delivered = any("已成功保存" in item.value for item in at.success)
+        self.result["saves"].append({"worker": self.worker, "session": index, "turn": turn,
+                                     "ms": elapsed * 1000, "delivered": delivered})
+
+    def _refresh(self, at: AppTest, index: int, turn: int):
+        button = self._button(at, index, "刷新")
+        if button is None:
+            return
+        start = time.perf_counter()
+        button.click().run()
+        self._check(at, index, f"第 {turn} 轮刷新")
+        self.result["refreshes"].append({"worker": self.worker, "session": index, "turn": turn,
+                                         "bucket": bucket_of(turn), "ms": (time.perf_counter() - start) * 1000})
+
+    def _button(self, at: AppTest, index: int, label: str):
+        button = next((b for b in at.button if label in b.label), None)
+        if button is None:
+            self.result["errors"].append(f"会话 {index}: 未找到按钮「{label}」")
+        return button
+
+    def _memory(self, phase: str, sessions: int, turn: int, apps: Optional[Dict[int, AppTest]] = None):
+        self.result["memory"].append({
+            "worker": self.worker, "phase": phase, "sessions": sessions, "turn": turn,
+            "rss_mb": (process_rss() or 0) / MB,
+            "sessions_mb": sum(self._session_bytes(at) for at in (apps or {}).values()) / MB,
+        })
+
+    @staticmethod
+    def _session_bytes(at: AppTest) -> int:
+        """app.py 上报的本会话内存估算（见 account_session_memory）"""
+        sizes = at.session_state["memory_sizes"] if "memory_sizes" in at.session_state else {}
+        return sum(sizes.values())
+
+    def _check(self, at: AppTest, index: int, step: str):
+        if at.exception:
+            self.result["errors"].append(f"会话 {index} {step}: {at.exception[0].message}")
+        for error in at.error:
+            self.result["errors"].append(f"会话 {index} {step}: {error.value}")
+
+
+def run_worker(worker: int, sessions: List[int], secrets: Dict[str, Any], generation_seconds: float,
+               turns: int, save_every: int, data_dir: str) -> Dict[str, List]:
+    """工作进程入口"""
+    os.chdir(ROOT)
+    os.environ["ASSISTANT_DATA_DIR"] = data_dir
+    return Worker(worker, sessions, secrets, generation_seconds, turns, save_every).run()
+
+
+def run_load_test(stub: StubProviders, args: argparse.Namespace, data_dir: str,
+                  cache_url: str = "") -> Dict[str, Any]:
+    """按工作进程分配会话并汇总结果"""
+    secrets = dict(stub.secrets())
+    secrets.update({
+        # 负载测试不受会话和 Key 配额限制
+        "SESSION_TOKEN_BUDGET": 10 ** 9,
+        "KEY_TOKEN_BUDGET": 10 ** 10,
+        "KEY_CONCURRENCY": 64,
+        "CACHE_URL": cache_url,
+    })
+    sessions = list(range(1, args.sessions + 1))
+    jobs = [
+        (worker, sessions[worker::args.processes], secrets, stub.config.generation_seconds,
+         args.turns, args.save_every, data_dir)
+        for worker in range(args.processes) if sessions[worker::args.processes]
+    ]
+
+    start = time.perf_counter()
+    if len(jobs) == 1:
+        parts = [run_worker(*jobs[0])]
+    else:
+        with multiprocessing.get_context("spawn").Pool(len(jobs)) as pool:
+            parts = pool.starmap(run_worker, jobs)
+
+    results: Dict[str, Any] = {
+        "config": {
+            "sessions": args.sessions, "turns": args.turns, "processes": len(jobs),
+            "generation_ms": stub.config.generation_seconds * 1000, "cache": args.cache,
+        },
+        "elapsed_s": time.perf_counter() - start,
+        "provider_requests": dict(stub.counts),
+    }
+    for key in ("interactions", "refreshes", "saves", "memory", "errors"):
+        results[key] = [item for part in parts for item in part[key]]
+    return results
+
+
+def summarize(results: Dict[str, Any]):
+    """打印汇总表"""
+    config = results["config"]
+    print(f"\n{config['sessions']} 个会话 × {config['turns']} 轮，{config['processes']} 个工作进程，"
+          f"共享缓存 {config['cache']}，桩服务每次生成 {config['generation_ms']:.0f}ms，总耗时 {results['elapsed_s']:.1f}s")
+
+    print(f"\n{'轮数':>8} {'交互 p50':>10} {'交互 p95':>10} {'开销 p50':>10} {'开销 p95':>10} {'刷新 p50':>10} "
+          f"{'会话 KB':>10}")
+    for bucket in dict.fromkeys(item["bucket"] for item in sorted(results["interactions"], key=lambda i: i["turn"])):
+        items = [item for item in results["interactions"] if item["bucket"] == bucket]
+        refreshes = [item["ms"] for item in results["refreshes"] if item["bucket"] == bucket]
+        ms = [item["ms"] for item in items]
+        overhead = [item["overhead_ms"] for item in items]
+        print(f"{bucket:>8} {statistics.median(ms):>10.0f} {percentile(ms, 0.95):>10.0f} "
+              f"{statistics.median(overhead):>10.0f} {percentile(overhead, 0.95):>10.0f} "
+              f"{(statistics.median(refreshes) if refreshes else 0):>10.0f} "
+              f"{statistics.median(item['session_kb'] for item in items):>10.0f}")
+
+    saves = [item["ms"] for item in results["saves"]]
+    if saves:
+        delivered = sum(1 for item in results["saves"] if item["delivered"])
+        print(f"\n保存到飞书: {len(saves)} 次（成功 {delivered}），p50 {statistics.median(saves):.0f}ms，"
+              f"p95 {percentile(saves, 0.95):.0f}ms")
+
+    # 内存按工作进程分别统计（相对该进程打开会话之前的 RSS）
+    print(f"\n{'进程':>4} {'会话数':>6} {'轮数':>6} {'RSS (MB)':>10} {'增长 (MB)':>10} {'会话估算 (MB)':>14}")
+    baselines = {item["worker"]: item["rss_mb"] for item in results["memory"] if item["phase"] == "baseline"}
+    for item in results["memory"]:
+        if item["phase"] == "baseline":
+            continue
+        print(f"{item['worker']:>4} {item['sessions']:>6} {item['turn']:>6} {item['rss_mb']:>10.0f} "
+              f"{item['rss_mb'] - baselines[item['worker']]:>10.0f} {item['sessions_mb']:>14.2f}")
+
+    print(f"\n上游请求: {results['provider_requests']}")
+    if results.get("redis_commands"):
+        print(f"Redis 命令: {results['redis_commands']}")
+    if results["errors"]:
+        print(f"\n错误 {len(results['errors'])} 个:")
+        for error in results["errors"][:10]:
+            print(f"  {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端负载测试（AppTest + 本地桩服务）")
+    parser.add_argument("--sessions", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--processes", type=int, default=1, help="并行的工作进程数（会话平均分配）")
+    parser.add_argument("--save-every", type=int, default=5, help="每隔多少轮保存一次到飞书（0 表示不保存）")
+    parser.add_argument("--first-token", type=float, default=0.2)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--cache", choices=("sqlite", "redis", "off"), default="sqlite",
+                        help="跨进程共享缓存的后端（redis 时使用 Redis 协议桩服务）")
+    parser.add_argument("--json", help="将原始结果写入该 JSON 文件")
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    with tempfile.TemporaryDirectory(prefix="load-test-") as data_dir:
+        config = StubConfig(args.first_token, args.chunk_delay, args.chunks)
+        with StubProviders(config) as stub:
+            if args.cache == "redis":
+                with StubRedis() as redis:
+                    results = run_load_test(stub, args, data_dir, cache_url=redis.url)
+                results["redis_commands"] = dict(redis.counts)
+            else:
+                results = run_load_test(stub, args, data_dir, cache_url="off" if args.cache == "off" else "")
+
+    summarize(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+聊天记录渲染基准测试
+使用 streamlit.testing 的 AppTest 运行 app.py，测量不同对话长度下一次重新运行（点击"刷新界面"）的耗时，
+对比折叠历史（默认）与渲染全部历史两种方式
+
+用法: python benchmarks/render_benchmark.py [--turns 10 100 500] [--repeat 5]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+from streamlit.testing.v1 import AppTest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "app.py")
+
+
+def build_messages(turns: int):
+    """构造指定轮数的对话（每轮一问一答，seq 与 append_message 追加的消息一致）"""
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"第 {i} 个问题：请解释一下 **Markdown** 渲染的开销？",
+                         "image_preview": None, "seq": 2 * i})
+        messages.append({
+            "role": "assistant",
+            "content": f"第 {i} 个回答。\n\n- 要点一\n- 要点二\n\n```python\nprint({i})\n```",
+            "model": "deepseek",
+            "model_name": "deepseek-chat",
+            "seq": 2 * i + 1
+        })
+    return messages
+
+
+def measure(turns: int, repeat: int, render_all: bool) -> float:
+    """返回重新运行耗时的中位数（毫秒）"""
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    # 未配置 secrets.toml 时提供空配置
+    at.secrets["DEEPSEEK_API_KEY"] = ""
+    at.run()
+    messages = build_messages(turns)
+    at.session_state["messages"] = messages
+    if render_all:
+        at.session_state["history_visible"] = len(messages)
+    at.run()
+
+    samples = []
+    for _ in range(repeat):
+        refresh = next(b for b in at.button if "刷新" in b.label)
+        start = time.perf_counter()
+        refresh.click().run()
+        samples.append((time.perf_counter() - start) * 1000)
+        if at.exception:
+            raise RuntimeError(at.exception)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天记录渲染基准测试")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+
+    print(f"{'轮数':>6} {'折叠历史 (ms)':>14} {'全部渲染 (ms)':>14}")
+    for turns in args.turns:
+        windowed = measure(turns, args.repeat, render_all=False)
+        full = measure(turns, args.repeat, render_all=True)
+        print(f"{turns:>6} {windowed:>14.1f} {full:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
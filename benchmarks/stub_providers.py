@@ -0,0 +1,435 @@
+"""
+本地桩服务
+在一个 HTTP 服务中模拟 DeepSeek（OpenAI 兼容接口）、Gemini（REST 接口，含 Files API 上传）和飞书开放平台，
+按配置的首 token 延迟、分块间隔和飞书延迟返回固定内容，并统计每个接口的请求数，供负载测试使用。
+
+各服务的地址：
+    DeepSeek: {url}/deepseek      （DEEPSEEK_BASE_URL）
+    Gemini:   {url}/gemini        （GEMINI_BASE_URL）
+    飞书:     {url}/feishu        （FEISHU_BASE_URL）
+
+StubRedis 是一个进程内的最小 Redis 协议服务（GET / SET / DEL / PING），用于测试共享缓存的 RedisCache。
+
+用法: python benchmarks/stub_providers.py [--port 8765] [--redis-port 6390]
+"""
+
+import argparse
+import json
+import socketserver
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterable, Optional
+from urllib.parse import parse_qs, urlparse
+
+
+class StubConfig:
+    """桩服务的延迟与输出配置"""
+
+    def __init__(self,
+                 first_token: float = 0.2,
+                 chunk_delay: float = 0.02,
+                 chunks: int = 20,
+                 feishu_latency: float = 0.05):
+        """
+        初始化配置
+
+        Args:
+            first_token: 模型首个分块之前的延迟（秒）
+            chunk_delay: 模型相邻分块之间的间隔（秒）
+            chunks: 每个回答的分块数
+            feishu_latency: 飞书每个接口的延迟（秒）
+        """
+        self.first_token = first_token
+        self.chunk_delay = chunk_delay
+        self.chunks = chunks
+        self.feishu_latency = feishu_latency
+
+    @property
+    def generation_seconds(self) -> float:
+        """一次生成在桩服务中花费的时间（秒）"""
+        return self.first_token + self.chunk_delay * self.chunks
+
+
+class StubProviders:
+    """DeepSeek / Gemini / 飞书桩服务"""
+
+    def __init__(self, config: Optional[StubConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        """
+        初始化桩服务
+
+        Args:
+            config: 延迟与输出配置
+            host: 监听地址
+            port: 监听端口，0 表示随机端口
+        """
+        self.config = config or StubConfig()
+        self.counts: Counter = Counter()
+        self.records: Dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _handler_class(self))
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def secrets(self) -> Dict[str, str]:
+        """指向桩服务的 secrets（可直接赋值给 AppTest.secrets）"""
+        return {
+            "DEEPSEEK_API_KEY": "sk-stub",
+            "DEEPSEEK_BASE_URL": f"{self.url}/deepseek",
+            "GEMINI_API_KEY": "gemini-stub",
+            "GEMINI_BASE_URL": f"{self.url}/gemini",
+            "FEISHU_APP_ID": "cli_stub",
+            "FEISHU_APP_SECRET": "stub-secret",
+            "FEISHU_APP_TOKEN": "bascnStub",
+            "FEISHU_TABLE_ID": "tblStub",
+            "FEISHU_BASE_URL": f"{self.url}/feishu",
+        }
+
+    def start(self) -> "StubProviders":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name="stub-providers")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, endpoint: str):
+        with self._lock:
+            self.counts[endpoint] += 1
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _answer_pieces(config: StubConfig, prompt: str) -> list:
+    """固定格式的回答（包含 Markdown，接近真实回答的渲染开销）"""
+    head = f"关于「{prompt[:20]}」的回答：\n\n"
+    body = [f"- 第 {i + 1} 点，说明一些细节。\n" for i in range(max(0, config.chunks - 2))]
+    tail = ["\n```python\nprint('stub')\n```\n"]
+    return ([head] + body + tail)[:max(1, config.chunks)]
+
+
+def _handler_class(stub: StubProviders):
+    config = stub.config
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        # ==================== 基础方法 ====================
+
+        def _body(self) -> Dict[str, Any]:
+            length = int(self.headers.get("content-length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            try:
+                return json.loads(raw) if raw else {}
+            except ValueError:
+                return {"_raw": len(raw)}
+
+        def _json(self, payload: Dict[str, Any], status: int = 200, headers: Optional[Dict[str, str]] = None):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("content-type", "application/json; charset=utf-8")
+            self.send_header("content-length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _sse(self, events: Iterable[str]):
+            """分块传输的 SSE 响应（保持连接可复用）"""
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.send_header("transfer-encoding", "chunked")
+            self.end_headers()
+            for event in events:
+                data = f"data: {event}\n\n".encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path.startswith("/deepseek/models"):
+                stub.count("deepseek.models")
+                return self._json({"object": "list", "data": [
+                    {"id": "deepseek-chat", "object": "model", "created": 0, "owned_by": "stub"}
+                ]})
+            if path.startswith("/gemini/") and "/models/" in path:
+                stub.count("gemini.models")
+                return self._json({"name": "models/" + path.rsplit("/", 1)[-1], "displayName": "stub"})
+            if path.startswith("/feishu/"):
+                return self._feishu("GET", path)
+            self._json({"error": f"unknown path {path}"}, status=404)
+
+        def do_POST(self):
+            parsed = urlparse(self.path)
+            path = parsed.path
+            if path.startswith("/deepseek/chat/completions"):
+                return self._deepseek(self._body())
+            if path.startswith("/gemini/upload/"):
+                return self._gemini_upload(path, parse_qs(parsed.query))
+            if path.startswith("/gemini/") and (":generateContent" in path or ":streamGenerateContent" in path):
+                return self._gemini(path, self._body())
+            if path.startswith("/feishu/"):
+                return self._feishu("POST", path)
+            self._body()
+            self._json({"error": f"unknown path {path}"}, status=404)
+
+        # ==================== DeepSeek ====================
+
+        def _deepseek(self, body: Dict[str, Any]):
+            prompt = (body.get("messages") or [{}])[-1].get("content") or ""
+            prompt = prompt if isinstance(prompt, str) else json.dumps(prompt, ensure_ascii=False)
+            pieces = _answer_pieces(config, prompt)
+            # 每个分块计为 1 个输出 token，超过 max_tokens 时截断
+            finish_reason = "stop"
+            if body.get("max_tokens") and len(pieces) > body["max_tokens"]:
+                pieces, finish_reason = pieces[:body["max_tokens"]], "length"
+            usage = {"prompt_tokens": len(prompt), "completion_tokens": len(pieces), "total_tokens": len(prompt) + len(pieces)}
+            model = body.get("model", "deepseek-chat")
+            time.sleep(config.first_token)
+            if not body.get("stream"):
+                stub.count("deepseek.chat")
+                return self._json({
+                    "id": "stub", "object": "chat.completion", "created": 0, "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)},
+                                 "finish_reason": finish_reason}],
+                    "usage": usage
+                })
+
+            stub.count("deepseek.chat.stream")
+
+            def events():
+                for i, piece in enumerate(pieces):
+                    if i:
+                        time.sleep(config.chunk_delay)
+                    yield json.dumps({"id": "stub", "object": "chat.completion.chunk", "created": 0, "model": model,
+                                      "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]},
+                                     ensure_ascii=False)
+                yield json.dumps({"id": "stub", "object": "chat.completion.chunk", "created": 0, "model": model,
+                                  "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}], "usage": usage})
+                yield "[DONE]"
+            self._sse(events())
+
+        # ==================== Gemini ====================
+
+        def _gemini(self, path: str, body: Dict[str, Any]):
+            parts = [part.get("text", "") for content in body.get("contents") or [] for part in content.get("parts") or []]
+            prompt = next((text for text in reversed(parts) if text), "")
+            pieces = _answer_pieces(config, prompt)
+            usage = {"promptTokenCount": len(prompt), "candidatesTokenCount": len(pieces),
+                     "totalTokenCount": len(prompt) + len(pieces)}
+
+            def chunk(text, finish=None, with_usage=False):
+                candidate = {"content": {"parts": [{"text": text}], "role": "model"}}
+                if finish:
+                    candidate["finishReason"] = finish
+                payload = {"candidates": [candidate]}
+                if with_usage:
+                    payload["usageMetadata"] = usage
+                return payload
+
+            time.sleep(config.first_token)
+            if ":streamGenerateContent" not in path:
+                stub.count("gemini.generate")
+                return self._json(chunk("".join(pieces), "STOP", True))
+
+            stub.count("gemini.generate.stream")
+
+            def events():
+                for i, piece in enumerate(pieces):
+                    if i:
+                        time.sleep(config.chunk_delay)
+                    last = i == len(pieces) - 1
+                    yield json.dumps(chunk(piece, "STOP" if last else None, last), ensure_ascii=False)
+            self._sse(events())
+
+        def _gemini_upload(self, path: str, query: Dict[str, list]):
+            """Files API 可续传上传：start 返回上传地址，upload, finalize 返回文件信息"""
+            command = (self.headers.get("x-goog-upload-command") or "").lower()
+            body = self._body()
+            if "start" in command:
+                stub.count("gemini.upload.start")
+                upload_id = uuid.uuid4().hex[:12]
+                mime_type = ((body.get("file") or {}).get("mimeType")) or "image/jpeg"
+                host = self.headers.get("host")
+                return self._json({}, headers={
+                    "x-goog-upload-url": f"http://{host}/gemini/upload/session/{upload_id}?mime={mime_type}",
+                    "x-goog-upload-status": "active"
+                })
+            stub.count("gemini.upload.finalize")
+            upload_id = path.rsplit("/", 1)[-1]
+            mime_type = (query.get("mime") or ["image/jpeg"])[0]
+            host = self.headers.get("host")
+            return self._json({"file": {
+                "name": f"files/{upload_id}",
+                "uri": f"http://{host}/gemini/v1beta/files/{upload_id}",
+                "mimeType": mime_type,
+                "state": "ACTIVE"
+            }}, headers={"x-goog-upload-status": "final"})
+
+        # ==================== 飞书 ====================
+
+        def _feishu(self, method: str, path: str):
+            body = self._body() if method == "POST" else {}
+            time.sleep(config.feishu_latency)
+            if path.endswith("/tenant_access_token/internal"):
+                stub.count("feishu.token")
+                return self._json({"code": 0, "msg": "ok", "tenant_access_token": "t-stub", "expire": 7200})
+            if path.endswith("/records/batch_create"):
+                stub.count("feishu.batch_create")
+                records = [{"record_id": f"rec{uuid.uuid4().hex[:10]}", "fields": record.get("fields", {})}
+                           for record in body.get("records") or []]
+                with stub._lock:
+                    stub.records.setdefault(path, []).extend(records)
+                return self._json({"code": 0, "msg": "ok", "data": {"records": records}})
+            if path.endswith("/records"):
+                stub.count("feishu.list")
+                with stub._lock:
+                    items = list(stub.records.get(path + "/batch_create", []))
+                return self._json({"code": 0, "msg": "ok", "data": {"items": items, "has_more": False, "total": len(items)}})
+            stub.count("feishu.other")
+            return self._json({"code": 0, "msg": "ok", "data": {}})
+
+    return Handler
+
+
+class StubRedis:
+    """最小的 Redis 协议服务（数据只保存在内存中）"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        """
+        初始化服务
+
+        Args:
+            host: 监听地址
+            port: 监听端口，0 表示随机端口
+        """
+        self.data: Dict[bytes, tuple] = {}
+        self.counts: Counter = Counter()
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer((host, port), _redis_handler_class(self))
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self) -> "StubRedis":
+        threading.Thread(target=self._server.serve_forever, daemon=True, name="stub-redis").start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def execute(self, args: list) -> Any:
+        """执行一条命令，返回 bytes / int / None，错误时返回 Exception"""
+        command = args[0].upper().decode()
+        with self._lock:
+            self.counts[command] += 1
+            if command == "PING":
+                return "PONG"
+            if command in ("AUTH", "SELECT"):
+                return "OK"
+            if command == "GET":
+                return self._live(args[1])
+            if command == "DEL":
+                return sum(1 for key in args[1:] if self.data.pop(key, None) is not None)
+            if command == "SET":
+                options = [arg.upper() for arg in args[3:]]
+                expires_at = None
+                if b"PX" in options:
+                    expires_at = time.time() + int(args[3 + options.index(b"PX") + 1]) / 1000
+                if b"NX" in options and self._live(args[1]) is not None:
+                    return None
+                self.data[args[1]] = (args[2], expires_at)
+                return "OK"
+        return Exception(f"ERR unknown command '{command}'")
+
+    def _live(self, key: bytes) -> Optional[bytes]:
+        value, expires_at = self.data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            self.data.pop(key, None)
+            return None
+        return value
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _redis_handler_class(stub: StubRedis):
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            while True:
+                line = self.rfile.readline()
+                if not line.startswith(b"*"):
+                    return
+                args = []
+                for _ in range(int(line[1:])):
+                    length = int(self.rfile.readline()[1:])
+                    args.append(self.rfile.read(length + 2)[:-2])
+                self.wfile.write(self._encode(stub.execute(args)))
+
+        @staticmethod
+        def _encode(reply) -> bytes:
+            if reply is None:
+                return b"$-1\r\n"
+            if isinstance(reply, Exception):
+                return f"-{reply}\r\n".encode()
+            if isinstance(reply, str):
+                return f"+{reply}\r\n".encode()
+            if isinstance(reply, int):
+                return b":%d\r\n" % reply
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DeepSeek / Gemini / 飞书本地桩服务")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--first-token", type=float, default=0.2)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--redis-port", type=int, help="同时启动 Redis 协议桩服务（共享缓存 CACHE_URL）")
+    args = parser.parse_args()
+
+    stub = StubProviders(StubConfig(args.first_token, args.chunk_delay, args.chunks), port=args.port).start()
+    redis = StubRedis(port=args.redis_port).start() if args.redis_port is not None else None
+    print(f"桩服务已启动: {stub.url}")
+    for name, value in stub.secrets().items():
+        print(f'{name} = "{value}"')
+    if redis is not None:
+        print(f'CACHE_URL = "{redis.url}"')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
+        if redis is not None:
+            redis.stop()
+
+
+if __name__ == "__main__":
+    main()
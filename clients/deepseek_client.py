@@ -4,27 +4,68 @@ DeepSeek API 客户端模块
 """
 
 import openai
-from typing import Optional, Dict, Any
+import time
+from typing import Optional, Dict, Any, List, Iterator
 import logging
 
+from utils.retry import RetryPolicy
+from utils.prompt_cache import PrefixMessageBuilder
+from utils.cancellation import CancelToken, partial_usage, close_response
+from utils.tokens import estimate_tokens
+from utils.recorder import ProviderRecorder, httpx_module_of
+from utils.transport import ClientTransport
+from utils.output_length import (
+    OutputLengthPredictor, model_max_output, includes_reasoning, REASONING_MIN_TOKENS
+)
+from utils.metrics import metrics
+
 # 配置日志
 logger = logging.getLogger(__name__)
 
+# 未配置输出长度预测器时的 max_tokens
+DEFAULT_MAX_TOKENS = 2000
+# 续写的开头与已输出内容重复时去掉重复部分（检查的最大字符数与最少重复字符数）
+OVERLAP_WINDOW = 200
+MIN_OVERLAP = 8
+CONTINUE_PROMPT = "你的回答因长度限制被截断了。请从中断处直接继续输出剩余内容，不要重复已输出的内容，也不要添加任何开场白。"
+
 
 class DeepSeekClient:
     """DeepSeek API 客户端"""
     
-    def __init__(self, api_key: str, base_url: str = "https://api.deepseek.com"):
+    def __init__(self, 
+                 api_key: str, 
+                 base_url: str = "https://api.deepseek.com",
+                 retry_policy: Optional[RetryPolicy] = None,
+                 recorder: Optional[ProviderRecorder] = None,
+                 transport: Optional[ClientTransport] = None,
+                 length_predictor: Optional[OutputLengthPredictor] = None,
+                 max_continuations: int = 2):
         """
         初始化 DeepSeek 客户端
         
         Args:
             api_key: DeepSeek API Key
             base_url: API 基础 URL，默认为 DeepSeek 官方 API
+            retry_policy: 重试策略，默认最多尝试 3 次
+            recorder: 录制/回放控制器（录制或回放上游请求），传入 transport 时以 transport 的设置为准
+            transport: 传输层（代理与连接池），默认使用 SDK 自带的客户端
+            length_predictor: 输出长度预测器，未指定 max_tokens 时按历史输出长度估算
+            max_continuations: 未指定 max_tokens 时，回复被截断后最多自动续写的次数
         """
         self.api_key = api_key
         self.base_url = base_url
+        if transport is None and recorder is not None and recorder.enabled:
+            transport = ClientTransport(recorder=recorder)
+        self.transport = transport
         self.client = None
+        # 流式请求的超时（读超时限制分块间隔，由传输层配置）
+        self._stream_timeout = openai.NOT_GIVEN
+        self.retry_policy = retry_policy or RetryPolicy(name="deepseek", total_timeout=120.0)
+        # 前缀稳定的消息构建器（命中 DeepSeek 上下文缓存）
+        self.message_builder = PrefixMessageBuilder()
+        self.length_predictor = length_predictor
+        self.max_continuations = max_continuations
         
         if api_key:
             self._initialize_client()
@@ -32,21 +73,83 @@ class DeepSeekClient:
     def _initialize_client(self):
         """初始化 OpenAI 客户端"""
         try:
+            # 关闭 SDK 内置重试，统一由 retry_policy 处理
+            # 传入 transport 时共享其连接池（HTTP/2、连接数上限、keep-alive 和超时由传输层配置）
+            http_client = None
+            if self.transport is not None:
+                http_client = self.transport.httpx_client(openai.DefaultHttpxClient)
+                self._stream_timeout = self.transport.settings.timeout(
+                    httpx_module_of(openai.DefaultHttpxClient), stream=True
+                )
             self.client = openai.OpenAI(
                 api_key=self.api_key,
-                base_url=self.base_url
+                base_url=self.base_url,
+                max_retries=0,
+                http_client=http_client
             )
             logger.info("DeepSeek 客户端初始化成功")
         except Exception as e:
             logger.error(f"DeepSeek 客户端初始化失败: {e}")
             self.client = None
     
+    def warm_up(self, probe: bool = False) -> Dict[str, Any]:
+        """
+        预热：请求模型列表以建立连接（TLS 握手后连接留在连接池中），可选发送一次极小的生成请求
+        
+        Args:
+            probe: 是否额外发送一次 max_tokens=1 的生成请求（会产生少量费用）
+            
+        Returns:
+            Dict 包含 success、steps（各步骤耗时，毫秒）和 error
+        """
+        if not self.client:
+            return {"success": False, "steps": {}, "error": "DeepSeek 客户端未初始化"}
+        steps = {}
+        try:
+            start = time.perf_counter()
+            self.client.models.list()
+            steps["connect"] = (time.perf_counter() - start) * 1000
+            if probe:
+                start = time.perf_counter()
+                self.client.chat.completions.create(
+                    model="deepseek-chat",
+                    messages=[{"role": "user", "content": "ping"}],
+                    max_tokens=1
+                )
+                steps["probe"] = (time.perf_counter() - start) * 1000
+            return {"success": True, "steps": steps, "error": None}
+        except Exception as e:
+            logger.warning(f"DeepSeek 预热失败: {e}")
+            return {"success": False, "steps": steps, "error": str(e)}
+    
+    def health_check(self, timeout: float = 5.0) -> Dict[str, Any]:
+        """
+        健康检查：以较短的超时读取模型列表（不重试），用于侧边栏服务状态
+        
+        Args:
+            timeout: 超时（秒）
+            
+        Returns:
+            Dict 包含 success、latency_ms 和 error
+        """
+        if not self.client:
+            return {"success": False, "latency_ms": 0.0, "error": "DeepSeek 客户端未初始化"}
+        start = time.perf_counter()
+        try:
+            self.client.with_options(timeout=timeout, max_retries=0).models.list()
+            return {"success": True, "latency_ms": (time.perf_counter() - start) * 1000, "error": None}
+        except Exception as e:
+            return {"success": False, "latency_ms": (time.perf_counter() - start) * 1000, "error": str(e)}
+    
     def get_response(self, 
                     message: str, 
                     model: str = "deepseek-chat",
                     system_prompt: Optional[str] = None,
                     temperature: float = 0.7,
-                    max_tokens: int = 2000) -> Dict[str, Any]:
+                    max_tokens: Optional[int] = None,
+                    history: Optional[List[Dict[str, Any]]] = None,
+                    context: Optional[str] = None,
+                    max_continuations: Optional[int] = None) -> Dict[str, Any]:
         """
         获取 DeepSeek 的文本回复
         
@@ -55,10 +158,14 @@ class DeepSeekClient:
             model: 使用的模型，默认为 deepseek-chat
             system_prompt: 系统提示词
             temperature: 温度参数，控制随机性
-            max_tokens: 最大生成 token 数
+            max_tokens: 最大生成 token 数，None 时由输出长度预测器估算（未配置时为 2000）
+            history: 历史消息（每项包含 role 和 content），原样作为请求前缀
+            context: 仅本轮使用的附加上下文，拼接在用户消息前
+            max_continuations: 回复被截断（finish_reason 为 length）时最多自动续写的次数，
+                默认只在 max_tokens 为 None 时续写（显式指定 max_tokens 视为有意限制长度）
             
         Returns:
-            Dict 包含响应内容或错误信息
+            Dict 包含响应内容或错误信息（续写时 content 为拼接后的完整回复，usage 为各段之和）
         """
         if not self.client:
             return {
@@ -68,80 +175,366 @@ class DeepSeekClient:
             }
         
         try:
-            # 构建消息列表
-            messages = []
-            
-            if system_prompt:
-                messages.append({
-                    "role": "system",
-                    "content": system_prompt
-                })
-            
-            messages.append({
-                "role": "user",
-                "content": message
-            })
-            
-            # 调用 API
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                stream=False
+            # 构建消息列表（系统提示词和历史保持逐字节一致，便于命中前缀缓存）
+            messages = self.message_builder.build(
+                message,
+                system_prompt=system_prompt,
+                history=history,
+                context=context
             )
+            plan = self._length_plan(message, model, context, max_tokens, max_continuations)
+            
+            pieces = []
+            usage = {}
+            finish_reason = None
+            request_messages = messages
+            for attempt in range(plan["continuations"] + 1):
+                limit = plan["max_tokens"] if attempt == 0 else plan["continuation_tokens"]
+                # 调用 API（限流、连接错误和 5xx 按重试策略重试）
+                try:
+                    response = self.retry_policy.call(
+                        lambda request_messages=request_messages, limit=limit: self.client.chat.completions.create(
+                            model=model,
+                            messages=request_messages,
+                            temperature=temperature,
+                            max_tokens=limit,
+                            stream=False
+                        )
+                    )
+                except Exception as e:
+                    if not attempt:
+                        raise
+                    # 续写失败时返回已生成的部分
+                    logger.warning(f"DeepSeek 续写失败，返回已生成的内容: {e}")
+                    break
+                
+                # 提取回复内容
+                choice = response.choices[0]
+                pieces.append(_strip_overlap("".join(pieces), choice.message.content or ""))
+                usage = _merge_usage(usage, self._extract_usage(response.usage))
+                finish_reason = choice.finish_reason
+                if finish_reason != "length" or attempt == plan["continuations"]:
+                    break
+                if not "".join(pieces):
+                    # 额度在输出正文之前就已耗尽（通常是思维链），续写无从接起
+                    logger.warning("DeepSeek 回复被截断且没有正文，不再续写")
+                    break
+                request_messages = self._continuation_messages(messages, "".join(pieces))
             
-            # 提取回复内容
-            content = response.choices[0].message.content
+            content = "".join(pieces)
+            self._observe_length(plan, usage, truncated=len(pieces) > 1 or finish_reason == "length")
             
-            logger.info(f"DeepSeek 响应成功，token 使用: {response.usage.total_tokens}")
+            logger.info(
+                f"DeepSeek 响应成功，token 使用: {usage['total_tokens']}，"
+                f"缓存命中: {usage['prompt_cache_hit_tokens']}，续写 {len(pieces) - 1} 次"
+            )
             
             return {
                 "success": True,
                 "content": content,
                 "model": model,
-                "usage": {
-                    "prompt_tokens": response.usage.prompt_tokens,
-                    "completion_tokens": response.usage.completion_tokens,
-                    "total_tokens": response.usage.total_tokens
+                "usage": usage,
+                "finish_reason": finish_reason,
+                "continuations": len(pieces) - 1
+            }
+            
+        except Exception as e:
+            return self._error_response(e)
+    
+    def stream_response(self, 
+                        message: str, 
+                        model: str = "deepseek-chat",
+                        system_prompt: Optional[str] = None,
+                        temperature: float = 0.7,
+                        max_tokens: Optional[int] = None,
+                        history: Optional[List[Dict[str, Any]]] = None,
+                        context: Optional[str] = None,
+                        cancel_token: Optional[CancelToken] = None,
+                        max_continuations: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        流式获取 DeepSeek 的文本回复（被截断时自动续写，续写的内容接在同一个流中输出）
+        
+        Args:
+            参数同 get_response
+            cancel_token: 取消令牌，取消时立即关闭上游连接
+            
+        Yields:
+            Dict 事件：{"type": "delta", "content": 文本片段}，
+            结束时 {"type": "done", "content": 完整回复, "usage": ..., "finish_reason": ..., "continuations": ...}，
+            被取消时 {"type": "cancelled", "content": 部分回复, "usage": 估算用量}，
+            出错时 {"type": "error", "error": 错误信息}
+        """
+        if not self.client:
+            yield {"type": "error", "error": "DeepSeek 客户端未初始化，请检查 API Key"}
+            return
+        
+        try:
+            messages = self.message_builder.build(
+                message,
+                system_prompt=system_prompt,
+                history=history,
+                context=context
+            )
+            plan = self._length_plan(message, model, context, max_tokens, max_continuations)
+            
+            parts = []
+            usage = {}
+            finish_reason = None
+            request_messages = messages
+            for attempt in range(plan["continuations"] + 1):
+                limit = plan["max_tokens"] if attempt == 0 else plan["continuation_tokens"]
+                try:
+                    piece = yield from self._stream_piece(request_messages, model, temperature, limit,
+                                                          cancel_token, previous="".join(parts))
+                except Exception as e:
+                    if not attempt:
+                        raise
+                    logger.warning(f"DeepSeek 续写失败，返回已生成的内容: {e}")
+                    break
+                parts.append(piece["content"])
+                usage = _merge_usage(usage, piece["usage"])
+                finish_reason = piece["finish_reason"]
+                if cancel_token and cancel_token.cancelled:
+                    break
+                if finish_reason != "length" or attempt == plan["continuations"]:
+                    break
+                if not "".join(parts):
+                    logger.warning("DeepSeek 回复被截断且没有正文，不再续写")
+                    break
+                request_messages = self._continuation_messages(messages, "".join(parts))
+            
+            if cancel_token and cancel_token.cancelled:
+                content = "".join(parts)
+                logger.info(f"DeepSeek 流式响应已取消，已生成 {len(content)} 字符")
+                prompt_tokens = sum(estimate_tokens(m["content"]) for m in messages)
+                yield {
+                    "type": "cancelled",
+                    "content": content,
+                    "model": model,
+                    "usage": usage or partial_usage(prompt_tokens, content)
                 }
+                return
+            
+            self._observe_length(plan, usage, truncated=len(parts) > 1 or finish_reason == "length")
+            logger.info(f"DeepSeek 流式响应完成，token 使用: {usage.get('total_tokens')}，续写 {len(parts) - 1} 次")
+            
+            yield {
+                "type": "done",
+                "content": "".join(parts),
+                "model": model,
+                "usage": usage,
+                "finish_reason": finish_reason,
+                "continuations": len(parts) - 1
             }
             
-        except openai.AuthenticationError as e:
+        except Exception as e:
+            yield {"type": "error", "error": self._error_response(e)["error"]}
+    
+    def _stream_piece(self,
+                      messages: List[Dict[str, Any]],
+                      model: str,
+                      temperature: float,
+                      max_tokens: int,
+                      cancel_token: Optional[CancelToken],
+                      previous: str = "") -> Iterator[Dict[str, Any]]:
+        """
+        流式请求一段回复，逐块产出 delta 事件
+        
+        Args:
+            messages: 请求消息
+            previous: 之前各段已输出的内容（续写时去掉开头与之重复的部分）
+            
+        Returns:
+            Dict 包含本段的 content、usage 和 finish_reason（作为生成器的返回值）
+        """
+        # 建立连接阶段按重试策略重试，开始输出后不再重试
+        stream = self.retry_policy.call(
+            lambda: self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},
+                timeout=self._stream_timeout
+            )
+        )
+        
+        parts = []
+        usage = {}
+        finish_reason = None
+        # 续写的开头先缓存 OVERLAP_WINDOW 个字符，去掉与已输出内容重复的部分后再输出
+        pending = "" if previous else None
+        # 取消时从其他线程关闭响应，阻塞中的读取会立即返回
+        unregister = cancel_token.add_callback(lambda: close_response(stream.response)) if cancel_token else None
+        try:
+            for chunk in stream:
+                if cancel_token and cancel_token.cancelled:
+                    break
+                if chunk.usage:
+                    usage = self._extract_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+                if choice.delta and choice.delta.content:
+                    text = choice.delta.content
+                    if pending is not None:
+                        pending += text
+                        if len(pending) < OVERLAP_WINDOW:
+                            continue
+                        text, pending = _strip_overlap(previous, pending), None
+                        if not text:
+                            continue
+                    parts.append(text)
+                    yield {"type": "delta", "content": text}
+        except Exception:
+            if not (cancel_token and cancel_token.cancelled):
+                raise
+        finally:
+            if unregister:
+                unregister()
+            stream.close()
+        
+        if pending:
+            text = _strip_overlap(previous, pending)
+            if text:
+                parts.append(text)
+                yield {"type": "delta", "content": text}
+        return {"content": "".join(parts), "usage": usage, "finish_reason": finish_reason}
+    
+    def _length_plan(self,
+                     message: str,
+                     model: str,
+                     context: Optional[str],
+                     max_tokens: Optional[int],
+                     max_continuations: Optional[int]) -> Dict[str, Any]:
+        """
+        确定本次请求的 max_tokens 和续写次数
+        
+        Returns:
+            Dict 包含 features（未使用预测器时为 None）、max_tokens、continuations 和 continuation_tokens
+        """
+        features = None
+        if max_tokens is None:
+            if includes_reasoning(model):
+                # 推理模型的 max_tokens 包含思维链，按回答长度预测会导致正文为空
+                max_tokens = REASONING_MIN_TOKENS
+            elif self.length_predictor is not None:
+                features = self.length_predictor.features(message, model, context)
+                max_tokens = self.length_predictor.predict(features)
+            else:
+                max_tokens = DEFAULT_MAX_TOKENS
+            if max_continuations is None:
+                max_continuations = self.max_continuations
+        return {
+            "features": features,
+            "max_tokens": max_tokens,
+            "continuations": max_continuations or 0,
+            # 需要续写说明回答较长，续写时预留更多额度
+            "continuation_tokens": min(model_max_output(model), max(max_tokens, 1024) * 2)
+        }
+    
+    def _observe_length(self, plan: Dict[str, Any], usage: Dict[str, int], truncated: bool):
+        """将实际输出长度计入预测器"""
+        if truncated:
+            metrics.increment("deepseek.truncated")
+        if plan["features"] is not None:
+            self.length_predictor.observe(plan["features"], usage.get("completion_tokens", 0), truncated=truncated)
+    
+    @staticmethod
+    def _continuation_messages(messages: List[Dict[str, Any]], partial: str) -> List[Dict[str, Any]]:
+        """续写请求的消息：原请求（前缀不变，可命中上下文缓存）+ 已生成的部分 + 续写指令"""
+        metrics.increment("deepseek.continuations")
+        logger.info(f"DeepSeek 回复因长度限制被截断（已生成 {len(partial)} 字符），自动续写")
+        return messages + [
+            {"role": "assistant", "content": partial},
+            {"role": "user", "content": CONTINUE_PROMPT}
+        ]
+    
+    def _error_response(self, e: Exception) -> Dict[str, Any]:
+        """
+        将异常转换为错误响应
+        
+        Args:
+            e: 捕获到的异常
+            
+        Returns:
+            Dict 包含错误信息
+        """
+        if isinstance(e, openai.AuthenticationError):
             logger.error(f"DeepSeek 认证失败: {e}")
-            return {
-                "success": False,
-                "error": f"API Key 认证失败: {str(e)}",
-                "content": None
-            }
-        except openai.RateLimitError as e:
+            error = f"API Key 认证失败: {str(e)}"
+        elif isinstance(e, openai.RateLimitError):
             logger.error(f"DeepSeek 请求频率限制: {e}")
-            return {
-                "success": False,
-                "error": f"请求频率超限: {str(e)}",
-                "content": None
-            }
-        except openai.APIConnectionError as e:
+            error = f"请求频率超限: {str(e)}"
+        elif isinstance(e, openai.APIConnectionError):
             logger.error(f"DeepSeek 连接错误: {e}")
-            return {
-                "success": False,
-                "error": f"网络连接错误: {str(e)}",
-                "content": None
-            }
-        except openai.APIError as e:
+            error = f"网络连接错误: {str(e)}"
+        elif isinstance(e, openai.APIError):
             logger.error(f"DeepSeek API 错误: {e}")
-            return {
-                "success": False,
-                "error": f"API 调用错误: {str(e)}",
-                "content": None
-            }
-        except Exception as e:
+            error = f"API 调用错误: {str(e)}"
+        else:
             logger.error(f"DeepSeek 未知错误: {e}")
-            return {
-                "success": False,
-                "error": f"未知错误: {str(e)}",
-                "content": None
-            }
+            error = f"未知错误: {str(e)}"
+        
+        return {
+            "success": False,
+            "error": error,
+            "content": None
+        }
+    
+    @staticmethod
+    def _extract_usage(usage) -> Dict[str, int]:
+        """
+        提取 token 使用量（包含 DeepSeek 的上下文缓存命中/未命中 token 数）
+        
+        Args:
+            usage: 响应中的 usage 对象
+            
+        Returns:
+            Dict 包含各项 token 数
+        """
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        cache_hit = getattr(usage, "prompt_cache_hit_tokens", None)
+        if cache_hit is None:
+            # OpenAI 兼容格式：usage.prompt_tokens_details.cached_tokens
+            details = getattr(usage, "prompt_tokens_details", None)
+            cache_hit = getattr(details, "cached_tokens", 0) or 0
+        cache_miss = getattr(usage, "prompt_cache_miss_tokens", None)
+        if cache_miss is None:
+            cache_miss = max(0, prompt_tokens - cache_hit)
+        
+        # deepseek-reasoner 的思维链 token（已计入 completion_tokens）
+        completion_details = getattr(usage, "completion_tokens_details", None)
+        reasoning_tokens = getattr(completion_details, "reasoning_tokens", 0) or 0
+        
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "total_tokens": getattr(usage, "total_tokens", 0) or 0,
+            "prompt_cache_hit_tokens": cache_hit,
+            "prompt_cache_miss_tokens": cache_miss,
+            "image_tokens": 0,
+            "reasoning_tokens": reasoning_tokens
+        }
+
+
+def _merge_usage(total: Dict[str, int], usage: Dict[str, int]) -> Dict[str, int]:
+    """累加多段请求的 token 用量"""
+    merged = dict(total)
+    for key, value in (usage or {}).items():
+        merged[key] = merged.get(key, 0) + (value or 0)
+    return merged
+
+
+def _strip_overlap(previous: str, addition: str) -> str:
+    """去掉续写内容开头与已输出内容结尾重复的部分"""
+    for size in range(min(len(previous), len(addition), OVERLAP_WINDOW), MIN_OVERLAP - 1, -1):
+        if previous.endswith(addition[:size]):
+            return addition[size:]
+    return addition
 
 
 def get_deepseek_response(message: str, api_key: str, **kwargs) -> Dict[str, Any]:
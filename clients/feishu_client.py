@@ -10,6 +10,13 @@ import logging
 from typing import Dict, Any, Optional, List, Union
 from datetime import datetime
 import uuid
+import hashlib
+
+from utils.retry import RetryPolicy, RetryableError, parse_retry_after
+from utils.archive_ledger import ArchiveLedger
+from utils.recorder import ProviderRecorder
+from utils.transport import ClientTransport
+from utils.shared_cache import SharedCache
 
 # 配置日志
 logger = logging.getLogger(__name__)
@@ -19,28 +26,70 @@ class FeishuClient:
     """飞书多维表格 API 客户端"""
     
     # 飞书API端点
+    BASE_URL = "https://open.feishu.cn"
     TOKEN_URL = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal"
     BITABLE_URL = "https://open.feishu.cn/open-apis/bitable/v1/apps/{app_token}/tables/{table_id}/records"
     
-    def __init__(self, app_id: str, app_secret: str, app_token: str):
+    # 飞书错误码：令牌失效（需刷新后重试）与请求频率限制（退避后重试）
+    TOKEN_INVALID_CODES = frozenset({99991661, 99991663, 99991668})
+    RATE_LIMIT_CODES = frozenset({99991400})
+    
+    # 生成确定性记录键 / client_token 的命名空间
+    RECORD_NAMESPACE = uuid.UUID("6f1c2a0e-3b7d-5e42-9a8c-1d4f0b6e2c91")
+    
+    def __init__(self, app_id: str, app_secret: str, app_token: str,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 ledger: Optional[ArchiveLedger] = None,
+                 recorder: Optional[ProviderRecorder] = None,
+                 transport: Optional[ClientTransport] = None,
+                 base_url: Optional[str] = None,
+                 token_cache: Optional[SharedCache] = None):
         """
         初始化飞书客户端
+        
+        transport 为传输层（代理与连接池，多个客户端共享同一个 Session）；
+        只传入 recorder（录制/回放控制器）时使用直连的传输层；
+        base_url 为开放平台地址（默认 https://open.feishu.cn，可指向本地桩服务）；
+        token_cache 为跨进程共享缓存，多个工作进程共用同一个访问令牌
         """
         self.app_id = app_id
         self.app_secret = app_secret
         self.app_token = app_token
         
+        self.base_url = (base_url or self.BASE_URL).rstrip("/")
+        if self.base_url != self.BASE_URL:
+            self.TOKEN_URL = self.TOKEN_URL.replace(self.BASE_URL, self.base_url, 1)
+            self.BITABLE_URL = self.BITABLE_URL.replace(self.BASE_URL, self.base_url, 1)
+        
+        # 已归档记录台账（重复保存直接跳过）
+        self.ledger = ledger if ledger is not None else ArchiveLedger()
+        
+        # 复用连接的请求 Session
+        if transport is None and recorder is not None and recorder.enabled:
+            transport = ClientTransport(recorder=recorder)
+        self.transport = transport
+        self.session = transport.requests_session() if transport is not None else requests.Session()
+        
         # Token缓存
         self._access_token = None
         self._token_expiry = 0  # Token过期时间戳
+        self.token_cache = token_cache
+        # 共享缓存键包含应用凭证的摘要，凭证错误时不会命中其他用户获取的令牌
+        credential = hashlib.sha256(f"{app_id}:{app_secret}".encode("utf-8")).hexdigest()[:16]
+        self._token_cache_key = f"feishu_token:{self.base_url}:{credential}"
         
         # 重试配置
         self.max_retries = 3
         self.retry_delay = 1  # 秒
+        self.retry_policy = retry_policy or RetryPolicy(
+            max_attempts=self.max_retries,
+            base_delay=self.retry_delay,
+            name="feishu"
+        )
         
         logger.info("飞书客户端初始化完成")
     
-    def _get_tenant_access_token(self, force_refresh: bool = False) -> Optional[str]:
+    def _get_tenant_access_token(self, force_refresh: bool = False, timeout: float = 10) -> Optional[str]:
         """
         获取租户访问令牌（带缓存机制，有效期2小时）
         """
@@ -52,6 +101,15 @@ class FeishuClient:
             logger.debug("使用缓存的访问令牌")
             return self._access_token
         
+        # 其他工作进程获取的令牌（强制刷新时跳过，说明缓存的令牌已失效）
+        if self.token_cache is not None and not force_refresh:
+            cached = self.token_cache.get_json(self._token_cache_key)
+            if cached and current_time < cached.get("expiry", 0) - 300:
+                logger.debug("使用共享缓存的访问令牌")
+                self._access_token = cached["token"]
+                self._token_expiry = cached["expiry"]
+                return self._access_token
+        
         logger.info("获取新的访问令牌")
         
         # 请求获取令牌
@@ -65,19 +123,25 @@ class FeishuClient:
         }
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 self.TOKEN_URL,
                 headers=headers,
                 json=payload,
-                timeout=10
+                timeout=timeout
             )
             
             if response.status_code == 200:
                 data = response.json()
                 if data.get("code") == 0:
                     self._access_token = data.get("tenant_access_token")
-                    # 设置过期时间（2小时 = 7200秒）
-                    self._token_expiry = current_time + 7200
+                    # 设置过期时间（默认2小时 = 7200秒）
+                    self._token_expiry = current_time + data.get("expire", 7200)
+                    if self.token_cache is not None:
+                        self.token_cache.set_json(
+                            self._token_cache_key,
+                            {"token": self._access_token, "expiry": self._token_expiry},
+                            ttl=self._token_expiry - 300 - current_time
+                        )
                     logger.info("访问令牌获取成功")
                     return self._access_token
                 else:
@@ -95,53 +159,91 @@ class FeishuClient:
         """
         带重试机制的HTTP请求
         """
-        for attempt in range(self.max_retries):
+        start = time.monotonic()
+        
+        def attempt() -> Optional[Dict[str, Any]]:
+            # 确保有有效的访问令牌
+            token = self._get_tenant_access_token()
+            if not token:
+                logger.error("无法获取有效的访问令牌")
+                return None
+            
+            # 添加认证头
+            headers = dict(kwargs.get('headers') or {})
+            headers['Authorization'] = f'Bearer {token}'
+            request_kwargs = dict(kwargs, headers=headers)
+            
+            # 单次请求超时不超过剩余的总时长预算
+            remaining = self.retry_policy.remaining(start)
+            if remaining is not None and 'timeout' in request_kwargs:
+                request_kwargs['timeout'] = max(1.0, min(request_kwargs['timeout'], remaining))
+            
+            # 发送请求（网络错误由重试策略分类处理）
+            response = self.session.request(method, url, **request_kwargs)
+            retry_after = parse_retry_after(
+                response.headers.get("Retry-After") or response.headers.get("x-ogw-ratelimit-reset")
+            )
+            
             try:
-                # 确保有有效的访问令牌
-                token = self._get_tenant_access_token()
-                if not token:
-                    logger.error("无法获取有效的访问令牌")
-                    return None
-                
-                # 添加认证头
-                headers = kwargs.get('headers', {})
-                headers['Authorization'] = f'Bearer {token}'
-                kwargs['headers'] = headers
-                
-                # 发送请求
-                response = requests.request(method, url, **kwargs)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    if data.get("code") == 0:
-                        return data
-                    else:
-                        logger.warning(f"API返回错误: {data.get('msg')}")
-                        # 如果是令牌过期，强制刷新并重试
-                        if data.get("code") == 99991663 and attempt < self.max_retries - 1:
-                            logger.info("令牌过期，强制刷新并重试")
-                            self._get_tenant_access_token(force_refresh=True)
-                            time.sleep(self.retry_delay * (attempt + 1))
-                            continue
-                        return None
-                else:
-                    logger.warning(f"HTTP错误 {response.status_code}: {response.text}")
-                    if attempt < self.max_retries - 1:
-                        time.sleep(self.retry_delay * (attempt + 1))
-                        continue
-                    return None
-                    
-            except requests.exceptions.RequestException as e:
-                logger.warning(f"请求失败 (尝试 {attempt + 1}/{self.max_retries}): {e}")
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay * (attempt + 1))
-                    continue
+                data = response.json()
+            except ValueError:
+                data = {}
+            code = data.get("code")
+            
+            if response.status_code == 200 and code == 0:
+                return data
+            
+            if code in self.TOKEN_INVALID_CODES:
+                # 令牌失效，强制刷新后重试
+                logger.info("令牌过期，强制刷新并重试")
+                self._get_tenant_access_token(force_refresh=True)
+                raise RetryableError(f"访问令牌失效: {data.get('msg')}")
+            
+            if code in self.RATE_LIMIT_CODES:
+                raise RetryableError(f"请求频率超限: {data.get('msg')}", retry_after)
+            
+            if response.status_code != 200:
+                if self.retry_policy.is_retryable_status(response.status_code):
+                    raise RetryableError(f"HTTP错误 {response.status_code}: {response.text}", retry_after)
+                logger.warning(f"HTTP错误 {response.status_code}: {response.text}")
                 return None
+            
+            logger.warning(f"API返回错误: {data.get('msg')}")
+            return None
         
-        logger.error(f"所有 {self.max_retries} 次重试均失败")
-        return None
+        try:
+            return self.retry_policy.call(attempt)
+        except (RetryableError, requests.exceptions.RequestException) as e:
+            logger.error(f"请求失败，已停止重试: {e}")
+            return None
+    
+    def _record_key(self, table_id: str, field_data: Dict[str, Any]) -> str:
+        """
+        生成记录在台账中的键（表格 + sectionID + 角色）
+        """
+        return f"{self.app_token}/{table_id}/{field_data.get('sectionID')}/{field_data.get('role')}"
+    
+    def _client_token(self, record_keys: List[str]) -> str:
+        """
+        根据记录键生成确定性的 client_token，保证同一批记录的重试是幂等的
+        """
+        return str(uuid.uuid5(self.RECORD_NAMESPACE, "\n".join(record_keys)))
+    
+    def client_token_for(self, table_id: str, fields_list: List[Dict[str, Any]]) -> str:
+        """
+        获取一组记录的幂等写入令牌
+        """
+        return self._client_token([self._record_key(table_id, field_data) for field_data in fields_list])
+    
+    def is_archived(self, table_id: str, fields_list: List[Dict[str, Any]]) -> bool:
+        """
+        判断一组记录是否已全部归档
+        """
+        keys = [self._record_key(table_id, field_data) for field_data in fields_list]
+        return not self.ledger.missing(keys)
     
-    def add_record_to_bitable(self, table_id: str, fields: Union[Dict[str, Any], List[Dict[str, Any]]]) -> Dict[str, Any]:
+    def add_record_to_bitable(self, table_id: str, fields: Union[Dict[str, Any], List[Dict[str, Any]]],
+                              client_token: Optional[str] = None) -> Dict[str, Any]:
         """
         添加记录到飞书多维表格
         """
@@ -164,6 +266,24 @@ class FeishuClient:
                         "record_ids": []
                     }
         
+        # 跳过台账中已归档的记录，全部已归档时直接返回
+        keyed_fields = [(self._record_key(table_id, field_data), field_data) for field_data in fields_list]
+        pending = [(key, field_data) for key, field_data in keyed_fields if key not in self.ledger]
+        
+        if not pending:
+            logger.info(f"{len(fields_list)} 条记录均已归档，跳过写入")
+            return {
+                "success": True,
+                "error": None,
+                "record_ids": [self.ledger.get(key) for key, _ in keyed_fields if self.ledger.get(key)],
+                "deduplicated": True
+            }
+        
+        fields_list = [field_data for _, field_data in pending]
+        pending_keys = [key for key, _ in pending]
+        if client_token is None:
+            client_token = self._client_token(pending_keys)
+        
         # 构建URL
         url = self.BITABLE_URL.format(
             app_token=self.app_token,
@@ -185,6 +305,7 @@ class FeishuClient:
             method="POST",
             url=url + "/batch_create",  # 使用批量创建接口
             headers={"Content-Type": "application/json; charset=utf-8"},
+            params={"client_token": client_token},  # 幂等写入，超时重试不会产生重复行
             json=payload,
             timeout=30
         )
@@ -194,10 +315,12 @@ class FeishuClient:
             record_ids = [record.get("record_id") for record in records if record.get("record_id")]
             
             if record_ids:
+                self.ledger.mark(pending_keys, record_ids)
                 return {
                     "success": True,
                     "error": None,
-                    "record_ids": record_ids
+                    "record_ids": record_ids,
+                    "deduplicated": False
                 }
             else:
                 return {
@@ -212,13 +335,68 @@ class FeishuClient:
                 "record_ids": []
             }
     
+    def list_records(self, table_id: str, page_size: int = 500, max_records: Optional[int] = None) -> Dict[str, Any]:
+        """
+        分页读取飞书多维表格中的全部记录
+        """
+        url = self.BITABLE_URL.format(
+            app_token=self.app_token,
+            table_id=table_id
+        )
+
+        records = []
+        page_token = None
+
+        while True:
+            params = {"page_size": page_size}
+            if page_token:
+                params["page_token"] = page_token
+
+            response_data = self._make_request_with_retry(
+                method="GET",
+                url=url,
+                headers={"Content-Type": "application/json; charset=utf-8"},
+                params=params,
+                timeout=30
+            )
+
+            if not response_data:
+                return {
+                    "success": False,
+                    "error": "读取记录失败，请检查网络连接和权限",
+                    "records": records
+                }
+
+            data = response_data.get("data", {})
+            records.extend(data.get("items") or [])
+
+            if max_records is not None and len(records) >= max_records:
+                records = records[:max_records]
+                break
+
+            page_token = data.get("page_token")
+            if not data.get("has_more") or not page_token:
+                break
+
+        logger.info(f"从表格 {table_id} 读取 {len(records)} 条记录")
+
+        return {
+            "success": True,
+            "error": None,
+            "records": records
+        }
+
     def format_chat_record(self, user_question: str, ai_answer: str,
-                          model_used: str = "unknown") -> List[Dict[str, Any]]:
+                          model_used: str = "unknown",
+                          session_id: Optional[str] = None) -> List[Dict[str, Any]]:
         """
         格式化聊天记录为飞书多维表格字段
         """
-        # 生成唯一的会话ID（两条记录共享）
-        session_id = str(uuid.uuid4())
+        # 由会话 + 内容哈希生成确定性的 sectionID（两条记录共享），重复保存得到相同的键
+        content_hash = hashlib.sha256(
+            "\x1f".join([session_id or "", user_question, ai_answer, model_used]).encode("utf-8")
+        ).hexdigest()
+        section_id = str(uuid.uuid5(self.RECORD_NAMESPACE, content_hash))
         
         # === 关键修正 ===
         # 使用 13位 毫秒级时间戳 (Integer) 替代字符串，解决 DatetimeFieldConvFail 问题
@@ -226,7 +404,7 @@ class FeishuClient:
         
         # 用户消息记录
         user_record = {
-            "sectionID": session_id,
+            "sectionID": section_id,
             "时间": current_time,
             "role": "user",
             "user_question": user_question,
@@ -236,7 +414,7 @@ class FeishuClient:
         
         # AI消息记录
         ai_record = {
-            "sectionID": session_id,
+            "sectionID": section_id,
             "时间": current_time,
             "role": "assistant",
             "user_question": "",  # AI消息时用户问题留空
@@ -246,6 +424,48 @@ class FeishuClient:
         
         return [user_record, ai_record]
     
+    def warm_up(self) -> Dict[str, Any]:
+        """
+        预热：预先获取租户访问令牌（同时建立到 open.feishu.cn 的连接）
+        
+        Returns:
+            Dict 包含 success、steps（各步骤耗时，毫秒）和 error
+        """
+        start = time.perf_counter()
+        token = self._get_tenant_access_token()
+        steps = {"token": (time.perf_counter() - start) * 1000}
+        if not token:
+            return {"success": False, "steps": steps, "error": "无法获取访问令牌"}
+        return {"success": True, "steps": steps, "error": None}
+    
+    def health_check(self, timeout: float = 5.0) -> Dict[str, Any]:
+        """
+        健康检查：以较短的超时读取应用信息（不重试），用于侧边栏服务状态
+        
+        Returns:
+            Dict 包含 success、latency_ms 和 error
+        """
+        start = time.perf_counter()
+        
+        def result(error=None):
+            return {"success": error is None, "latency_ms": (time.perf_counter() - start) * 1000, "error": error}
+        
+        token = self._get_tenant_access_token(timeout=timeout)
+        if not token:
+            return result("无法获取访问令牌，请检查App ID和App Secret")
+        try:
+            response = self.session.get(
+                f"{self.base_url}/open-apis/bitable/v1/apps/{self.app_token}",
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=timeout
+            )
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return result(f"网络错误: {e}")
+        if response.status_code != 200 or data.get("code") != 0:
+            return result(f"HTTP {response.status_code}: {data.get('msg') or data.get('code')}")
+        return result()
+    
     def test_connection(self) -> Dict[str, Any]:
         """
         测试飞书API连接
@@ -262,7 +482,7 @@ class FeishuClient:
             }
         
         # 测试简单的API调用（获取应用信息）
-        test_url = f"https://open.feishu.cn/open-apis/bitable/v1/apps/{self.app_token}"
+        test_url = f"{self.base_url}/open-apis/bitable/v1/apps/{self.app_token}"
         
         response_data = self._make_request_with_retry(
             method="GET",
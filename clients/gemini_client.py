@@ -1,60 +1,350 @@
-from google import genai
-from PIL import Image
 import io
+import itertools
+import logging
+import time
+
+from google import genai
+from google.genai import types
+
+from utils.retry import RetryPolicy
+from utils.prompt_cache import GeminiCacheManager, PrefixMessageBuilder
+from utils.cancellation import partial_usage, closing_responses, response_hook
+from utils.tokens import estimate_tokens
+from utils.images import as_image_list, prepare_images
+from utils.transport import ClientTransport
+
+# 配置日志
+logger = logging.getLogger(__name__)
 
 class GeminiClient:
-    def __init__(self, api_key, model_name="gemini-2.0-flash"):
+    def __init__(self, api_key, model_name="gemini-2.0-flash", retry_policy=None, recorder=None, transport=None,
+                 base_url=None, cache_manager=None):
+        # 重试策略：429 / 5xx / 网络错误时退避重试
+        self.retry_policy = retry_policy or RetryPolicy(name="gemini", total_timeout=120.0)
+        self.api_key = api_key
+        # 传输层（ClientTransport，代理与连接池）；只传入录制/回放控制器时使用直连的传输层
+        if transport is None and recorder is not None and recorder.enabled:
+            transport = ClientTransport(recorder=recorder)
+        self.transport = transport
+        # 历史消息与 DeepSeek 使用相同的截断窗口
+        self.message_builder = PrefixMessageBuilder()
+
         # === 使用 Google 最新版 SDK (google-genai) ===
         try:
-            self.client = genai.Client(api_key=api_key)
+            # base_url 可指向代理网关或本地桩服务
+            http_options = None
+            if transport is not None or base_url:
+                httpx_client = transport.httpx_client() if transport is not None else None
+                if httpx_client is not None and response_hook not in httpx_client.event_hooks["response"]:
+                    # SDK 不暴露流式响应，取消时通过钩子关闭底层响应（见 stream_response）
+                    httpx_client.event_hooks["response"].append(response_hook)
+                http_options = types.HttpOptions(base_url=base_url, httpx_client=httpx_client)
+            self.client = genai.Client(api_key=api_key, http_options=http_options)
             
-            # 强制修正：如果用户传的是旧的 1.5，我们强制改成 2.0，因为你的账号只支持 2.0
-            if "1.5" in model_name:
-                print(f"WARNING: 检测到旧模型 {model_name}，自动升级为 gemini-2.0-flash")
-                self.model_name = "gemini-2.0-flash"
-            else:
-                self.model_name = model_name.replace("models/", "")
+            self.model_name = self.normalize_model(model_name)
+            if self.model_name != model_name:
+                logger.warning(f"检测到旧模型 {model_name}，自动升级为 {self.model_name}")
             
-            print(f"DEBUG: 客户端启动成功 - 当前使用模型: {self.model_name}")
+            # 长系统提示词使用显式上下文缓存（可传入按 API Key 共享的管理器，各会话复用同一份服务端缓存）
+            self.cache_manager = cache_manager or GeminiCacheManager()
+            
+            logger.info(f"Gemini 客户端初始化成功，当前模型: {self.model_name}")
             
         except Exception as e:
-            print(f"ERROR: 客户端初始化失败: {e}")
+            logger.error(f"Gemini 客户端初始化失败: {e}")
 
-    def get_response(self, message, image_input=None, image_data=None, **kwargs):
+    def get_response(self, message, image_input=None, image_data=None, system_prompt=None,
+                     model=None, context=None, history=None, **kwargs):
         """
         使用新版 google-genai SDK 发送请求
+        
+        system_prompt 较长时会创建/复用显式上下文缓存，只在请求中引用缓存名称。
+        model 可临时指定本次请求使用的模型（由路由策略选择），context 会拼接在消息前。
+        image_input 可以是单张图片或图片列表，多张图片会并行预处理后放入同一个请求。
+        history 为之前的对话（role 为 user / assistant），按 DeepSeek 相同的窗口截断后放在本轮消息之前。
         """
         # 兼容参数
-        img_bytes = image_input if image_input is not None else image_data
+        images = as_image_list(image_input if image_input is not None else image_data)
+        model_name = self.normalize_model(model) if model else self.model_name
         
         try:
-            contents = [message]
+            if images:
+                logger.debug(f"正在处理 {len(images)} 张图片...")
+            contents = self._build_contents(message, context, images, history)
 
-            if img_bytes:
-                print("DEBUG: 正在处理图片...")
-                image = Image.open(io.BytesIO(img_bytes))
-                contents.append(image)
+            config = self._build_config(system_prompt, model_name)
 
-            print(f"DEBUG: 正在发送请求给 {self.model_name}...")
+            logger.debug(f"正在发送请求给 {model_name}...")
 
             # === 发送请求 ===
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                contents=contents
-            )
+            try:
+                response = self._generate(contents, config, model_name)
+            except Exception as e:
+                if not (config and config.cached_content):
+                    raise
+                # 缓存可能已在服务端过期，丢弃后直接携带系统提示词重试一次
+                logger.warning(f"上下文缓存不可用，改为直接发送系统提示词: {e}")
+                self.cache_manager.invalidate(config.cached_content)
+                response = self._generate(
+                    contents, types.GenerateContentConfig(system_instruction=system_prompt), model_name
+                )
             
             return {
                 "success": True,
                 "content": response.text,
-                "model": self.model_name
+                "model": model_name,
+                "usage": self._extract_usage(response)
             }
 
         except Exception as e:
             err_msg = str(e)
-            print(f"ERROR: API 调用出错: {err_msg}")
+            logger.error(f"Gemini API 调用出错: {err_msg}")
             
             if "404" in err_msg:
-                return {"success": False, "error": f"模型 {self.model_name} 不存在，请尝试在代码中将 model_name 改为 'gemini-flash-latest'"}
+                return {"success": False, "error": f"模型 {model_name} 不存在，请尝试在代码中将 model_name 改为 'gemini-flash-latest'"}
             
             return {"success": False, "error": f"Gemini 报错: {err_msg}"}
 
+
+
+    def stream_response(self, message, image_input=None, image_data=None, system_prompt=None,
+                        model=None, context=None, history=None, cancel_token=None, **kwargs):
+        """
+        流式发送请求，事件格式与 DeepSeekClient.stream_response 一致
+
+        cancel_token 被取消时停止读取并关闭上游流，产出 cancelled 事件（含部分内容和估算用量）。
+        """
+        images = as_image_list(image_input if image_input is not None else image_data)
+        model_name = self.normalize_model(model) if model else self.model_name
+        
+        try:
+            contents = self._build_contents(message, context, images, history)
+            config = self._build_config(system_prompt, model_name)
+            
+            parts = []
+            usage = {}
+            finish_reason = None
+            stream = None
+            # 取消时从其他线程关闭底层 httpx 响应（而不是生成器本身：生成器正在读取时无法关闭），
+            # 阻塞中的读取会立即返回；未使用共享传输层时在收到下一个分片后停止
+            try:
+                with closing_responses(cancel_token):
+                    try:
+                        stream, first = self._open_stream(contents, config, model_name)
+                    except Exception as e:
+                        if not (config and config.cached_content) or (cancel_token and cancel_token.cancelled):
+                            raise
+                        # 缓存可能已在服务端过期，丢弃后直接携带系统提示词重试一次（与 get_response 相同）
+                        logger.warning(f"上下文缓存不可用，改为直接发送系统提示词: {e}")
+                        self.cache_manager.invalidate(config.cached_content)
+                        config = types.GenerateContentConfig(system_instruction=system_prompt)
+                        stream, first = self._open_stream(contents, config, model_name)
+                    for chunk in itertools.chain([first] if first is not None else [], stream):
+                        if cancel_token and cancel_token.cancelled:
+                            break
+                        if getattr(chunk, "usage_metadata", None):
+                            usage = self._extract_usage(chunk)
+                        if chunk.candidates and chunk.candidates[0].finish_reason:
+                            finish_reason = str(chunk.candidates[0].finish_reason)
+                        text = chunk.text
+                        if text:
+                            parts.append(text)
+                            yield {"type": "delta", "content": text}
+            except Exception:
+                # 取消时关闭上游流会使读取中断，不视为错误
+                if not (cancel_token and cancel_token.cancelled):
+                    raise
+            finally:
+                close = getattr(stream, "close", None)
+                if close:
+                    close()
+            
+            if cancel_token and cancel_token.cancelled:
+                content = "".join(parts)
+                yield {
+                    "type": "cancelled",
+                    "content": content,
+                    "model": model_name,
+                    "usage": usage or partial_usage(
+                        sum(estimate_tokens(part.text or "") for item in contents for part in item.parts)
+                        + estimate_tokens(system_prompt or ""),
+                        content
+                    )
+                }
+                return
+            
+            yield {
+                "type": "done",
+                "content": "".join(parts),
+                "model": model_name,
+                "usage": usage,
+                "finish_reason": finish_reason
+            }
+        
+        except Exception as e:
+            logger.error(f"Gemini API 流式调用出错: {e}")
+            yield {"type": "error", "error": f"Gemini 报错: {e}"}
+
+    def warm_up(self, probe=False):
+        """
+        预热：读取模型信息以建立连接（连接留在连接池中），可选发送一次极小的生成请求
+
+        probe=True 时额外发送一次 max_output_tokens=1 的请求（会产生少量费用）。
+        返回 success、steps（各步骤耗时，毫秒）和 error。
+        """
+        steps = {}
+        try:
+            start = time.perf_counter()
+            self.client.models.get(model=self.model_name)
+            steps["connect"] = (time.perf_counter() - start) * 1000
+            if probe:
+                start = time.perf_counter()
+                self.client.models.generate_content(
+                    model=self.model_name,
+                    contents="ping",
+                    config=types.GenerateContentConfig(max_output_tokens=1)
+                )
+                steps["probe"] = (time.perf_counter() - start) * 1000
+            return {"success": True, "steps": steps, "error": None}
+        except Exception as e:
+            logger.warning(f"Gemini 预热失败: {e}")
+            return {"success": False, "steps": steps, "error": str(e)}
+
+    def health_check(self, timeout=5.0):
+        """
+        健康检查：以较短的超时读取模型信息（不重试），用于侧边栏服务状态
+
+        返回 success、latency_ms 和 error。
+        """
+        start = time.perf_counter()
+        try:
+            self.client.models.get(
+                model=self.model_name,
+                config=types.GetModelConfig(http_options=types.HttpOptions(timeout=int(timeout * 1000)))
+            )
+            return {"success": True, "latency_ms": (time.perf_counter() - start) * 1000, "error": None}
+        except Exception as e:
+            return {"success": False, "latency_ms": (time.perf_counter() - start) * 1000, "error": str(e)}
+
+    def _open_stream(self, contents, config, model_name):
+        """
+        按重试策略发起流式请求，返回 (剩余分片的迭代器, 第一个分片)
+
+        SDK 的 generate_content_stream 是生成器函数，HTTP 请求在读取第一个分片时才发出，
+        因此在重试范围内读取第一个分片；开始输出后不再重试。没有任何分片时第一个分片为 None。
+        """
+        def open_once():
+            stream = iter(self.client.models.generate_content_stream(
+                model=model_name,
+                contents=contents,
+                config=config
+            ))
+            return stream, next(stream, None)
+        return self.retry_policy.call(open_once)
+
+    def _generate(self, contents, config, model_name):
+        """
+        按重试策略调用 generate_content
+        """
+        return self.retry_policy.call(
+            lambda: self.client.models.generate_content(
+                model=model_name,
+                contents=contents,
+                config=config
+            )
+        )
+
+    @staticmethod
+    def normalize_model(model_name):
+        """
+        规范化模型名称（实际发送请求使用的名称，路由策略按该名称查询价格和延迟）
+        """
+        # 强制修正：如果用户传的是旧的 1.5，我们强制改成 2.0，因为你的账号只支持 2.0
+        if "1.5" in model_name:
+            return "gemini-2.0-flash"
+        return model_name.replace("models/", "")
+
+    def upload_image(self, data, mime_type):
+        """
+        上传图片到 Files API（供 ImagePrefetcher 在选择图片后预上传），返回文件 URI
+        """
+        uploaded = self.retry_policy.call(
+            lambda: self.client.files.upload(
+                file=io.BytesIO(data),
+                config=types.UploadFileConfig(mime_type=mime_type)
+            )
+        )
+        return uploaded.uri
+
+    @staticmethod
+    def _image_parts(images):
+        """
+        将图片转换为 Part：已预上传的图片只发送文件引用，其余并行预处理为内联数据（总大小自动压缩到上限以内）
+        """
+        parts = [None] * len(images)
+        inline = []
+        for i, image in enumerate(images):
+            if isinstance(image, dict) and image.get("file_uri"):
+                parts[i] = types.Part.from_uri(file_uri=image["file_uri"], mime_type=image["mime_type"])
+            else:
+                inline.append(i)
+        # 已预处理的图片在这里直接复用原数据，只做总大小检查
+        for i, item in zip(inline, prepare_images([images[i] for i in inline])):
+            parts[i] = types.Part.from_bytes(data=item["data"], mime_type=item["mime_type"])
+        return parts
+
+    def _build_contents(self, message, context, images, history):
+        """
+        构建 contents：历史消息（assistant 对应 Gemini 的 model 角色）+ 本轮消息（附加上下文拼接在前）和图片
+        """
+        messages = self.message_builder.build(message, history=history, context=context)
+        contents = [
+            types.Content(
+                role="model" if item["role"] == "assistant" else "user",
+                parts=[types.Part.from_text(text=item["content"])]
+            )
+            for item in messages
+        ]
+        if images:
+            contents[-1].parts.extend(self._image_parts(images))
+        return contents
+
+    def _build_config(self, system_prompt, model_name):
+        """
+        构建请求配置：命中上下文缓存时引用缓存，否则直接携带系统提示词
+        """
+        if not system_prompt:
+            return None
+        
+        cached_content = self.cache_manager.get_cached_content(model_name, system_prompt, client=self.client)
+        if cached_content:
+            return types.GenerateContentConfig(cached_content=cached_content)
+        return types.GenerateContentConfig(system_instruction=system_prompt)
+
+    @staticmethod
+    def _extract_usage(response):
+        """
+        从 usage_metadata 提取 token 使用量，字段与 DeepSeekClient 一致
+        （包含上下文缓存命中、图片输入和思考过程的 token 数；思考 token 按输出计费，计入 completion_tokens）
+        """
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return {}
+        
+        prompt_tokens = usage.prompt_token_count or 0
+        cached_tokens = usage.cached_content_token_count or 0
+        reasoning_tokens = getattr(usage, "thoughts_token_count", None) or 0
+        image_tokens = sum(
+            detail.token_count or 0
+            for detail in (getattr(usage, "prompt_tokens_details", None) or [])
+            if "IMAGE" in str(detail.modality)
+        )
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": (usage.candidates_token_count or 0) + reasoning_tokens,
+            "total_tokens": usage.total_token_count or 0,
+            "prompt_cache_hit_tokens": cached_tokens,
+            "prompt_cache_miss_tokens": max(0, prompt_tokens - cached_tokens),
+            "image_tokens": image_tokens,
+            "reasoning_tokens": reasoning_tokens
+        }
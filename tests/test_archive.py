@@ -0,0 +1,79 @@
+"""飞书归档幂等写入测试"""
+
+from clients.feishu_client import FeishuClient
+from utils.archive_ledger import ArchiveLedger
+
+
+def make_fields(section_id, role):
+    return {"sectionID": section_id, "时间": 0, "role": role,
+            "user_question": "问题", "AI_answer": "回答", "tags": "测试"}
+
+
+def make_client(ledger=None):
+    client = FeishuClient("app-id", "secret", "app-token", ledger=ledger)
+    client.requests = []
+
+    def fake_request(method, url, **kwargs):
+        client.requests.append(kwargs["params"]["client_token"])
+        count = len(kwargs["json"]["records"])
+        return {"data": {"records": [{"record_id": f"rec{len(client.requests)}-{i}"} for i in range(count)]}}
+
+    client._make_request_with_retry = fake_request
+    return client
+
+
+def test_ledger_persists_and_skips_corrupt_lines(tmp_path):
+    path = str(tmp_path / "ledger.jsonl")
+    ledger = ArchiveLedger(path)
+    ledger.mark(["a", "b"], ["rec-a"])
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("not json\n")
+
+    reloaded = ArchiveLedger(path)
+
+    assert len(reloaded) == 2
+    assert reloaded.get("a") == "rec-a" and reloaded.get("b") is None
+    assert reloaded.missing(["a", "c"]) == ["c"]
+
+
+def test_client_token_is_deterministic_per_record_set():
+    client = make_client()
+    fields = [make_fields("s1", "user"), make_fields("s1", "assistant")]
+
+    assert client.client_token_for("t", fields) == client.client_token_for("t", fields)
+    assert client.client_token_for("t", fields) != client.client_token_for("t", fields[:1])
+
+
+def test_archived_records_are_not_written_twice():
+    client = make_client()
+    fields = [make_fields("s1", "user"), make_fields("s1", "assistant")]
+
+    first = client.add_record_to_bitable("t", fields)
+    second = client.add_record_to_bitable("t", fields)
+
+    assert first["success"] and not first["deduplicated"]
+    assert second["success"] and second["deduplicated"]
+    assert second["record_ids"] == first["record_ids"]
+    assert len(client.requests) == 1
+    assert client.is_archived("t", fields)
+
+
+def test_partially_archived_batch_only_sends_missing_records():
+    client = make_client()
+    client.add_record_to_bitable("t", [make_fields("s1", "user")])
+
+    result = client.add_record_to_bitable("t", [make_fields("s1", "user"), make_fields("s1", "assistant")])
+
+    assert len(result["record_ids"]) == 1
+    assert client.requests[1] == client.client_token_for("t", [make_fields("s1", "assistant")])
+
+
+def test_missing_required_field_is_rejected():
+    client = make_client()
+    fields = make_fields("s1", "user")
+    del fields["tags"]
+
+    result = client.add_record_to_bitable("t", fields)
+
+    assert not result["success"] and "tags" in result["error"]
+    assert client.requests == []
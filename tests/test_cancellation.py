@@ -0,0 +1,87 @@
+"""取消令牌测试"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from utils.cancellation import CancelToken, closing_responses, partial_usage, response_hook
+
+
+class SlowStreamHandler(BaseHTTPRequestHandler):
+    """先发送一个分块，然后长时间不再发送"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.wfile.write(b"5\r\nfirst\r\n")
+        self.wfile.flush()
+        time.sleep(5)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def slow_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowStreamHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+    server.server_close()
+
+
+def test_callbacks_run_once_on_cancel():
+    token = CancelToken()
+    calls = []
+    token.add_callback(lambda: calls.append("a"))
+    unregister = token.add_callback(lambda: calls.append("b"))
+    unregister()
+
+    token.cancel()
+    token.cancel()
+
+    assert calls == ["a"]
+    assert token.cancelled and token.wait(0)
+
+
+def test_callback_added_after_cancel_runs_immediately():
+    token = CancelToken()
+    token.cancel()
+    calls = []
+
+    token.add_callback(lambda: calls.append(1))
+
+    assert calls == [1]
+
+
+def test_cancel_interrupts_blocked_stream_read(slow_server):
+    token = CancelToken()
+    client = httpx.Client(event_hooks={"response": [response_hook]})
+    received = []
+
+    threading.Timer(0.2, token.cancel).start()
+    start = time.perf_counter()
+    with closing_responses(token):
+        with client.stream("GET", slow_server) as response:
+            with pytest.raises(Exception):
+                for chunk in response.iter_bytes():
+                    received.append(chunk)
+
+    assert b"".join(received) == b"first"
+    assert time.perf_counter() - start < 2
+    client.close()
+
+
+def test_partial_usage_is_marked_estimated():
+    usage = partial_usage(100, "部分回答")
+
+    assert usage["prompt_tokens"] == 100
+    assert usage["completion_tokens"] > 0
+    assert usage["estimated"] is True
@@ -0,0 +1,100 @@
+"""分块 map-reduce 文档摘要测试"""
+
+import io
+import threading
+import time
+
+from utils.documents import DocumentSummarizer, SummaryCache, chunk_text, iter_document_text
+from utils.governor import RequestGovernor
+from utils.tokens import estimate_tokens
+
+
+class FakeDeepSeek:
+    """记录并发数的摘要客户端，内容含 TRUNC 的分块返回被截断的摘要"""
+
+    api_key = "sk-test"
+
+    def __init__(self):
+        self.calls = 0
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def get_response(self, text, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.02)
+        with self._lock:
+            self.active -= 1
+        return {"success": True, "content": "摘要:" + text[:8],
+                "finish_reason": "length" if "TRUNC" in text else "stop",
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}}
+
+
+def make_document(paragraphs=6, truncated=None):
+    return "\n\n".join(
+        (("TRUNC 段落 " if i == truncated else f"段落 {i} ") * 300) for i in range(paragraphs)
+    ).encode("utf-8")
+
+
+def test_chunks_respect_token_budget_across_stream_pieces():
+    text = "\n\n".join(f"第 {i} 段内容。" * 40 for i in range(10))
+    pieces = [text[i:i + 97] for i in range(0, len(text), 97)]
+
+    chunks = list(chunk_text(pieces, max_tokens=200))
+
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= 200 for chunk in chunks)
+    assert "".join(chunks).replace("\n", "") == text.replace("\n", "")
+
+
+def test_unsupported_extension_is_rejected():
+    try:
+        list(iter_document_text(io.BytesIO(b"x"), "a.exe"))
+    except ValueError as e:
+        assert ".exe" in str(e)
+    else:
+        raise AssertionError("expected ValueError")
+
+
+def test_map_reduce_summary_is_cached_except_truncated_chunks():
+    client = FakeDeepSeek()
+    summarizer = DocumentSummarizer(client, chunk_tokens=300, cache=SummaryCache())
+
+    first = summarizer.summarize(io.BytesIO(make_document(truncated=2)), "doc.txt")
+    calls_after_first = client.calls
+    second = summarizer.summarize(io.BytesIO(make_document(truncated=2)), "doc.txt")
+
+    assert first["success"] and first["levels"] >= 1 and first["truncated"] >= 1
+    assert first["usage"]["total_tokens"] == 15 * calls_after_first
+    # 第二次只重新生成被截断的分块（以及受其影响的合并层）
+    assert second["cached"] > 0
+    assert client.calls - calls_after_first < calls_after_first
+
+
+def test_document_is_admitted_once_and_chunks_run_in_parallel():
+    client = FakeDeepSeek()
+    governor = RequestGovernor(per_session_concurrency=1)
+    summarizer = DocumentSummarizer(client, chunk_tokens=300, max_workers=4, cache=SummaryCache(),
+                                    governor=governor, session_id="s1")
+
+    result = summarizer.summarize(io.BytesIO(make_document()), "doc.txt")
+
+    assert result["success"]
+    assert client.peak > 1
+    status = governor.session_status("s1")
+    assert status["tokens_used"] == result["usage"]["total_tokens"]
+    assert status["active"] == 0 and status["tokens_reserved"] == 0
+
+
+def test_document_over_budget_is_rejected_before_any_call():
+    client = FakeDeepSeek()
+    governor = RequestGovernor(session_token_budget=100)
+    summarizer = DocumentSummarizer(client, chunk_tokens=300, governor=governor, session_id="s1")
+
+    result = summarizer.summarize(io.BytesIO(make_document()), "doc.txt")
+
+    assert not result["success"]
+    assert client.calls == 0
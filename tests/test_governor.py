@@ -0,0 +1,105 @@
+"""配额与并发控制测试"""
+
+import threading
+import time
+
+from utils.governor import RequestGovernor, key_fingerprint
+
+
+def test_key_fingerprint_hides_key():
+    assert key_fingerprint(None) == "anonymous"
+    fingerprint = key_fingerprint("sk-secret")
+    assert "secret" not in fingerprint and len(fingerprint) == 16
+
+
+def test_second_request_in_session_waits_for_release():
+    governor = RequestGovernor(per_session_concurrency=1)
+    first = governor.acquire("s1", "k")
+    result = {}
+
+    waiter = threading.Thread(target=lambda: result.update(governor.acquire("s1", "k", timeout=5)))
+    waiter.start()
+    time.sleep(0.1)
+    assert "success" not in result
+    governor.release(first["ticket"])
+    waiter.join(2)
+
+    assert result["success"]
+    assert governor.stats() == {"active": 1, "queue_length": 0}
+
+
+def test_queue_timeout_rejects():
+    governor = RequestGovernor(per_session_concurrency=1)
+    governor.acquire("s1", "k")
+
+    result = governor.acquire("s1", "k", timeout=0.05, poll_interval=0.01)
+
+    assert not result["success"] and result["reason"] == "queue_timeout"
+
+
+def test_concurrent_requests_cannot_overshoot_budget_with_reservations():
+    governor = RequestGovernor(per_session_concurrency=4, session_token_budget=1000)
+
+    first = governor.acquire("s1", "k", estimated_tokens=600)
+    second = governor.acquire("s1", "k", estimated_tokens=600)
+
+    assert first["success"]
+    assert not second["success"] and second["reason"] == "session_budget"
+    assert governor.session_status("s1")["tokens_reserved"] == 600
+
+
+def test_release_reconciles_reservation_with_actual_usage():
+    governor = RequestGovernor(session_token_budget=1000)
+
+    ticket = governor.acquire("s1", "k", estimated_tokens=900)["ticket"]
+    governor.release(ticket, tokens_used=300)
+    status = governor.session_status("s1")
+
+    assert status["tokens_used"] == 300 and status["tokens_reserved"] == 0
+    assert governor.acquire("s1", "k", estimated_tokens=700)["success"]
+
+
+def test_timed_out_request_returns_its_reservation():
+    governor = RequestGovernor(per_session_concurrency=1, session_token_budget=1000)
+    governor.acquire("s1", "k", estimated_tokens=100)
+
+    governor.acquire("s1", "k", estimated_tokens=500, timeout=0.05, poll_interval=0.01)
+
+    assert governor.session_status("s1")["tokens_reserved"] == 100
+
+
+def test_idle_sessions_are_evicted_after_window():
+    governor = RequestGovernor(window_seconds=0.05)
+    for i in range(10):
+        ticket = governor.acquire(f"s{i}", "k", estimated_tokens=10)["ticket"]
+        governor.release(ticket)
+    assert len(governor._session_usage) == 10
+
+    time.sleep(0.1)
+    governor.acquire("fresh", "k")
+
+    assert governor._session_usage == {}
+    assert governor._key_usage == {}
+
+
+def test_higher_priority_request_is_granted_first():
+    governor = RequestGovernor(per_key_concurrency=1)
+    holder = governor.acquire("s0", "k")
+    order = []
+
+    def request(session_id, priority):
+        result = governor.acquire(session_id, "k", priority=priority, timeout=5)
+        order.append(session_id)
+        governor.release(result["ticket"])
+
+    low = threading.Thread(target=request, args=("low", 0))
+    low.start()
+    time.sleep(0.05)
+    high = threading.Thread(target=request, args=("high", 5))
+    high.start()
+    time.sleep(0.05)
+    governor.release(holder["ticket"])
+    low.join(2)
+    high.join(2)
+
+    assert order == ["high", "low"]
@@ -0,0 +1,91 @@
+"""健康检查测试"""
+
+import threading
+import time
+
+from utils.health import HealthMonitor
+
+
+def _ok():
+    return {"success": True, "latency_ms": 12.0, "error": None}
+
+
+def _fail():
+    return {"success": False, "error": "401 Unauthorized"}
+
+
+def test_first_check_returns_checking_without_blocking():
+    gate = threading.Event()
+    monitor = HealthMonitor()
+
+    def slow_probe():
+        gate.wait(5)
+        return _ok()
+
+    result = monitor.check("deepseek", "k1", slow_probe)
+    assert result["status"] == "checking"
+    assert result["stale"] is False
+
+    gate.set()
+    assert monitor.wait(5)
+    result = monitor.check("deepseek", "k1", slow_probe)
+    assert result["status"] == "ok"
+    assert result["latency_ms"] == 12.0
+    assert result["stale"] is False
+
+
+def test_probe_exception_is_reported_as_error():
+    monitor = HealthMonitor()
+
+    def broken():
+        raise RuntimeError("connect timeout")
+
+    monitor.check("feishu", "k", broken)
+    monitor.wait(5)
+    result = monitor.check("feishu", "k", broken)
+    assert result["status"] == "error"
+    assert "connect timeout" in result["error"]
+
+
+def test_expired_result_is_returned_stale_while_refreshing():
+    monitor = HealthMonitor(ttl=0.0)
+    calls = []
+
+    def probe():
+        calls.append(1)
+        return _ok()
+
+    monitor.check("gemini", "k", probe)
+    monitor.wait(5)
+    time.sleep(0.01)
+    result = monitor.check("gemini", "k", probe)
+    assert result["status"] == "ok"
+    assert result["stale"] is True
+    monitor.wait(5)
+    assert len(calls) == 2
+
+
+def test_errors_expire_sooner_than_successes():
+    monitor = HealthMonitor(ttl=60.0, error_ttl=0.0)
+    monitor.check("ok", "a", _ok)
+    monitor.check("bad", "b", _fail)
+    monitor.wait(5)
+    time.sleep(0.01)
+
+    assert monitor.check("ok", "a", _ok)["stale"] is False
+    assert monitor.check("bad", "b", _fail)["stale"] is True
+
+
+def test_refresh_shares_inflight_probe():
+    gate = threading.Event()
+    monitor = HealthMonitor()
+
+    def probe():
+        gate.wait(5)
+        return _ok()
+
+    first = monitor.refresh("deepseek", "k", probe)
+    second = monitor.refresh("deepseek", "k", probe)
+    assert first is second
+    gate.set()
+    assert first.result(5)["status"] == "ok"
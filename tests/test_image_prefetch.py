@@ -0,0 +1,97 @@
+"""图片预取与预上传测试"""
+
+import io
+import threading
+
+from PIL import Image
+
+from utils.images import ImagePrefetcher
+
+
+def encode(size, color=(30, 120, 200)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_get_returns_none_for_unsubmitted_image():
+    assert ImagePrefetcher().get(encode((32, 32), (1, 2, 3))) is None
+
+
+def test_same_image_is_prepared_and_uploaded_once():
+    prefetcher = ImagePrefetcher(max_side=256)
+    uploads = []
+
+    def uploader(data, mime_type):
+        uploads.append((len(data), mime_type))
+        return f"files/{len(uploads)}"
+
+    image = encode((1200, 800), (10, 20, 30))
+    digest = prefetcher.submit(image, uploader=uploader, upload_key="key-a")
+    assert prefetcher.submit(image, uploader=uploader, upload_key="key-a") == digest
+
+    prepared = prefetcher.get(image, upload_key="key-a", timeout=5)
+    assert prepared["digest"] == digest
+    assert max(prepared["width"], prepared["height"]) <= 256
+    assert prepared["file_uri"] == "files/1"
+    assert len(uploads) == 1
+
+
+def test_uploads_are_scoped_by_upload_key():
+    prefetcher = ImagePrefetcher()
+    image = encode((64, 64), (40, 50, 60))
+    prefetcher.submit(image, uploader=lambda data, mime: "files/a", upload_key="key-a")
+
+    assert prefetcher.get(image, upload_key="key-a", timeout=5)["file_uri"] == "files/a"
+    assert "file_uri" not in prefetcher.get(image, upload_key="key-b", timeout=5)
+
+
+def test_failed_upload_falls_back_to_inline_and_is_retried():
+    prefetcher = ImagePrefetcher()
+    image = encode((64, 64), (70, 80, 90))
+    attempts = []
+
+    def flaky(data, mime_type):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionError("upload failed")
+        return "files/retry"
+
+    prefetcher.submit(image, uploader=flaky)
+    prepared = prefetcher.get(image, timeout=5)
+    assert prepared is not None and "file_uri" not in prepared
+
+    prefetcher.submit(image, uploader=flaky)
+    assert prefetcher.get(image, timeout=5)["file_uri"] == "files/retry"
+    assert len(attempts) == 2
+
+
+def test_expired_upload_is_sent_inline():
+    prefetcher = ImagePrefetcher(upload_ttl=0.0)
+    image = encode((64, 64), (100, 110, 120))
+    prefetcher.submit(image, uploader=lambda data, mime: "files/old")
+    assert "file_uri" not in prefetcher.get(image, timeout=5)
+
+
+def test_get_waits_for_inflight_upload():
+    prefetcher = ImagePrefetcher()
+    image = encode((64, 64), (130, 140, 150))
+    gate = threading.Event()
+
+    def slow(data, mime_type):
+        gate.wait(5)
+        return "files/slow"
+
+    prefetcher.submit(image, uploader=slow)
+    threading.Timer(0.05, gate.set).start()
+    assert prefetcher.get(image, timeout=5)["file_uri"] == "files/slow"
+
+
+def test_least_recently_used_entries_are_evicted():
+    prefetcher = ImagePrefetcher(max_entries=2)
+    first, second, third = (encode((16, 16), (i, i, i)) for i in (160, 170, 180))
+    for image in (first, second, third):
+        prefetcher.submit(image)
+
+    assert prefetcher.get(first, timeout=5) is None
+    assert prefetcher.get(third, timeout=5) is not None
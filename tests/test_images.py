@@ -0,0 +1,70 @@
+"""多图片预处理测试"""
+
+import io
+from types import SimpleNamespace
+
+from PIL import Image
+
+from clients.gemini_client import GeminiClient
+from utils.images import as_image_list, image_digest, prepare_images
+
+
+def encode(size, fmt="JPEG", color=(200, 30, 30)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def noisy_png(size):
+    image = Image.effect_noise(size, 100).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_as_image_list_normalises_inputs():
+    assert as_image_list(None) == []
+    assert as_image_list(b"x") == [b"x"]
+    assert as_image_list([b"a", None, b"b"]) == [b"a", b"b"]
+
+
+def test_small_jpeg_is_kept_as_is_and_large_image_is_downscaled():
+    small = encode((64, 64))
+    small_item, large_item = prepare_images([small, encode((3000, 1500))], max_side=1024)
+
+    assert small_item["data"] == small and small_item["mime_type"] == "image/jpeg"
+    assert max(large_item["width"], large_item["height"]) <= 1024
+
+
+def test_total_size_is_kept_under_budget():
+    images = [noisy_png((600, 600)) for _ in range(3)]
+    budget = sum(len(data) for data in images) // 4
+
+    prepared = prepare_images(images, max_total_bytes=budget)
+
+    assert len(prepared) == 3
+    assert sum(len(item["data"]) for item in prepared) <= budget
+
+
+def test_image_digest_is_content_based():
+    assert image_digest(encode((10, 10))) == image_digest(encode((10, 10)))
+    assert image_digest(encode((10, 10))) != image_digest(encode((10, 10), color=(0, 0, 0)))
+
+
+def test_gemini_sends_all_images_in_one_request():
+    requests = []
+
+    def generate_content(model, contents, config):
+        requests.append(contents)
+        return SimpleNamespace(text="两张图", usage_metadata=None)
+
+    client = GeminiClient("test-key")
+    client.client = SimpleNamespace(models=SimpleNamespace(generate_content=generate_content))
+
+    result = client.get_response("比较这两张图", image_input=[encode((32, 32)), encode((48, 48))])
+
+    assert result["success"]
+    assert len(requests) == 1
+    parts = requests[0][-1].parts
+    assert parts[0].text == "比较这两张图"
+    assert [part.inline_data.mime_type for part in parts[1:]] == ["image/jpeg", "image/jpeg"]
@@ -0,0 +1,22 @@
+"""端到端负载测试（AppTest + 本地桩服务）冒烟测试"""
+
+import argparse
+
+from benchmarks.load_test import run_load_test
+from benchmarks.stub_providers import StubConfig, StubProviders
+
+
+def test_single_session_round_trip(tmp_path, monkeypatch):
+    # run_worker 会切换工作目录并设置数据目录，测试结束后由 monkeypatch 还原
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("ASSISTANT_DATA_DIR", str(tmp_path))
+    args = argparse.Namespace(sessions=1, turns=2, processes=1, save_every=2, cache="off")
+
+    with StubProviders(StubConfig(0.01, 0.0, 3)) as stub:
+        results = run_load_test(stub, args, str(tmp_path / "data"))
+
+    assert results["errors"] == []
+    assert [item["turn"] for item in results["interactions"]] == [1, 2]
+    assert [item["turn"] for item in results["refreshes"]] == [2]
+    assert [item["delivered"] for item in results["saves"]] == [True]
+    assert results["provider_requests"]
@@ -0,0 +1,61 @@
+"""会话内存统计测试"""
+
+from PIL import Image
+
+from utils import memory
+from utils.memory import MB, MemoryAccountant, estimate_size, messages_size, trim_messages
+
+
+def make_messages(count, preview_bytes=100_000):
+    return [{"seq": i, "role": "user" if i % 2 == 0 else "assistant", "content": f"消息 {i}",
+             "image_preview": b"x" * preview_bytes} for i in range(count)]
+
+
+def test_estimate_size_counts_bytes_and_decoded_images():
+    assert estimate_size({"data": b"x" * 10_000}) > 10_000
+    assert estimate_size(Image.new("RGB", (100, 100))) >= 100 * 100 * 3
+
+
+def test_messages_size_cache_drops_removed_messages():
+    messages = make_messages(4)
+    cache = {}
+    total = messages_size(messages, cache)
+
+    del messages[:2]
+
+    assert messages_size(messages, cache) < total
+    assert set(cache) == {2, 3}
+
+
+def test_trim_unloads_folded_messages_before_touching_visible_ones():
+    messages = make_messages(10)
+    budget = messages_size(messages) - 250_000
+
+    result = trim_messages(messages, budget, visible=6, keep_last=4)
+
+    assert result["unloaded"] == 3 and result["previews"] == 0
+    assert [m["seq"] for m in messages] == list(range(3, 10))
+
+
+def test_trim_evicts_previews_but_keeps_recent_messages():
+    messages = make_messages(6)
+
+    result = trim_messages(messages, budget=450_000, keep_last=4)
+
+    assert result["previews"] >= 1
+    assert messages[0].get("image_evicted") is True
+    assert all(m["image_preview"] for m in messages[-4:])
+    assert messages_size(messages) <= 450_000
+
+
+def test_worker_budget_is_shared_between_sessions(monkeypatch):
+    accountant = MemoryAccountant(session_budget=100 * MB, worker_budget=200 * MB)
+    accountant.record_session("a", {"messages": 40 * MB})
+    accountant.record_session("b", {"messages": 20 * MB})
+    monkeypatch.setattr(memory, "process_rss", lambda: 260 * MB)
+
+    # 会话以外占用 200MB，剩余 0 时每个会话至少保留 1MB
+    assert accountant.budget_for() == MB
+    monkeypatch.setattr(memory, "process_rss", lambda: 150 * MB)
+    assert accountant.budget_for() == 100 * MB
+    assert [s["session_id"] for s in accountant.sessions()] == ["a", "b"]
@@ -0,0 +1,110 @@
+"""飞书发件箱测试"""
+
+import threading
+import time
+
+import pytest
+
+from utils.outbox import FeishuOutbox
+from utils.retry import RetryPolicy
+
+
+class FakeFeishu:
+    """记录 batch_create 调用的飞书客户端"""
+
+    app_token = "app"
+
+    def __init__(self, failures=0, delay=0.0):
+        self.failures = failures
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def add_record_to_bitable(self, table_id, fields, client_token=None):
+        time.sleep(self.delay)
+        with self._lock:
+            self.calls.append((client_token, [f["sectionID"] for f in fields]))
+            if self.failures:
+                self.failures -= 1
+                return {"success": False, "error": "timeout"}
+        return {"success": True}
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "outbox.db")
+
+
+def make_outbox(path, **kwargs):
+    return FeishuOutbox(path, backoff_policy=RetryPolicy(base_delay=0.01, max_delay=0.01), **kwargs)
+
+
+def test_enqueue_is_idempotent_per_client_token(db_path):
+    outbox = make_outbox(db_path)
+
+    first = outbox.enqueue("app", "t", [{"sectionID": "s1"}], "tok")
+    second = outbox.enqueue("app", "t", [{"sectionID": "s1"}], "tok")
+
+    assert first["queued"] and not second["queued"]
+    assert first["id"] == second["id"]
+    assert outbox.depth() == 1
+
+
+def test_drain_batches_rows_and_deletes_delivered(db_path):
+    outbox = make_outbox(db_path)
+    for i in range(3):
+        outbox.enqueue("app", "t", [{"sectionID": f"s{i}"}], f"tok{i}")
+    client = FakeFeishu()
+
+    result = outbox.drain(client)
+
+    assert result == {"sent": 3, "failed": 0, "depth": 0}
+    assert len(client.calls) == 1
+    assert client.calls[0][1] == ["s0", "s1", "s2"]
+
+
+def test_retry_resends_frozen_batch_with_same_token(db_path):
+    outbox = make_outbox(db_path)
+    outbox.enqueue("app", "t", [{"sectionID": "s1"}], "A")
+    outbox.enqueue("app", "t", [{"sectionID": "s2"}], "B")
+    client = FakeFeishu(failures=1)
+
+    assert outbox.drain(client)["failed"] == 2
+    outbox.enqueue("app", "t", [{"sectionID": "s3"}], "C")
+    time.sleep(0.05)
+    assert outbox.drain(client)["sent"] == 3
+
+    (first_token, first), (retry_token, retried), (_, new) = client.calls
+    assert retry_token == first_token and retried == first == ["s1", "s2"]
+    assert new == ["s3"]
+
+
+def test_rows_go_dead_after_max_attempts(db_path):
+    outbox = make_outbox(db_path, max_attempts=1)
+    entry = outbox.enqueue("app", "t", [{"sectionID": "s1"}], "A")
+
+    outbox.drain(FakeFeishu(failures=1))
+
+    assert outbox.entry_state(entry["id"])["status"] == "dead"
+    assert outbox.stats()["dead"] == 1
+
+
+def test_concurrent_drains_on_shared_database_deliver_each_row_once(db_path):
+    producer = make_outbox(db_path, batch_size=2)
+    for i in range(6):
+        producer.enqueue("app", "t", [{"sectionID": f"s{i}"}], f"tok{i}")
+    # 模拟多个工作进程：各自独立的连接共享同一数据库文件
+    workers = [make_outbox(db_path, batch_size=2) for _ in range(3)]
+    client = FakeFeishu(delay=0.05)
+
+    threads = [threading.Thread(target=w.drain, args=(client,)) for w in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    while producer.drain(client)["sent"]:
+        pass
+
+    delivered = [section for _, sections in client.calls for section in sections]
+    assert sorted(delivered) == [f"s{i}" for i in range(6)]
+    assert producer.depth() == 0
@@ -0,0 +1,80 @@
+"""输出长度预测与自动续写测试"""
+
+import pytest
+
+from benchmarks.stub_providers import StubConfig, StubProviders
+from clients.deepseek_client import DeepSeekClient
+from utils.output_length import (
+    KIND_DEFAULTS, REASONING_MIN_TOKENS, OutputLengthPredictor, model_max_output, question_kind
+)
+from utils.shared_cache import SQLiteCache
+
+
+@pytest.mark.parametrize("message, kind", [
+    ("今天星期几？", "short"),
+    ("帮我写一个 Python 函数计算斐波那契", "code"),
+    ("详细解释一下 TCP 三次握手", "long"),
+    ("连接池和 keep-alive 有什么关系，在生产环境中应该如何配置它们以获得最佳性能呢", "general"),
+])
+def test_question_kind(message, kind):
+    assert question_kind(message) == kind
+
+
+def test_prediction_uses_defaults_then_history_quantile():
+    predictor = OutputLengthPredictor(min_tokens=1, min_samples=3, quantile=0.9, headroom=1.0)
+    features = predictor.features("帮我写一个排序函数")
+    assert predictor.predict(features) == KIND_DEFAULTS["code"]
+
+    for tokens in (100, 200, 300):
+        predictor.observe(features, tokens)
+
+    assert predictor.predict(features) == 300
+
+
+def test_prediction_is_capped_by_model_limit():
+    predictor = OutputLengthPredictor(min_samples=1)
+    features = predictor.features("写一篇文章")
+    predictor.observe(features, 50_000)
+
+    assert predictor.predict(features) == model_max_output("deepseek-chat")
+
+
+def test_samples_are_shared_between_processes(tmp_path):
+    path = str(tmp_path / "shared.db")
+    writer = OutputLengthPredictor(min_samples=2, min_tokens=1, headroom=1.0, cache=SQLiteCache(path))
+    features = writer.features("你好")
+    writer.observe(features, 700)
+    writer.observe(features, 800)
+
+    reader = OutputLengthPredictor(min_samples=2, min_tokens=1, headroom=1.0, cache=SQLiteCache(path))
+
+    assert reader.predict(features) == 800
+
+
+@pytest.fixture(scope="module")
+def stub():
+    with StubProviders(StubConfig(first_token=0.0, chunk_delay=0.0, chunks=25)) as providers:
+        yield providers.secrets()
+
+
+def test_truncated_answer_is_continued(stub):
+    client = DeepSeekClient(stub["DEEPSEEK_API_KEY"], base_url=stub["DEEPSEEK_BASE_URL"])
+
+    truncated = client.get_response("hi", max_tokens=10)
+    continued = client.get_response("hi", max_tokens=10, max_continuations=3)
+
+    assert truncated["finish_reason"] == "length" and truncated["continuations"] == 0
+    assert continued["finish_reason"] == "stop" and continued["continuations"] >= 1
+    assert continued["usage"]["completion_tokens"] > truncated["usage"]["completion_tokens"]
+
+
+def test_reasoner_is_not_predicted_from_answer_length(stub):
+    predictor = OutputLengthPredictor(min_samples=1)
+    features = predictor.features("今天星期几？", model="deepseek-reasoner")
+    predictor.observe(features, 10)
+
+    client = DeepSeekClient(stub["DEEPSEEK_API_KEY"], base_url=stub["DEEPSEEK_BASE_URL"], length_predictor=predictor)
+
+    plan = client._length_plan("今天星期几？", "deepseek-reasoner", None, None, None)
+
+    assert plan["max_tokens"] == REASONING_MIN_TOKENS and plan["features"] is None
@@ -0,0 +1,58 @@
+"""性能分析测试"""
+
+import pstats
+
+import pytest
+
+from utils.profiling import Profiler
+
+
+def _work():
+    return sum(i * i for i in range(1000))
+
+
+def test_should_profile_respects_force_and_sample_rate(tmp_path):
+    assert Profiler(str(tmp_path), sample_rate=0.0).should_profile() is False
+    assert Profiler(str(tmp_path), sample_rate=0.0).should_profile(force=True) is True
+    assert Profiler(str(tmp_path), sample_rate=1.0).should_profile() is True
+
+
+def test_unknown_engine_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        Profiler(str(tmp_path), engine="perf")
+
+
+def test_inactive_profile_writes_nothing(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    with profiler.profile("process_message", active=False):
+        _work()
+    assert profiler.recent() == []
+
+
+def test_profile_writes_loadable_cprofile_file(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    with profiler.profile("process_message", request_id="abcd1234"):
+        _work()
+
+    files = profiler.recent()
+    assert len(files) == 1
+    assert files[0]["name"].endswith("-abcd1234-process_message.prof")
+    assert pstats.Stats(files[0]["path"]).total_calls > 0
+
+
+def test_nested_profile_keeps_only_outermost(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    with profiler.profile("outer"):
+        with profiler.profile("inner"):
+            _work()
+    names = [item["name"] for item in profiler.recent()]
+    assert len(names) == 1
+    assert names[0].endswith("-outer.prof")
+
+
+def test_old_files_are_pruned(tmp_path):
+    profiler = Profiler(str(tmp_path), max_files=2)
+    for index in range(4):
+        with profiler.profile(f"run{index}"):
+            _work()
+    assert len(profiler.recent(limit=10)) == 2
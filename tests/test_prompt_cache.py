@@ -0,0 +1,89 @@
+"""提示词前缀复用与 Gemini 上下文缓存测试"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+from clients.gemini_client import GeminiClient
+from utils.prompt_cache import GeminiCacheManager, PrefixMessageBuilder
+
+LONG_PROMPT = "你是一个严谨的助手。" * 50
+
+
+class FakeCaches:
+    """记录 caches.create 调用，可模拟慢速创建"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.created = 0
+
+    def create(self, model, config):
+        time.sleep(self.delay)
+        self.created += 1
+        return SimpleNamespace(name=f"cachedContents/{self.created}")
+
+
+def test_history_prefix_stays_stable_and_context_goes_last():
+    builder = PrefixMessageBuilder(max_history_messages=4)
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": str(i)} for i in range(5)]
+
+    first = builder.build("q1", system_prompt="sys", history=history, context="检索结果")
+    second = builder.build("q2", system_prompt="sys", history=history + [{"role": "assistant", "content": "5"}])
+
+    assert first[0] == {"role": "system", "content": "sys"}
+    assert first[-1]["content"].startswith("检索结果") and first[-1]["content"].endswith("q1")
+    # 历史按块截断：相邻两轮的历史前缀一致
+    assert first[1:-1] == second[1:len(first) - 1]
+    assert first[1]["role"] == "user"
+
+
+def test_cache_manager_reuses_entry_and_skips_short_prompts():
+    caches = FakeCaches()
+    manager = GeminiCacheManager(client=SimpleNamespace(caches=caches), min_tokens=100)
+
+    assert manager.get_cached_content("m", "短提示词") is None
+    name = manager.get_cached_content("m", LONG_PROMPT)
+    assert manager.get_cached_content("m", LONG_PROMPT) == name
+    assert caches.created == 1
+
+    manager.invalidate(name)
+    assert manager.get_cached_content("m", LONG_PROMPT) != name
+
+
+def test_cache_creation_does_not_block_other_callers():
+    caches = FakeCaches(delay=0.3)
+    manager = GeminiCacheManager(client=SimpleNamespace(caches=caches), min_tokens=100)
+    creator = threading.Thread(target=manager.get_cached_content, args=("m", LONG_PROMPT))
+    creator.start()
+    time.sleep(0.05)
+
+    start = time.perf_counter()
+    assert manager.get_cached_content("m", LONG_PROMPT) is None
+    assert time.perf_counter() - start < 0.1
+    creator.join()
+    assert manager.get_cached_content("m", LONG_PROMPT) == "cachedContents/1"
+
+
+def test_stream_falls_back_to_inline_system_prompt_when_cache_expired():
+    class NotFound(Exception):
+        code = 404
+
+    requested = []
+
+    def generate_content_stream(model, contents, config):
+        requested.append(config.cached_content)
+        if config.cached_content:
+            raise NotFound("cached content not found")
+        yield SimpleNamespace(usage_metadata=None, candidates=[SimpleNamespace(finish_reason=None)], text="ok")
+
+    caches = FakeCaches()
+    manager = GeminiCacheManager(min_tokens=100)
+    client = GeminiClient("test-key", cache_manager=manager)
+    client.client = SimpleNamespace(models=SimpleNamespace(generate_content_stream=generate_content_stream),
+                                    caches=caches)
+
+    events = list(client.stream_response("你好", system_prompt=LONG_PROMPT))
+
+    assert [e["type"] for e in events] == ["delta", "done"]
+    assert requested == ["cachedContents/1", None]
+    assert manager._entries == {}
@@ -0,0 +1,45 @@
+"""录制 / 回放测试"""
+
+import httpx
+import pytest
+
+from utils.recorder import MISS_STATUS, ProviderRecorder, request_key
+
+
+def test_request_key_ignores_secrets_and_json_key_order():
+    first = request_key("post", "https://api.test/v1?key=secret&b=2&a=1", b'{"x": 1, "y": 2}')
+    second = request_key("POST", "https://api.test/v1?a=1&b=2&key=other", b'{"y": 2, "x": 1}')
+
+    assert first == second
+    assert "secret" not in first
+
+
+def test_invalid_mode_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        ProviderRecorder(str(tmp_path / "c.jsonl"), mode="live")
+
+
+def test_recorded_stream_replays_without_network(tmp_path):
+    path = str(tmp_path / "cassette.jsonl")
+    upstream_calls = []
+
+    def upstream(request):
+        upstream_calls.append(request)
+        return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                              content=iter([b"data: a\n\n", b"data: b\n\n"]))
+
+    recorder = ProviderRecorder(path, mode="record")
+    with httpx.Client(transport=recorder.httpx_transport(inner=httpx.MockTransport(upstream))) as client:
+        recorded = client.post("https://api.test/chat?key=secret", json={"q": "hi"}).content
+
+    replayer = ProviderRecorder(path, mode="replay", timing="none")
+    with httpx.Client(transport=replayer.httpx_transport(inner=httpx.MockTransport(upstream))) as client:
+        replayed = client.post("https://api.test/chat?key=another", json={"q": "hi"})
+        missed = client.post("https://api.test/chat", json={"q": "unrecorded"})
+
+    assert recorded == replayed.content == b"data: a\n\ndata: b\n\n"
+    assert replayed.headers["content-type"] == "text/event-stream"
+    assert missed.status_code == MISS_STATUS
+    assert len(upstream_calls) == 1
+    with open(path, encoding="utf-8") as f:
+        assert "secret" not in f.read()
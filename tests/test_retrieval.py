@@ -0,0 +1,60 @@
+"""知识库检索索引测试"""
+
+from utils.retrieval import KnowledgeIndex, normalize_question, tokenize
+
+
+def test_tokenize_mixes_words_and_cjk_bigrams():
+    assert tokenize("Python 异步编程") == ["python", "异步", "步编", "编程"]
+
+
+def test_normalize_question_ignores_case_and_punctuation():
+    assert normalize_question("什么是 BM25？") == normalize_question("什么是bm25")
+
+
+def test_exact_lookup_strips_model_footer():
+    index = KnowledgeIndex()
+    index.add("什么是 BM25？", "一种排序函数\n\n---\n*使用模型: deepseek*", "rec1")
+
+    hit = index.lookup_exact("什么是bm25")
+
+    assert hit["answer"] == "一种排序函数"
+    assert hit["record_id"] == "rec1"
+
+
+def test_search_ranks_relevant_document_first():
+    index = KnowledgeIndex()
+    index.add("如何配置飞书机器人", "在开放平台创建应用")
+    index.add("Python 异步编程入门", "使用 asyncio 和 await")
+
+    hits = index.search("异步编程", top_k=1)
+
+    assert hits[0]["question"] == "Python 异步编程入门"
+
+
+def test_updating_question_replaces_old_postings_and_length():
+    index = KnowledgeIndex()
+    doc_id = index.add("部署方式", "使用 docker compose 启动服务")
+    index.add("其他问题", "无关内容")
+    total_before = index._total_length
+
+    assert index.add("部署方式", "直接运行 streamlit") == doc_id
+
+    assert len(index) == 2
+    assert "docker" not in index._postings
+    assert index.search("docker compose") == []
+    assert index.search("streamlit")[0]["question"] == "部署方式"
+    expected_length = len(tokenize("部署方式") + tokenize("直接运行 streamlit"))
+    assert index._doc_lengths[doc_id] == expected_length
+    assert index._total_length == total_before - len(tokenize("部署方式 使用 docker compose 启动服务")) + expected_length
+
+
+def test_add_records_pairs_user_and_assistant_by_section():
+    index = KnowledgeIndex()
+    added = index.add_records([
+        {"fields": {"sectionID": "s1", "role": "user", "user_question": "你好"}},
+        {"record_id": "r2", "fields": {"sectionID": "s1", "role": "assistant", "AI_answer": "你好！"}},
+        {"fields": {"sectionID": "s2", "role": "user", "user_question": "没有回答"}},
+    ])
+
+    assert added == 1
+    assert index.lookup_exact("你好")["record_id"] == "r2"
@@ -0,0 +1,92 @@
+"""重试策略测试"""
+
+import pytest
+
+from utils.retry import RetryPolicy, RetryableError, RETRYABLE_STATUS_CODES, parse_retry_after
+
+
+class StatusError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = type("Response", (), {"headers": headers or {}})()
+
+
+def make_policy(**kwargs):
+    sleeps = []
+    policy = RetryPolicy(base_delay=0.01, max_delay=0.01, sleep=sleeps.append, **kwargs)
+    return policy, sleeps
+
+
+def failing(errors, result="ok"):
+    calls = []
+
+    def operation():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return operation, calls
+
+
+def test_retries_transient_status_then_succeeds():
+    policy, sleeps = make_policy()
+    operation, calls = failing([StatusError(503)])
+
+    assert policy.call(operation) == "ok"
+    assert len(calls) == 2 and len(sleeps) == 1
+
+
+@pytest.mark.parametrize("status", [400, 401, 404, 409])
+def test_client_errors_are_not_retried(status):
+    policy, _ = make_policy()
+    operation, calls = failing([StatusError(status)])
+
+    with pytest.raises(StatusError):
+        policy.call(operation)
+    assert len(calls) == 1
+
+
+def test_conflict_can_be_enabled_per_call_site():
+    policy, _ = make_policy(retryable_status_codes=RETRYABLE_STATUS_CODES | {409})
+    operation, calls = failing([StatusError(409)])
+
+    assert policy.call(operation) == "ok"
+    assert len(calls) == 2
+
+
+def test_gives_up_after_max_attempts():
+    policy, sleeps = make_policy(max_attempts=3)
+    operation, calls = failing([StatusError(500)] * 5)
+
+    with pytest.raises(StatusError):
+        policy.call(operation)
+    assert len(calls) == 3 and len(sleeps) == 2
+
+
+def test_honours_retry_after_and_rejects_excessive_values():
+    policy, sleeps = make_policy(max_retry_after=5)
+    operation, _ = failing([StatusError(429, {"retry-after": "2"})])
+    policy.call(operation)
+    assert sleeps == [2.0]
+
+    operation, calls = failing([StatusError(429, {"retry-after": "60"})])
+    with pytest.raises(StatusError):
+        policy.call(operation)
+    assert len(calls) == 1
+
+
+def test_transport_errors_and_explicit_retryable_errors_are_retried():
+    policy, _ = make_policy(max_attempts=3)
+    operation, calls = failing([ConnectionError("reset"), RetryableError("rate limited", retry_after=0)])
+
+    assert policy.call(operation) == "ok"
+    assert len(calls) == 3
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after("") is None
+    assert parse_retry_after("not a date") is None
+    assert parse_retry_after("Thu, 01 Jan 1970 00:00:00 GMT") == 0.0
@@ -0,0 +1,60 @@
+"""路由策略测试"""
+
+from clients.gemini_client import GeminiClient
+from utils.routing_policy import (
+    AdaptiveRoutingPolicy, COST_TABLE, DEFAULT_LATENCY, ProviderStats, StaticRoutingPolicy, estimate_cost
+)
+
+ALL = {"deepseek", "gemini"}
+
+
+def test_estimate_cost_prices_cached_input_separately():
+    full = estimate_cost("deepseek-chat", 1_000_000, 0)
+    cached = estimate_cost("deepseek-chat", 1_000_000, 0, cached_tokens=1_000_000)
+
+    assert full == COST_TABLE["deepseek-chat"]["input"]
+    assert cached == COST_TABLE["deepseek-chat"]["cached_input"]
+    assert estimate_cost("unknown-model", 1000, 1000) == 0.0
+
+
+def test_routed_gemini_models_have_prices_and_latency_priors():
+    fast = GeminiClient.normalize_model("gemini-1.5-flash")
+    pro = GeminiClient.normalize_model("gemini-1.5-pro")
+
+    assert fast == pro == "gemini-2.0-flash"
+    for model in (fast, "gemini-2.5-pro"):
+        assert model in COST_TABLE and model in DEFAULT_LATENCY
+
+
+def test_static_policy_sends_images_to_gemini():
+    policy = StaticRoutingPolicy(gemini_model="gemini-2.0-flash")
+
+    assert policy.decide("描述这张图", True, ALL, ProviderStats())["provider"] == "gemini"
+    assert policy.decide("你好", False, ALL, ProviderStats())["model"] == "deepseek-chat"
+
+
+def test_adaptive_policy_uses_reasoner_for_structured_math():
+    policy = AdaptiveRoutingPolicy()
+
+    simple = policy.decide("你好，今天天气怎么样", False, ALL, ProviderStats())
+    proof = policy.decide("请证明：对任意正整数 n，1 + 2 + ... + n = n(n+1)/2，并逐步推导每一步", False, ALL, ProviderStats())
+
+    assert simple["model"] == "deepseek-chat"
+    assert proof["model"] == "deepseek-reasoner"
+
+
+def test_adaptive_policy_skips_unhealthy_models():
+    stats = ProviderStats()
+    for _ in range(5):
+        stats.record("deepseek-chat", 1.0, success=False)
+
+    decision = AdaptiveRoutingPolicy().decide("你好", False, ALL, stats)
+
+    assert decision["provider"] == "gemini"
+    assert decision["model"] == "gemini-2.0-flash"
+
+
+def test_adaptive_policy_falls_back_when_deepseek_missing():
+    decision = AdaptiveRoutingPolicy().decide("你好", False, {"gemini"}, ProviderStats())
+
+    assert decision["provider"] == "gemini"
@@ -0,0 +1,50 @@
+"""会话持久化测试"""
+
+from utils.session_store import SessionStore
+
+
+def make_store(tmp_path, name="sessions.db"):
+    return SessionStore(str(tmp_path / name), flush_interval=0.01)
+
+
+def test_messages_round_trip_with_binary_meta(tmp_path):
+    store = make_store(tmp_path)
+    store.append("s1", 0, {"role": "user", "content": "看这张图", "images": [b"\x89PNG"], "model": None})
+    store.append("s1", 1, {"role": "assistant", "content": "好的", "model": "deepseek-chat"})
+    assert store.flush()
+
+    messages = make_store(tmp_path).load_page("s1")
+
+    assert messages == [
+        {"role": "user", "content": "看这张图", "images": [b"\x89PNG"], "seq": 0},
+        {"role": "assistant", "content": "好的", "model": "deepseek-chat", "seq": 1},
+    ]
+
+
+def test_pages_load_newest_first_and_older_on_demand(tmp_path):
+    store = make_store(tmp_path)
+    for seq in range(10):
+        store.append("s1", seq, {"role": "user", "content": str(seq)})
+    store.flush()
+
+    latest = store.load_page("s1", limit=4)
+    older = store.load_page("s1", before=latest[0]["seq"], limit=4)
+
+    assert [m["seq"] for m in latest] == [6, 7, 8, 9]
+    assert [m["seq"] for m in older] == [2, 3, 4, 5]
+    assert store.count("s1") == 10
+
+
+def test_rewriting_seq_overwrites_and_delete_removes_session(tmp_path):
+    store = make_store(tmp_path)
+    store.append("s1", 0, {"role": "assistant", "content": "草稿"})
+    store.append("s1", 0, {"role": "assistant", "content": "最终回答"})
+    store.append("s2", 0, {"role": "user", "content": "其他会话"})
+    store.flush()
+    assert store.load_page("s1")[0]["content"] == "最终回答"
+
+    store.delete_session("s1")
+    store.flush()
+
+    assert store.count("s1") == 0
+    assert store.count("s2") == 1
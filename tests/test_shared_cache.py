@@ -0,0 +1,72 @@
+"""跨进程共享缓存测试"""
+
+import socket
+import time
+
+import pytest
+
+from benchmarks.stub_providers import StubRedis
+from utils.shared_cache import RedisCache, SQLiteCache, open_shared_cache
+
+
+@pytest.fixture
+def redis_url():
+    server = StubRedis().start()
+    yield server.url
+    server.stop()
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_sqlite_cache_is_shared_between_connections(tmp_path):
+    path = str(tmp_path / "shared.db")
+    writer, reader = SQLiteCache(path), SQLiteCache(path)
+
+    writer.set_json("summary:k", {"text": "摘要"})
+
+    assert reader.get_json("summary:k") == {"text": "摘要"}
+
+
+def test_sqlite_only_new_keeps_first_value_until_expired(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "shared.db"))
+
+    assert cache.set("k", b"first", ttl=0.05, only_new=True)
+    assert not cache.set("k", b"second", only_new=True)
+    assert cache.get("k") == b"first"
+    time.sleep(0.06)
+    assert cache.get("k") is None
+    assert cache.set("k", b"third", only_new=True)
+    assert cache.get("k") == b"third"
+
+
+def test_redis_cache_round_trip(redis_url):
+    cache = RedisCache(redis_url, prefix="test:")
+
+    assert cache.ping()
+    assert cache.set("k", b"v", ttl=60, only_new=True)
+    assert not cache.set("k", b"other", only_new=True)
+    assert cache.get("k") == b"v"
+    cache.delete("k")
+    assert cache.get("k") is None
+
+
+def test_unavailable_redis_is_treated_as_miss():
+    cache = RedisCache(f"redis://127.0.0.1:{unused_port()}/0", timeout=0.2, retry_interval=60)
+
+    assert cache.get("k") is None
+    start = time.perf_counter()
+    assert not cache.set("k", b"v")
+    # 暂停期内不再尝试连接
+    assert time.perf_counter() - start < 0.05
+
+
+def test_open_shared_cache_selects_backend(tmp_path, redis_url):
+    default_path = str(tmp_path / "default.db")
+
+    assert open_shared_cache("off", default_path) is None
+    assert isinstance(open_shared_cache("", default_path), SQLiteCache)
+    assert isinstance(open_shared_cache(redis_url, default_path), RedisCache)
@@ -0,0 +1,116 @@
+"""请求合并（single-flight）测试"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+from clients.gemini_client import GeminiClient
+from utils.cancellation import CancelToken
+from utils.retry import RetryPolicy
+from utils.singleflight import SingleFlight
+
+
+def run_concurrently(count, target):
+    results = [None] * count
+    threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, target())) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return results
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.1)
+        return "answer"
+
+    results = run_concurrently(4, lambda: flight.do("key", fetch))
+
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+    assert {value for value, _ in results} == {"answer"}
+    assert flight.in_flight() == 0
+
+
+def test_errors_reach_every_waiter_and_next_call_retries():
+    flight = SingleFlight()
+
+    def fail():
+        time.sleep(0.05)
+        raise ValueError("boom")
+
+    def call():
+        try:
+            flight.do("key", fail)
+        except ValueError as e:
+            return str(e)
+
+    assert run_concurrently(3, call) == ["boom"] * 3
+    assert flight.do("key", lambda: "ok") == ("ok", False)
+
+
+def test_stream_is_broadcast_to_all_subscribers():
+    flight = SingleFlight()
+    started = []
+
+    def stream(cancel_token):
+        started.append(1)
+        for chunk in "abc":
+            time.sleep(0.02)
+            yield chunk
+
+    first, first_shared = flight.do_stream("key", stream)
+    second, second_shared = flight.do_stream("key", stream)
+
+    assert (first_shared, second_shared) == (False, True)
+    assert "".join(first) == "".join(second) == "abc"
+    assert len(started) == 1
+
+
+def test_upstream_is_cancelled_when_all_subscribers_leave():
+    flight = SingleFlight()
+    upstream_token = []
+
+    def stream(cancel_token):
+        upstream_token.append(cancel_token)
+        while not cancel_token.cancelled:
+            yield "x"
+            time.sleep(0.01)
+
+    caller_token = CancelToken()
+    chunks, _ = flight.do_stream("key", stream, cancel_token=caller_token)
+    assert next(chunks) == "x"
+    caller_token.cancel()
+    assert list(chunks) == []
+
+    assert upstream_token[0].wait(1)
+
+
+def test_gemini_stream_retries_until_first_chunk():
+    class Unavailable(Exception):
+        status_code = 503
+
+    attempts = []
+
+    def generate_content_stream(**kwargs):
+        attempts.append(1)
+        if len(attempts) == 1:
+            # SDK 的流是惰性的：错误在读取第一个分块时才抛出
+            raise Unavailable("unavailable")
+        for text in ("a", "b"):
+            yield SimpleNamespace(usage_metadata=None, candidates=[SimpleNamespace(finish_reason=None)], text=text)
+
+    client = GeminiClient("test-key", retry_policy=RetryPolicy(base_delay=0.01, sleep=lambda _: None))
+    client.client = SimpleNamespace(models=SimpleNamespace(generate_content_stream=generate_content_stream))
+
+    events = list(client.stream_response("你好"))
+
+    assert len(attempts) == 2
+    assert [e["type"] for e in events] == ["delta", "delta", "done"]
+    assert events[-1]["content"] == "ab"
+
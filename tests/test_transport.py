@@ -0,0 +1,39 @@
+"""HTTP 传输层测试"""
+
+from utils.transport import PoolSettings, TransportRegistry, normalize_proxy
+
+
+def make_registry(**kwargs):
+    return TransportRegistry(settings=PoolSettings(http2=False), **kwargs)
+
+
+def test_normalize_proxy_treats_blank_as_direct():
+    assert normalize_proxy("  ") is None
+    assert normalize_proxy(" http://127.0.0.1:7890 ") == "http://127.0.0.1:7890"
+
+
+def test_same_proxy_reuses_transport_and_clients():
+    registry = make_registry()
+
+    transport = registry.get("")
+    assert registry.get(None) is transport
+    assert transport.httpx_client() is transport.httpx_client()
+    assert transport.requests_session() is transport.requests_session()
+    assert len(registry) == 1
+
+
+def test_eviction_closes_least_recently_used_transport():
+    registry = make_registry(max_transports=2)
+    first = registry.get("http://proxy-a:1")
+    second = registry.get("http://proxy-b:1")
+    first_client = first.httpx_client()
+    second_client = second.httpx_client()
+
+    # 最近使用过 proxy-a，淘汰的应是 proxy-b
+    assert registry.get("http://proxy-a:1") is first
+    registry.get("http://proxy-c:1")
+
+    assert len(registry) == 2
+    assert second_client.is_closed
+    assert not first_client.is_closed
+    assert registry.get("http://proxy-b:1") is not second
@@ -0,0 +1,69 @@
+"""用量台账测试"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from clients.gemini_client import GeminiClient
+from utils.routing_policy import estimate_cost
+from utils.usage_ledger import UsageLedger, today
+
+DEEPSEEK_USAGE = {"prompt_tokens": 1000, "completion_tokens": 200, "prompt_cache_hit_tokens": 600}
+
+
+def test_record_prices_cache_hits_and_skips_coalesced_tokens():
+    ledger = UsageLedger()
+
+    cost = ledger.record("s1", "deepseek", "deepseek-chat", DEEPSEEK_USAGE, latency=1.0)
+    shared = ledger.record("s1", "deepseek", "deepseek-chat", DEEPSEEK_USAGE, latency=0.1, coalesced=True)
+    summary = ledger.summary(session_id="s1")
+
+    assert cost == pytest.approx(estimate_cost("deepseek-chat", 1000, 200, 600))
+    assert shared == 0.0
+    assert summary["requests"] == 2
+    assert summary["total_tokens"] == 1200 and summary["cached_tokens"] == 600
+
+
+def test_summary_filters_and_groups():
+    ledger = UsageLedger()
+    ledger.record("s1", "deepseek", "deepseek-chat", DEEPSEEK_USAGE, latency=1.0)
+    ledger.record("s2", "gemini", "gemini-2.0-flash", {"prompt_tokens": 10, "completion_tokens": 5}, latency=2.0)
+    ledger.record("s2", "gemini", "gemini-2.0-flash", None, latency=0.5, status="error")
+
+    by_provider = ledger.group_by("provider")
+
+    assert ledger.summary(session_id="s2")["errors"] == 1
+    assert ledger.summary(day=today())["requests"] == 3
+    assert by_provider["gemini"]["total_tokens"] == 15
+    assert by_provider["deepseek"]["requests"] == 1
+    with pytest.raises(ValueError):
+        ledger.group_by("user")
+
+
+def test_records_survive_restart(tmp_path):
+    path = str(tmp_path / "usage.db")
+    ledger = UsageLedger(path, flush_every=100)
+    ledger.record("s1", "deepseek", "deepseek-chat", DEEPSEEK_USAGE, latency=1.0)
+    ledger.flush()
+
+    reloaded = UsageLedger(path)
+
+    assert len(reloaded) == 1
+    assert reloaded.summary()["cached_tokens"] == 600
+
+
+def test_gemini_usage_matches_deepseek_fields():
+    metadata = SimpleNamespace(
+        prompt_token_count=1300, cached_content_token_count=1000, candidates_token_count=50,
+        thoughts_token_count=20, total_token_count=1370,
+        prompt_tokens_details=[SimpleNamespace(modality="MediaModality.IMAGE", token_count=258),
+                               SimpleNamespace(modality="MediaModality.TEXT", token_count=1042)]
+    )
+
+    usage = GeminiClient._extract_usage(SimpleNamespace(usage_metadata=metadata))
+
+    assert usage == {
+        "prompt_tokens": 1300, "completion_tokens": 70, "total_tokens": 1370,
+        "prompt_cache_hit_tokens": 1000, "prompt_cache_miss_tokens": 300,
+        "image_tokens": 258, "reasoning_tokens": 20,
+    }
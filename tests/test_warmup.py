@@ -0,0 +1,54 @@
+"""预热任务测试"""
+
+import threading
+
+from utils.warmup import WarmupManager
+
+
+def test_same_key_is_warmed_up_once():
+    manager = WarmupManager()
+    calls = []
+
+    def warm_up():
+        calls.append(1)
+        return {"success": True, "steps": {"tls": 5.0}, "error": None}
+
+    assert manager.submit("deepseek", "deepseek:abc", warm_up) is True
+    assert manager.submit("deepseek", "deepseek:abc", warm_up) is False
+    assert manager.wait(5)
+    assert len(calls) == 1
+
+    result = manager.results()["deepseek"]
+    assert result["success"] is True
+    assert result["elapsed_ms"] >= 0
+    assert result["finished_at"] is not None
+
+
+def test_pending_counts_unfinished_tasks():
+    gate = threading.Event()
+    manager = WarmupManager()
+
+    def warm_up():
+        gate.wait(5)
+        return {"success": True, "steps": {}, "error": None}
+
+    manager.submit("gemini", "gemini:1", warm_up)
+    assert manager.pending() == 1
+    assert manager.results() == {}
+
+    gate.set()
+    assert manager.wait(5)
+    assert manager.pending() == 0
+
+
+def test_failure_is_recorded_not_raised():
+    manager = WarmupManager()
+
+    def warm_up():
+        raise ConnectionError("proxy refused")
+
+    manager.submit("feishu", "feishu:x", warm_up)
+    assert manager.wait(5)
+    result = manager.results()["feishu"]
+    assert result["success"] is False
+    assert "proxy refused" in result["error"]
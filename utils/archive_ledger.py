@@ -0,0 +1,111 @@
+"""
+归档台账模块
+记录已成功写入飞书多维表格的记录键，避免重复保存同一轮对话
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, List, Iterable
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+
+class ArchiveLedger:
+    """已归档记录键的本地台账（内存索引 + 可选 JSONL 追加日志）"""
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        初始化台账
+
+        Args:
+            path: JSONL 文件路径；为 None 时仅保存在内存中
+        """
+        self.path = path
+        self._entries: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+
+        if path:
+            self._load()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        获取已归档记录的飞书 record_id
+
+        Args:
+            key: 记录键
+
+        Returns:
+            Optional[str]: record_id，未归档或未知时返回 None
+        """
+        return self._entries.get(key)
+
+    def missing(self, keys: Iterable[str]) -> List[str]:
+        """
+        筛选出尚未归档的记录键
+
+        Args:
+            keys: 记录键列表
+
+        Returns:
+            List[str]: 未归档的记录键（保持原顺序）
+        """
+        return [key for key in keys if key not in self._entries]
+
+    def mark(self, keys: List[str], record_ids: Optional[List[Optional[str]]] = None):
+        """
+        标记记录键为已归档
+
+        Args:
+            keys: 记录键列表
+            record_ids: 与 keys 一一对应的飞书 record_id（可选）
+        """
+        record_ids = list(record_ids or [])
+        record_ids += [None] * (len(keys) - len(record_ids))
+        now = int(time.time())
+
+        with self._lock:
+            new_entries = [
+                (key, record_id) for key, record_id in zip(keys, record_ids)
+                if key not in self._entries
+            ]
+            for key, record_id in new_entries:
+                self._entries[key] = record_id
+
+            if self.path and new_entries:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        for key, record_id in new_entries:
+                            f.write(json.dumps(
+                                {"key": key, "record_id": record_id, "ts": now},
+                                ensure_ascii=False
+                            ) + "\n")
+                except OSError as e:
+                    logger.warning(f"写入归档台账失败（仅保留内存记录）: {e}")
+
+    def _load(self):
+        """从 JSONL 文件加载台账（忽略损坏的行）"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self._entries[entry["key"]] = entry.get("record_id")
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+        logger.info(f"已加载归档台账，共 {len(self._entries)} 条记录")
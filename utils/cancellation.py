@@ -0,0 +1,168 @@
+"""
+取消令牌模块
+用于中止进行中的生成：界面的停止按钮触发取消，客户端收到后立即关闭上游连接
+"""
+
+import logging
+import socket
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Any, Iterator, List, Optional
+
+from utils.tokens import estimate_tokens
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+
+class CancelToken:
+    """线程安全的取消令牌"""
+
+    def __init__(self):
+        """初始化取消令牌"""
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        """是否已取消"""
+        return self._event.is_set()
+
+    def cancel(self):
+        """取消（重复调用无副作用），并依次执行已注册的回调"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._run(callback)
+
+    def add_callback(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        注册取消时执行的回调（例如关闭上游流），已取消时立即执行
+
+        Args:
+            callback: 无参回调
+
+        Returns:
+            Callable: 调用后注销该回调
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        self._run(callback)
+        return lambda: None
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待取消
+
+        Args:
+            timeout: 最长等待时间（秒）
+
+        Returns:
+            bool: 是否已取消
+        """
+        return self._event.wait(timeout)
+
+    def _remove(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    @staticmethod
+    def _run(callback: Callable[[], None]):
+        try:
+            callback()
+        except Exception as e:
+            logger.debug(f"取消回调执行失败: {e}")
+
+
+def close_response(response) -> None:
+    """
+    从其他线程关闭 httpx 流式响应
+
+    只调用 response.close() 不会打断其他线程中正在阻塞的读取（要等到下一个分块到达），
+    HTTP/1.1 连接先关闭底层 socket，读取立即返回（该连接随之从连接池中丢弃）；
+    HTTP/2 连接由多个请求共用，只关闭响应。
+
+    Args:
+        response: httpx.Response
+    """
+    if getattr(response, "http_version", None) == "HTTP/1.1":
+        network_stream = response.extensions.get("network_stream")
+        sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError as e:
+                logger.debug(f"关闭 socket 失败: {e}")
+    response.close()
+
+
+# 当前线程中正在等待取消的令牌（closing_responses 可嵌套）
+_scopes = threading.local()
+
+
+@contextmanager
+def closing_responses(cancel_token: Optional[CancelToken]) -> Iterator[None]:
+    """
+    在该范围内、当前线程发出的 httpx 请求的响应会在取消时被关闭
+
+    用于 SDK 不暴露底层响应的流式接口（例如 google-genai）：httpx 客户端需注册 response_hook。
+    从其他线程关闭响应后，阻塞中的读取会立即返回。
+
+    Args:
+        cancel_token: 取消令牌，None 时不做任何处理
+    """
+    if cancel_token is None:
+        yield
+        return
+    stack = getattr(_scopes, "stack", None)
+    if stack is None:
+        stack = _scopes.stack = []
+    scope = {"token": cancel_token, "unregister": []}
+    stack.append(scope)
+    try:
+        yield
+    finally:
+        stack.remove(scope)
+        for unregister in scope["unregister"]:
+            unregister()
+
+
+def response_hook(response) -> None:
+    """
+    httpx 的 response 事件钩子（收到响应头、尚未读取响应体时调用），
+    当前线程处于 closing_responses 范围内时，取消令牌触发后关闭该响应
+
+    Args:
+        response: httpx.Response
+    """
+    stack = getattr(_scopes, "stack", None)
+    if stack:
+        scope = stack[-1]
+        scope["unregister"].append(scope["token"].add_callback(lambda: close_response(response)))
+
+
+def partial_usage(prompt_tokens: int, content: str) -> Dict[str, Any]:
+    """
+    估算被中止的生成已消耗的 token（上游只在正常结束时返回用量）
+
+    Args:
+        prompt_tokens: 提示词的估算 token 数
+        content: 已生成的部分内容
+
+    Returns:
+        Dict: 与客户端 usage 格式一致，并带有 estimated=True 标记
+    """
+    completion_tokens = estimate_tokens(content)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "estimated": True
+    }
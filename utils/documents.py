@@ -0,0 +1,433 @@
+"""
+文档导入与摘要模块
+流式读取 txt / markdown / PDF 文本，按 token 预算切块，
+并发调用 DeepSeek 生成分块摘要（map），再逐层合并为最终摘要（reduce）
+"""
+
+import codecs
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from utils.governor import RequestGovernor, key_fingerprint
+from utils.shared_cache import SharedCache
+from utils.tokens import estimate_tokens, truncate_to_tokens
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTENSIONS = ("txt", "md", "markdown", "pdf")
+
+# 提示词版本变化时缓存自动失效
+_PROMPT_VERSION = "v1"
+
+# 共享缓存中摘要的有效期（秒）
+SUMMARY_SHARED_TTL = 30 * 24 * 3600
+
+MAP_PROMPT = (
+    "你是文档摘要助手。请用中文概括下面这段文档片段的要点，保留关键事实、数据、结论和术语，"
+    "不要添加片段中没有的信息。使用简洁的条目列表。"
+)
+REDUCE_PROMPT = (
+    "你是文档摘要助手。下面是同一文档中连续若干部分的摘要，请将它们合并为一份连贯的中文摘要，"
+    "去除重复内容，保留关键事实、数据和结论，按主题组织。"
+)
+
+
+def iter_document_text(source, filename: str, block_size: int = 64 * 1024) -> Iterator[str]:
+    """
+    流式读取文档文本
+
+    Args:
+        source: 文件对象（需支持 read）或文件路径
+        filename: 文件名（用于判断类型）
+        block_size: 文本文件每次读取的字节数
+
+    Yields:
+        str: 文本片段（PDF 为逐页文本）
+    """
+    extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else "txt"
+    if extension not in SUPPORTED_EXTENSIONS:
+        raise ValueError(f"不支持的文档类型: .{extension}")
+
+    stream = open(source, "rb") if isinstance(source, str) else source
+    try:
+        if extension == "pdf":
+            yield from _iter_pdf_pages(stream)
+            return
+
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            block = stream.read(block_size)
+            if not block:
+                break
+            text = decoder.decode(block)
+            if text:
+                yield text
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+    finally:
+        if isinstance(source, str):
+            stream.close()
+
+
+def _iter_pdf_pages(stream) -> Iterator[str]:
+    """逐页提取 PDF 文本（需要安装 pypdf）"""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise ImportError("读取 PDF 需要安装 pypdf: pip install pypdf")
+
+    reader = PdfReader(stream)
+    for page in reader.pages:
+        text = page.extract_text() or ""
+        if text.strip():
+            yield text + "\n\n"
+
+
+def chunk_text(pieces: Iterable[str], max_tokens: int = 1500) -> Iterator[str]:
+    """
+    将流式文本按段落切分为不超过 token 预算的块
+
+    Args:
+        pieces: 文本片段迭代器
+        max_tokens: 每块的 token 上限
+
+    Yields:
+        str: 文本块
+    """
+    buffer = ""
+    current: List[str] = []
+    current_tokens = 0
+
+    def paragraphs() -> Iterator[str]:
+        nonlocal buffer
+        for piece in pieces:
+            buffer += piece
+            parts = buffer.split("\n\n")
+            # 最后一段可能不完整，留到下一个片段
+            buffer = parts.pop()
+            for part in parts:
+                if part.strip():
+                    yield part.strip()
+        if buffer.strip():
+            yield buffer.strip()
+
+    for paragraph in paragraphs():
+        tokens = estimate_tokens(paragraph)
+        if tokens > max_tokens:
+            # 超长段落单独按预算切开
+            if current:
+                yield "\n\n".join(current)
+                current, current_tokens = [], 0
+            while paragraph:
+                head = truncate_to_tokens(paragraph, max_tokens)
+                yield head
+                paragraph = paragraph[len(head):].lstrip()
+            continue
+        if current and current_tokens + tokens > max_tokens:
+            yield "\n\n".join(current)
+            current, current_tokens = [], 0
+        current.append(paragraph)
+        current_tokens += tokens
+
+    if current:
+        yield "\n\n".join(current)
+
+
+class SummaryCache:
+    """分块摘要缓存（内存索引 + 可选 JSONL 追加日志 + 可选跨进程共享缓存），相同内容再次导入时直接复用"""
+
+    def __init__(self, path: Optional[str] = None, shared: Optional[SharedCache] = None):
+        """
+        初始化缓存
+
+        Args:
+            path: JSONL 文件路径；为 None 时仅保存在内存中
+            shared: 跨进程共享缓存，其他工作进程生成的摘要也能命中
+        """
+        self.path = path
+        self.shared = shared
+        self._entries: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self._entries[entry["key"]] = entry["summary"]
+                    except (json.JSONDecodeError, KeyError):
+                        continue
+
+    def get(self, key: str) -> Optional[str]:
+        summary = self._entries.get(key)
+        if summary is None and self.shared is not None:
+            value = self.shared.get(f"summary:{key}")
+            if value is not None:
+                summary = value.decode("utf-8")
+                with self._lock:
+                    self._entries.setdefault(key, summary)
+        return summary
+
+    def set(self, key: str, summary: str):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = summary
+            if self.path:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"key": key, "summary": summary}, ensure_ascii=False) + "\n")
+        if self.shared is not None:
+            self.shared.set(f"summary:{key}", summary.encode("utf-8"), ttl=SUMMARY_SHARED_TTL, only_new=True)
+
+
+class DocumentSummarizer:
+    """分块 map-reduce 文档摘要"""
+
+    def __init__(self,
+                 client,
+                 model: str = "deepseek-chat",
+                 chunk_tokens: int = 1500,
+                 summary_tokens: int = 500,
+                 max_workers: int = 4,
+                 reduce_fan_in: int = 6,
+                 max_continuations: int = 1,
+                 cache: Optional[SummaryCache] = None,
+                 governor: Optional[RequestGovernor] = None,
+                 session_id: Optional[str] = None):
+        """
+        初始化摘要器
+
+        Args:
+            client: DeepSeekClient 实例
+            model: 使用的模型
+            chunk_tokens: 每块原文的 token 上限
+            summary_tokens: 每次摘要的 max_tokens
+            max_workers: 并发请求数上限
+            reduce_fan_in: 每次合并的摘要数量上限
+            max_continuations: 摘要因长度限制被截断时自动续写的次数（仍被截断的摘要不写入缓存）
+            cache: 分块摘要缓存
+            governor: 配额与并发控制器（可选）：整篇文档作为一次请求准入（按估算的总 token 数），
+                      占用会话和 API Key 的一个并发名额，文档内的分块仍按 max_workers 并发
+            session_id: 发起摘要的会话 ID，配置了 governor 时必须提供
+        """
+        self.client = client
+        self.model = model
+        self.chunk_tokens = chunk_tokens
+        self.summary_tokens = summary_tokens
+        self.max_workers = max_workers
+        self.reduce_fan_in = reduce_fan_in
+        self.max_continuations = max_continuations
+        self.cache = cache or SummaryCache()
+        self.governor = governor
+        self.session_id = session_id
+
+    def summarize(self,
+                  source,
+                  filename: str,
+                  instruction: Optional[str] = None,
+                  on_progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """
+        生成文档摘要
+
+        Args:
+            source: 文件对象或路径
+            filename: 文件名
+            instruction: 额外要求（例如关注的问题），会附加到合并阶段的提示词中
+            on_progress: 进度回调，参数为 {"stage", "done", "total", "level"}，在调用线程中执行
+
+        Returns:
+            Dict 包含 success、content（最终摘要）、chunks、levels、cached、truncated（被截断的摘要数）、
+            usage 和 elapsed
+        """
+        start = time.time()
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+        try:
+            chunks = list(chunk_text(iter_document_text(source, filename), self.chunk_tokens))
+        except Exception as e:
+            logger.error(f"读取文档失败: {e}")
+            return {"success": False, "error": f"读取文档失败: {e}", "content": None}
+
+        if not chunks:
+            return {"success": False, "error": "文档中没有可提取的文本", "content": None}
+
+        logger.info(f"文档 {filename} 切分为 {len(chunks)} 块")
+
+        ticket = None
+        if self.governor is not None and self.session_id is not None:
+            admission = self.governor.acquire(
+                self.session_id,
+                f"deepseek:{key_fingerprint(getattr(self.client, 'api_key', None))}",
+                estimated_tokens=self._estimate_tokens(chunks)
+            )
+            if not admission["success"]:
+                return {"success": False, "error": admission["error"], "content": None,
+                        "chunks": len(chunks), "usage": usage, "elapsed": time.time() - start}
+            ticket = admission["ticket"]
+        try:
+            return self._summarize_chunks(chunks, instruction, on_progress, usage, start)
+        finally:
+            if ticket is not None:
+                self.governor.release(ticket, usage["total_tokens"])
+
+    def _summarize_chunks(self,
+                          chunks: List[str],
+                          instruction: Optional[str],
+                          on_progress: Optional[Callable[[Dict[str, Any]], None]],
+                          usage: Dict[str, int],
+                          start: float) -> Dict[str, Any]:
+        """map-reduce 摘要已切分的文本块（usage 原地累加）"""
+        cached = 0
+        truncated = 0
+
+        # map：并发摘要每个分块
+        summaries, map_stats = self._run_level(chunks, MAP_PROMPT, "map", 0, on_progress)
+        cached += map_stats["cached"]
+        truncated += map_stats["truncated"]
+        self._add_usage(usage, map_stats["usage"])
+        if map_stats["failed"]:
+            return self._failed(map_stats, usage, len(chunks), start)
+
+        # reduce：逐层合并，直到只剩一份摘要
+        level = 0
+        reduce_prompt = REDUCE_PROMPT + (f"\n\n用户的要求：{instruction}" if instruction else "")
+        while len(summaries) > 1 or (level == 0 and instruction):
+            level += 1
+            groups = self._group(summaries)
+            summaries, stats = self._run_level(groups, reduce_prompt, "reduce", level, on_progress)
+            cached += stats["cached"]
+            truncated += stats["truncated"]
+            self._add_usage(usage, stats["usage"])
+            if stats["failed"]:
+                return self._failed(stats, usage, len(chunks), start)
+
+        elapsed = time.time() - start
+        logger.info(f"文档摘要完成: {len(chunks)} 块，{level} 层合并，缓存命中 {cached} 次，"
+                    f"截断 {truncated} 次，耗时 {elapsed:.1f}s")
+        return {
+            "success": True,
+            "content": summaries[0],
+            "model": self.model,
+            "chunks": len(chunks),
+            "levels": level,
+            "cached": cached,
+            "truncated": truncated,
+            "usage": usage,
+            "elapsed": elapsed
+        }
+
+    def _run_level(self, texts: List[str], system_prompt: str, stage: str, level: int,
+                   on_progress: Optional[Callable[[Dict[str, Any]], None]]) -> tuple:
+        """并发处理一层，结果保持原顺序"""
+        results: List[Optional[str]] = [None] * len(texts)
+        stats = {"cached": 0, "failed": 0, "truncated": 0, "error": None,
+                 "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}}
+        pending = []
+
+        for i, text in enumerate(texts):
+            summary = self.cache.get(self._cache_key(system_prompt, text))
+            if summary is not None:
+                results[i] = summary
+                stats["cached"] += 1
+            else:
+                pending.append(i)
+
+        done = len(texts) - len(pending)
+        self._report(on_progress, stage, done, len(texts), level)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"doc-{stage}")
+        try:
+            futures = {executor.submit(self._summarize_one, system_prompt, texts[i]): i for i in pending}
+            for future in as_completed(futures):
+                i = futures[future]
+                result = future.result()
+                if result.get("success"):
+                    results[i] = result["content"]
+                    if result.get("finish_reason") == "length":
+                        # 续写后仍被截断：本次照常使用，但不缓存，下次导入时重新生成
+                        stats["truncated"] += 1
+                        logger.warning(f"{stage} 摘要因长度限制被截断，不写入缓存")
+                    else:
+                        self.cache.set(self._cache_key(system_prompt, texts[i]), result["content"])
+                    self._add_usage(stats["usage"], result.get("usage") or {})
+                else:
+                    stats["failed"] += 1
+                    stats["error"] = result.get("error")
+                done += 1
+                self._report(on_progress, stage, done, len(texts), level)
+        finally:
+            # 调用方中断（例如界面重新运行）时不再发起尚未开始的请求
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return results, stats
+
+    def _summarize_one(self, system_prompt: str, text: str) -> Dict[str, Any]:
+        """调用 DeepSeek 摘要一段文本"""
+        try:
+            return self.client.get_response(
+                text,
+                model=self.model,
+                system_prompt=system_prompt,
+                temperature=0.3,
+                max_tokens=self.summary_tokens,
+                max_continuations=self.max_continuations
+            )
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def _group(self, summaries: List[str]) -> List[str]:
+        """将相邻摘要分组合并为下一层的输入（受数量和 token 预算限制）"""
+        groups, current, current_tokens = [], [], 0
+        for summary in summaries:
+            tokens = estimate_tokens(summary)
+            if current and (len(current) >= self.reduce_fan_in or current_tokens + tokens > self.chunk_tokens * 2):
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(summary)
+            current_tokens += tokens
+        if current:
+            groups.append(current)
+        return [
+            "\n\n".join(f"【第 {i + 1} 部分】\n{summary}" for i, summary in enumerate(group))
+            for group in groups
+        ]
+
+    def _estimate_tokens(self, chunks: List[str]) -> int:
+        """整篇文档摘要的估算 token 数：每块原文 + 提示词 + 摘要，合并阶段再读写一遍各块摘要"""
+        prompt_tokens = estimate_tokens(MAP_PROMPT)
+        map_tokens = sum(prompt_tokens + estimate_tokens(chunk) + self.summary_tokens for chunk in chunks)
+        return map_tokens + 2 * self.summary_tokens * len(chunks)
+
+    def _cache_key(self, system_prompt: str, text: str) -> str:
+        raw = f"{_PROMPT_VERSION}\x1f{self.model}\x1f{self.summary_tokens}\x1f{system_prompt}\x1f{text}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _failed(self, stats: Dict[str, Any], usage: Dict[str, int], chunks: int, start: float) -> Dict[str, Any]:
+        return {
+            "success": False,
+            "error": f"{stats['failed']} 个分块摘要失败（已完成的部分已缓存，可重试）: {stats['error']}",
+            "content": None,
+            "chunks": chunks,
+            "usage": usage,
+            "elapsed": time.time() - start
+        }
+
+    @staticmethod
+    def _add_usage(total: Dict[str, int], usage: Dict[str, Any]):
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            total[key] += usage.get(key) or 0
+
+    @staticmethod
+    def _report(on_progress, stage: str, done: int, total: int, level: int):
+        if on_progress is not None:
+            on_progress({"stage": stage, "done": done, "total": total, "level": level})
@@ -0,0 +1,379 @@
+"""
+配额与并发控制模块
+在 Router 之前按会话和 API Key 限制并发数与时间窗口内的 token 用量，
+超出并发上限的请求按优先级公平排队
+"""
+
+import hashlib
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, Any, Optional, Callable, Deque, List, Tuple
+
+from utils.metrics import metrics
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+
+def key_fingerprint(api_key: Optional[str]) -> str:
+    """
+    API Key 的指纹（不在内存中保存明文 Key 作为统计键）
+
+    Args:
+        api_key: API Key
+
+    Returns:
+        str: 指纹字符串，Key 为空时返回 "anonymous"
+    """
+    if not api_key:
+        return "anonymous"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+class Ticket:
+    """一次请求的准入凭据"""
+
+    def __init__(self, session_id: str, key_id: str, priority: int, estimated_tokens: int, seq: int):
+        self.session_id = session_id
+        self.key_id = key_id
+        self.priority = priority
+        self.estimated_tokens = estimated_tokens
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.granted_at: Optional[float] = None
+
+    @property
+    def waited(self) -> float:
+        """排队等待时间（秒）"""
+        end = self.granted_at if self.granted_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+
+class _Window:
+    """滑动时间窗口内的 token 用量"""
+
+    def __init__(self):
+        self.events: Deque[Tuple[float, int]] = deque()
+        self.total = 0
+
+    def prune(self, now: float, window: float):
+        while self.events and self.events[0][0] <= now - window:
+            self.total -= self.events.popleft()[1]
+
+    def add(self, now: float, tokens: int):
+        self.events.append((now, tokens))
+        self.total += tokens
+
+    def retry_after(self, now: float, window: float, needed: int) -> float:
+        """释放出 needed 个 token 额度还需等待的时间"""
+        released = 0
+        for ts, tokens in self.events:
+            released += tokens
+            if released >= needed:
+                return max(0.0, ts + window - now)
+        return window
+
+
+class RequestGovernor:
+    """
+    按会话和 API Key 的并发与配额控制器
+
+    - 每个会话、每个 API Key 的并发请求数有上限，超出后排队；
+    - 排队按优先级、会话在当前窗口内的用量（用量少的会话优先）和到达顺序排序，
+      队首请求所属的会话或 Key 没有空闲并发时跳过它，避免队头阻塞；
+    - 会话和 Key 在时间窗口内的 token 用量超出预算时直接拒绝，并给出可重试时间；
+      准入时预留估算用量，结束时按实际用量结算，避免并发请求同时通过预算检查；
+    - 排队时间超过上限或队列已满时拒绝，保证尾延迟可预期。
+    """
+
+    def __init__(self,
+                 per_session_concurrency: int = 1,
+                 per_key_concurrency: int = 4,
+                 session_token_budget: Optional[int] = 200_000,
+                 key_token_budget: Optional[int] = 2_000_000,
+                 window_seconds: float = 3600.0,
+                 max_queue_wait: float = 60.0,
+                 max_queue_length: int = 100):
+        """
+        初始化控制器
+
+        Args:
+            per_session_concurrency: 单个会话的最大并发请求数
+            per_key_concurrency: 单个 API Key 的最大并发请求数
+            session_token_budget: 单个会话在时间窗口内的 token 预算（None 表示不限制）
+            key_token_budget: 单个 API Key 在时间窗口内的 token 预算（None 表示不限制）
+            window_seconds: 预算的滑动时间窗口（秒）
+            max_queue_wait: 最长排队时间（秒）
+            max_queue_length: 最大排队请求数
+        """
+        self.per_session_concurrency = per_session_concurrency
+        self.per_key_concurrency = per_key_concurrency
+        self.session_token_budget = session_token_budget
+        self.key_token_budget = key_token_budget
+        self.window_seconds = window_seconds
+        self.max_queue_wait = max_queue_wait
+        self.max_queue_length = max_queue_length
+
+        self._active_sessions: Dict[str, int] = {}
+        self._active_keys: Dict[str, int] = {}
+        self._session_usage: Dict[str, _Window] = {}
+        self._key_usage: Dict[str, _Window] = {}
+        # 已准入（含排队中）但尚未结束的请求预留的估算用量
+        self._session_reserved: Dict[str, int] = {}
+        self._key_reserved: Dict[str, int] = {}
+        # 定期清理窗口内已无用量的会话和 Key，避免长期运行时无限增长
+        self._sweep_interval = min(60.0, window_seconds)
+        self._last_sweep = time.monotonic()
+        # 排队的请求：(-优先级, 会话用量, 序号, Ticket)
+        self._queue: List[Tuple[int, int, int, Ticket]] = []
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self,
+                session_id: str,
+                key_id: str,
+                priority: int = 0,
+                estimated_tokens: int = 0,
+                timeout: Optional[float] = None,
+                on_wait: Optional[Callable[[Dict[str, Any]], None]] = None,
+                poll_interval: float = 0.5) -> Dict[str, Any]:
+        """
+        申请执行一次请求（必要时排队等待）
+
+        Args:
+            session_id: 会话 ID
+            key_id: API Key 指纹（见 key_fingerprint）
+            priority: 优先级，数值越大越优先
+            estimated_tokens: 估算的 token 用量，用于预算检查
+            timeout: 最长排队时间（秒），默认为 max_queue_wait
+            on_wait: 排队期间定期回调，参数为 {"position", "waited", "queue_length"}
+            poll_interval: 回调间隔（秒）
+
+        Returns:
+            Dict: 成功时包含 success=True、ticket、waited 和 position；
+                  被拒绝时包含 success=False、error、reason 和 retry_after
+        """
+        timeout = self.max_queue_wait if timeout is None else timeout
+        labels = {"reason": ""}
+
+        with self._condition:
+            now = time.monotonic()
+            self._evict_idle(now)
+            rejection = self._check_budget(session_id, key_id, estimated_tokens, now)
+            if rejection:
+                labels["reason"] = rejection["reason"]
+                metrics.increment("governor.rejected", labels=labels)
+                return rejection
+
+            ticket = Ticket(session_id, key_id, priority, estimated_tokens, next(self._seq))
+            immediate = not self._queue and self._has_capacity(session_id, key_id)
+            if not immediate and len(self._queue) >= self.max_queue_length:
+                labels["reason"] = "queue_full"
+                metrics.increment("governor.rejected", labels=labels)
+                return self._rejected("queue_full", "当前请求过多，请稍后再试", retry_after=self.max_queue_wait / 2)
+
+            self._reserve(ticket, 1)
+            if immediate:
+                self._grant(ticket)
+                return self._admitted(ticket, position=0)
+
+            heapq.heappush(self._queue, (-priority, self._usage(self._session_usage, session_id, now),
+                                         ticket.seq, ticket))
+            metrics.set_gauge("governor.queue_length", len(self._queue))
+            self._dispatch()
+
+            deadline = ticket.enqueued_at + timeout
+            while ticket.granted_at is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._remove(ticket)
+                    self._reserve(ticket, -1)
+                    labels["reason"] = "queue_timeout"
+                    metrics.increment("governor.rejected", labels=labels)
+                    return self._rejected("queue_timeout", f"排队超过 {timeout:.0f} 秒，请稍后再试",
+                                          retry_after=poll_interval)
+                if on_wait is not None:
+                    status = {"position": self._position(ticket), "waited": ticket.waited,
+                              "queue_length": len(self._queue)}
+                    # 回调可能较慢（例如刷新界面），不持有锁
+                    self._condition.release()
+                    try:
+                        on_wait(status)
+                    finally:
+                        self._condition.acquire()
+                    if ticket.granted_at is not None:
+                        break
+                self._condition.wait(min(poll_interval, remaining))
+
+            return self._admitted(ticket, position=None)
+
+    def release(self, ticket: Ticket, tokens_used: Optional[int] = None):
+        """
+        请求结束，释放并发名额和预留用量，并记录实际用量
+
+        Args:
+            ticket: acquire 返回的 ticket
+            tokens_used: 实际 token 用量（None 时按估算值记录）
+        """
+        tokens = ticket.estimated_tokens if tokens_used is None else tokens_used
+        with self._condition:
+            now = time.monotonic()
+            self._decrement(self._active_sessions, ticket.session_id)
+            self._decrement(self._active_keys, ticket.key_id)
+            self._reserve(ticket, -1)
+            if tokens:
+                self._session_usage.setdefault(ticket.session_id, _Window()).add(now, tokens)
+                self._key_usage.setdefault(ticket.key_id, _Window()).add(now, tokens)
+            self._dispatch()
+            self._evict_idle(now)
+
+    def session_status(self, session_id: str) -> Dict[str, Any]:
+        """
+        会话的用量与排队状态（用于界面展示）
+
+        Args:
+            session_id: 会话 ID
+
+        Returns:
+            Dict 包含 tokens_used、tokens_reserved、token_budget、active 和 queued
+        """
+        with self._condition:
+            now = time.monotonic()
+            return {
+                "tokens_used": self._usage(self._session_usage, session_id, now),
+                "tokens_reserved": self._session_reserved.get(session_id, 0),
+                "token_budget": self.session_token_budget,
+                "active": self._active_sessions.get(session_id, 0),
+                "queued": sum(1 for *_, t in self._queue if t.session_id == session_id),
+                "queue_length": len(self._queue)
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        全局状态
+
+        Returns:
+            Dict 包含 active（进行中的请求数）和 queue_length
+        """
+        with self._condition:
+            return {
+                "active": sum(self._active_sessions.values()),
+                "queue_length": len(self._queue)
+            }
+
+    # ==================== 内部方法（调用方需持有锁） ====================
+
+    def _check_budget(self, session_id: str, key_id: str, estimated_tokens: int, now: float) -> Optional[Dict[str, Any]]:
+        """检查会话和 Key 的 token 预算（已用量加上进行中请求的预留量）"""
+        checks = (
+            (self._session_usage, self._session_reserved, session_id, self.session_token_budget,
+             "session_budget", "当前会话"),
+            (self._key_usage, self._key_reserved, key_id, self.key_token_budget, "key_budget", "当前 API Key"),
+        )
+        for usage, reserved, owner, budget, reason, label in checks:
+            if budget is None:
+                continue
+            committed = self._usage(usage, owner, now) + reserved.get(owner, 0)
+            if committed + estimated_tokens > budget:
+                window = usage.get(owner)
+                needed = committed + estimated_tokens - budget
+                retry_after = (window.retry_after(now, self.window_seconds, needed)
+                               if window is not None else self.window_seconds)
+                return self._rejected(
+                    reason,
+                    f"{label}的 token 用量已达上限（{committed}/{budget}），请 {retry_after:.0f} 秒后再试",
+                    retry_after=retry_after
+                )
+        return None
+
+    def _reserve(self, ticket: Ticket, sign: int):
+        """预留（sign=1）或归还（sign=-1）请求的估算用量"""
+        if not ticket.estimated_tokens:
+            return
+        for reserved, owner in ((self._session_reserved, ticket.session_id),
+                                (self._key_reserved, ticket.key_id)):
+            amount = reserved.get(owner, 0) + sign * ticket.estimated_tokens
+            if amount > 0:
+                reserved[owner] = amount
+            else:
+                reserved.pop(owner, None)
+
+    def _evict_idle(self, now: float):
+        """移除时间窗口内已没有用量记录的会话和 Key"""
+        if now - self._last_sweep < self._sweep_interval:
+            return
+        self._last_sweep = now
+        for usage in (self._session_usage, self._key_usage):
+            for owner in list(usage):
+                window = usage[owner]
+                window.prune(now, self.window_seconds)
+                if not window.events:
+                    del usage[owner]
+
+    def _usage(self, usage: Dict[str, _Window], owner: str, now: float) -> int:
+        window = usage.get(owner)
+        if window is None:
+            return 0
+        window.prune(now, self.window_seconds)
+        return window.total
+
+    def _has_capacity(self, session_id: str, key_id: str) -> bool:
+        return (self._active_sessions.get(session_id, 0) < self.per_session_concurrency and
+                self._active_keys.get(key_id, 0) < self.per_key_concurrency)
+
+    def _grant(self, ticket: Ticket):
+        ticket.granted_at = time.monotonic()
+        self._active_sessions[ticket.session_id] = self._active_sessions.get(ticket.session_id, 0) + 1
+        self._active_keys[ticket.key_id] = self._active_keys.get(ticket.key_id, 0) + 1
+
+    def _dispatch(self):
+        """按排队顺序放行有空闲名额的请求（跳过暂时没有名额的会话或 Key）"""
+        granted = False
+        waiting = []
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            ticket = entry[3]
+            if self._has_capacity(ticket.session_id, ticket.key_id):
+                self._grant(ticket)
+                metrics.observe("governor.wait_seconds", ticket.waited)
+                granted = True
+            else:
+                waiting.append(entry)
+        for entry in waiting:
+            heapq.heappush(self._queue, entry)
+        metrics.set_gauge("governor.queue_length", len(self._queue))
+        if granted:
+            self._condition.notify_all()
+
+    def _position(self, ticket: Ticket) -> int:
+        """排队位置（从 1 开始）"""
+        for position, entry in enumerate(sorted(self._queue), start=1):
+            if entry[3] is ticket:
+                return position
+        return 0
+
+    def _remove(self, ticket: Ticket):
+        self._queue = [entry for entry in self._queue if entry[3] is not ticket]
+        heapq.heapify(self._queue)
+        metrics.set_gauge("governor.queue_length", len(self._queue))
+
+    @staticmethod
+    def _decrement(counter: Dict[str, int], owner: str):
+        count = counter.get(owner, 0) - 1
+        if count > 0:
+            counter[owner] = count
+        else:
+            counter.pop(owner, None)
+
+    @staticmethod
+    def _admitted(ticket: Ticket, position: Optional[int]) -> Dict[str, Any]:
+        return {"success": True, "ticket": ticket, "waited": ticket.waited, "position": position}
+
+    @staticmethod
+    def _rejected(reason: str, error: str, retry_after: float) -> Dict[str, Any]:
+        logger.info(f"请求被拒绝 ({reason}): {error}")
+        return {"success": False, "reason": reason, "error": error, "retry_after": retry_after, "content": None}
@@ -0,0 +1,119 @@
+"""
+健康检查模块
+在后台线程中并发探测 DeepSeek、Gemini 和飞书（较短的超时、不重试），结果按 TTL 缓存：
+读取时直接返回缓存（过期时返回旧结果并在后台刷新），界面重新运行不会等待探测
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional
+
+from utils.metrics import metrics
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 状态：ok（正常）/ error（失败）/ checking（首次探测尚未完成）
+STATUSES = ("ok", "error", "checking")
+
+
+class HealthMonitor:
+    """进程内共享的健康检查（按服务商 + 凭证 + 代理缓存结果）"""
+
+    def __init__(self, ttl: float = 60.0, error_ttl: float = 15.0, max_workers: int = 4):
+        """
+        初始化健康检查
+
+        Args:
+            ttl: 成功结果的有效期（秒）
+            error_ttl: 失败结果的有效期（秒），较短以便尽快发现恢复
+            max_workers: 并发探测的线程数
+        """
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="health")
+        self._results: Dict[str, Dict[str, Any]] = {}
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def check(self, name: str, key: str, probe: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        读取健康状态（不阻塞），结果不存在或已过期时提交后台探测
+
+        Args:
+            name: 服务名称（deepseek / gemini / feishu），用于指标标签和日志
+            key: 缓存键（例如服务商 + Key 指纹 + 代理地址）
+            probe: 探测函数，返回 {"success", "latency_ms", "error"}
+
+        Returns:
+            Dict 包含 status、latency_ms、error、checked_at 和 stale（是否正在刷新过期结果）
+        """
+        with self._lock:
+            result = self._results.get(key)
+            expired = result is None or time.time() - result["checked_at"] > self._ttl_of(result)
+            if expired and key not in self._inflight:
+                self._inflight[key] = self._executor.submit(self._run, name, key, probe)
+            if result is None:
+                return {"status": "checking", "latency_ms": None, "error": None, "checked_at": None, "stale": False}
+            return dict(result, stale=expired)
+
+    def refresh(self, name: str, key: str, probe: Callable[[], Dict[str, Any]]) -> Future:
+        """
+        立即提交探测（忽略缓存）
+
+        Returns:
+            Future: 探测完成后的结果
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._inflight[key] = self._executor.submit(self._run, name, key, probe)
+            return future
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待进行中的探测完成
+
+        Args:
+            timeout: 最长等待时间（秒）
+
+        Returns:
+            bool: 是否全部完成
+        """
+        with self._lock:
+            futures = list(self._inflight.values())
+        _, not_done = wait(futures, timeout=timeout)
+        return not not_done
+
+    def _ttl_of(self, result: Dict[str, Any]) -> float:
+        return self.ttl if result["status"] == "ok" else self.error_ttl
+
+    def _run(self, name: str, key: str, probe: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            outcome = probe()
+        except Exception as e:
+            outcome = {"success": False, "error": str(e)}
+        latency_ms = outcome.get("latency_ms")
+        if latency_ms is None:
+            latency_ms = (time.perf_counter() - start) * 1000
+
+        result = {
+            "status": "ok" if outcome.get("success") else "error",
+            "latency_ms": latency_ms,
+            "error": outcome.get("error"),
+            "checked_at": time.time(),
+        }
+        labels = {"service": name}
+        metrics.observe("health.latency_ms", latency_ms, labels=labels)
+        metrics.set_gauge("health.up", 1 if result["status"] == "ok" else 0, labels=labels)
+        if result["status"] != "ok":
+            metrics.increment("health.failed", labels=labels)
+            logger.warning(f"{name} 健康检查失败（{latency_ms:.0f}ms）: {result['error']}")
+
+        with self._lock:
+            self._results[key] = result
+            self._inflight.pop(key, None)
+        return result
@@ -0,0 +1,398 @@
+"""
+图片预处理模块
+多张图片在线程池中并行解码、纠正方向、缩放和重新编码，
+并将总大小控制在上限以内，供 Gemini 以内联数据发送；
+ImagePrefetcher 在选择图片后立即于后台预处理并可选预上传，提问时只发送处理结果或文件引用
+"""
+
+import hashlib
+import io
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+from PIL import Image, ImageOps
+
+from utils.shared_cache import SharedCache
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+ImageInput = Union[str, bytes, bytearray, Image.Image, Dict[str, Any]]
+
+# Gemini 内联请求总大小上限为 20MB，预留文本和编码开销
+DEFAULT_MAX_TOTAL_BYTES = 15 * 1024 * 1024
+# 超过该边长的图片会被缩小（Gemini 内部也会缩放到类似尺寸，更大的分辨率只增加传输量）
+DEFAULT_MAX_SIDE = 2048
+# 每张图片大致占用的输入 token 数
+IMAGE_TOKENS = 258
+
+# 线程池共享（Pillow 解码和编码会释放 GIL）
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="image-prep")
+# 预上传是网络 I/O，使用单独的线程池（上传任务会等待预处理完成，与预处理共用线程池可能互相阻塞）
+_upload_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image-upload")
+# Gemini Files API 的文件保留 48 小时，提前失效以免引用过期文件
+UPLOAD_TTL = 47 * 3600
+# 共享缓存中预处理结果的有效期（秒）
+PREPARED_SHARED_TTL = 24 * 3600
+
+
+def as_image_list(image_input: Optional[Union[ImageInput, Sequence[ImageInput]]]) -> List[ImageInput]:
+    """
+    将单张或多张图片输入统一为列表
+
+    Args:
+        image_input: 图片输入（单张、列表或 None）
+
+    Returns:
+        List: 图片列表（无图片时为空列表）
+    """
+    if image_input is None:
+        return []
+    if isinstance(image_input, (list, tuple)):
+        return [image for image in image_input if image is not None]
+    return [image_input]
+
+
+def prepare_images(images: Sequence[ImageInput],
+                   max_total_bytes: int = DEFAULT_MAX_TOTAL_BYTES,
+                   max_side: int = DEFAULT_MAX_SIDE,
+                   quality: int = 85) -> List[Dict[str, Any]]:
+    """
+    并行预处理多张图片
+
+    小于尺寸上限的 JPEG/PNG/WebP 原样保留，其余图片缩放后重新编码为 JPEG（带透明通道的为 PNG）。
+    总大小超出上限时，按比例逐轮缩小最大的图片，直到满足上限。
+
+    Args:
+        images: 图片列表（路径、字节数据或 PIL Image）
+        max_total_bytes: 所有图片编码后的总大小上限
+        max_side: 最长边上限（像素）
+        quality: JPEG 编码质量
+
+    Returns:
+        List[Dict]: 每张图片包含 data、mime_type、width、height 和 original_bytes
+    """
+    if not images:
+        return []
+
+    prepared = list(_executor.map(lambda image: _prepare_one(image, max_side, quality), images))
+
+    # 总大小超限时逐轮缩小占用最大的图片
+    for _ in range(8):
+        total = sum(len(item["data"]) for item in prepared)
+        if total <= max_total_bytes:
+            break
+        budget = max_total_bytes / len(prepared)
+        oversized = [i for i, item in enumerate(prepared) if len(item["data"]) > budget]
+        if not oversized:
+            oversized = [max(range(len(prepared)), key=lambda i: len(prepared[i]["data"]))]
+        shrunk = _executor.map(
+            lambda i: _shrink(prepared[i], budget / len(prepared[i]["data"]), quality), oversized
+        )
+        for i, item in zip(oversized, shrunk):
+            prepared[i] = item
+    else:
+        logger.warning(f"图片总大小仍超过上限: {sum(len(item['data']) for item in prepared)} 字节")
+
+    logger.info(
+        f"已预处理 {len(prepared)} 张图片: "
+        f"{sum(item['original_bytes'] for item in prepared)} -> {sum(len(item['data']) for item in prepared)} 字节"
+    )
+    return prepared
+
+
+def make_thumbnail(image_input: ImageInput, max_side: int = 400, quality: int = 80) -> bytes:
+    """
+    生成 JPEG 缩略图（用于聊天记录中的图片预览，只需生成一次）
+
+    Args:
+        image_input: 图片输入
+        max_side: 最长边上限（像素）
+        quality: JPEG 编码质量
+
+    Returns:
+        bytes: 缩略图数据
+    """
+    image, _ = _load(image_input)
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def image_digest(image_input: ImageInput) -> str:
+    """
+    图片内容摘要（sha256），用于预处理缓存和请求合并键
+
+    Args:
+        image_input: 图片输入（预处理结果自带 digest）
+
+    Returns:
+        str: 十六进制摘要
+    """
+    if isinstance(image_input, dict):
+        return image_input.get("digest") or hashlib.sha256(image_input.get("data") or b"").hexdigest()
+    _, raw = _load_raw(image_input)
+    return hashlib.sha256(raw).hexdigest()
+
+
+class ImagePrefetcher:
+    """
+    图片预取器（进程内共享）
+
+    上传控件中选择图片后立即提交：后台完成解码、缩放和重新编码，配置了上传函数时再预上传到
+    Gemini Files API。用户输入问题期间这些工作已经完成，提问时 get() 直接返回处理结果
+    （带 file_uri 时请求中只发送文件引用）。同一图片按内容摘要只处理一次；
+    配置了共享缓存时，处理结果和文件引用在多个工作进程之间共用。
+    """
+
+    def __init__(self,
+                 max_entries: int = 32,
+                 max_side: int = DEFAULT_MAX_SIDE,
+                 quality: int = 85,
+                 upload_ttl: float = UPLOAD_TTL,
+                 cache: Optional[SharedCache] = None):
+        """
+        初始化预取器
+
+        Args:
+            max_entries: 最多缓存的图片数，超出时移除最早使用的
+            max_side: 最长边上限（像素），同 prepare_images
+            quality: JPEG 编码质量
+            upload_ttl: 预上传文件引用的有效期（秒）
+            cache: 跨进程共享缓存
+        """
+        self.max_entries = max_entries
+        self.max_side = max_side
+        self.quality = quality
+        self.upload_ttl = upload_ttl
+        self.cache = cache
+        # 摘要 -> {"prepared": Future, "uploads": {上传方标识: (Future, 提交时间)}}，
+        # 上传 Future 的结果为 {"file_uri", "uploaded_at"}
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self,
+               image_input: ImageInput,
+               uploader: Optional[Callable[[bytes, str], str]] = None,
+               upload_key: str = "") -> str:
+        """
+        提交后台预处理（及预上传）
+
+        Args:
+            image_input: 图片输入（Streamlit UploadedFile、字节数据或路径）
+            uploader: 上传函数 (data, mime_type) -> file_uri（例如 GeminiClient.upload_image），None 时只预处理
+            upload_key: 上传方标识（例如 Key 指纹），不同账号上传的文件互不可见
+
+        Returns:
+            str: 图片摘要
+        """
+        image, raw = _load_raw(image_input)
+        digest = hashlib.sha256(raw).hexdigest()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                entry = {
+                    "prepared": _executor.submit(self._prepare, image if image is not None else raw, digest),
+                    "uploads": {}
+                }
+                self._entries[digest] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            self._entries.move_to_end(digest)
+
+            upload = entry["uploads"].get(upload_key)
+            failed = upload is not None and upload[0].done() and upload[0].exception() is not None
+            expired = upload is not None and not failed and self._upload_expired(upload)
+            if uploader is not None and (upload is None or expired or failed):
+                entry["uploads"][upload_key] = (
+                    _upload_executor.submit(self._upload, entry["prepared"], uploader, digest, upload_key),
+                    time.time()
+                )
+        return digest
+
+    def get(self,
+            image_input: ImageInput,
+            upload_key: str = "",
+            timeout: Optional[float] = 30.0) -> Optional[Dict[str, Any]]:
+        """
+        获取预处理结果（仍在处理时等待完成）
+
+        Args:
+            image_input: 图片输入（与 submit 时相同的内容）
+            upload_key: 上传方标识，同 submit
+            timeout: 最长等待时间（秒）
+
+        Returns:
+            Optional[Dict]: 包含 data、mime_type、width、height、original_bytes 和 digest，
+            预上传成功时另有 file_uri；未提交或处理失败时为 None（调用方按原图发送）
+        """
+        digest = image_digest(image_input)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            upload = entry["uploads"].get(upload_key)
+
+        try:
+            prepared = entry["prepared"].result(timeout=timeout)
+        except FutureTimeoutError:
+            logger.warning(f"图片预处理超时: {digest[:12]}")
+            return None
+        except Exception as e:
+            logger.warning(f"图片预处理失败: {e}")
+            return None
+
+        if upload is not None:
+            try:
+                uploaded = upload[0].result(timeout=timeout)
+                if time.time() - uploaded["uploaded_at"] <= self.upload_ttl:
+                    return dict(prepared, file_uri=uploaded["file_uri"])
+                logger.info(f"预上传的文件引用已过期，改为内联发送: {digest[:12]}")
+            except FutureTimeoutError:
+                logger.warning(f"图片预上传超时，改为内联发送: {digest[:12]}")
+            except Exception as e:
+                logger.warning(f"图片预上传失败，改为内联发送: {e}")
+        return prepared
+
+    def _upload_expired(self, upload: tuple) -> bool:
+        """上传是否已过期（完成的上传按实际上传时间计算，共享缓存中的文件引用可能由其他进程较早上传）"""
+        future, submitted_at = upload
+        if future.done():
+            return time.time() - future.result()["uploaded_at"] > self.upload_ttl
+        return time.time() - submitted_at > self.upload_ttl
+
+    def _prepare(self, image_input: ImageInput, digest: str) -> Dict[str, Any]:
+        key = f"image:{digest}:{self.max_side}:{self.quality}"
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.debug(f"使用共享缓存的图片预处理结果: {digest[:12]}")
+                return _unpack_prepared(cached)
+
+        start = time.perf_counter()
+        prepared = dict(_prepare_one(image_input, self.max_side, self.quality), digest=digest)
+        logger.info(f"图片预处理完成: {prepared['original_bytes']} -> {len(prepared['data'])} 字节，"
+                    f"耗时 {(time.perf_counter() - start) * 1000:.0f}ms")
+        if self.cache is not None:
+            self.cache.set(key, _pack_prepared(prepared), ttl=PREPARED_SHARED_TTL)
+        return prepared
+
+    def _upload(self, prepared: Future, uploader: Callable[[bytes, str], str], digest: str,
+                upload_key: str) -> Dict[str, Any]:
+        key = f"image_upload:{upload_key}:{digest}"
+        if self.cache is not None:
+            cached = self.cache.get_json(key)
+            if cached and time.time() - cached["uploaded_at"] <= self.upload_ttl:
+                logger.debug(f"使用共享缓存的图片文件引用: {digest[:12]}")
+                return cached
+
+        item = prepared.result()
+        start = time.perf_counter()
+        uploaded = {"file_uri": uploader(item["data"], item["mime_type"]), "uploaded_at": time.time()}
+        logger.info(f"图片预上传完成: {len(item['data'])} 字节，耗时 {(time.perf_counter() - start) * 1000:.0f}ms")
+        if self.cache is not None:
+            self.cache.set_json(key, uploaded, ttl=self.upload_ttl)
+        return uploaded
+
+
+def _pack_prepared(prepared: Dict[str, Any]) -> bytes:
+    """预处理结果序列化为 JSON 头（除 data 外的字段）+ 换行 + 图片数据"""
+    header = {k: v for k, v in prepared.items() if k != "data"}
+    return json.dumps(header).encode("utf-8") + b"\n" + prepared["data"]
+
+
+def _unpack_prepared(value: bytes) -> Dict[str, Any]:
+    header, data = value.split(b"\n", 1)
+    return dict(json.loads(header), data=data)
+
+
+def _load_raw(image_input: ImageInput) -> tuple:
+    """读取原始字节数据，返回 (PIL Image 或 None, 字节数据)"""
+    if isinstance(image_input, Image.Image):
+        buffer = io.BytesIO()
+        image_input.save(buffer, format="PNG")
+        return image_input, buffer.getvalue()
+    if isinstance(image_input, (bytes, bytearray)):
+        return None, bytes(image_input)
+    if hasattr(image_input, "getvalue"):
+        # Streamlit UploadedFile / BytesIO
+        return None, image_input.getvalue()
+    with open(image_input, "rb") as f:
+        return None, f.read()
+
+
+def _load(image_input: ImageInput) -> tuple:
+    """读取图片，返回 (PIL Image, 原始字节数据或 None)"""
+    if isinstance(image_input, Image.Image):
+        return image_input, None
+    if isinstance(image_input, dict):
+        # 预处理结果（ImagePrefetcher.get）
+        raw = image_input["data"]
+    else:
+        _, raw = _load_raw(image_input)
+    return Image.open(io.BytesIO(raw)), raw
+
+
+def _prepare_one(image_input: ImageInput, max_side: int, quality: int) -> Dict[str, Any]:
+    """预处理单张图片"""
+    image, raw = _load(image_input)
+    original_format = image.format
+    original_bytes = len(raw) if raw is not None else 0
+
+    # EXIF 方向标记（0x0112）不为 1 时需要旋转
+    rotated = image.getexif().get(0x0112, 1) != 1
+    oriented = ImageOps.exif_transpose(image) if rotated else image
+    needs_resize = max(oriented.size) > max_side
+
+    # 常见格式、尺寸合适且无需旋转时直接使用原始数据，避免重新编码
+    if raw is not None and not needs_resize and not rotated and original_format in ("JPEG", "PNG", "WEBP"):
+        return {
+            "data": raw,
+            "mime_type": Image.MIME[original_format],
+            "width": image.width,
+            "height": image.height,
+            "original_bytes": original_bytes
+        }
+
+    if needs_resize:
+        oriented = oriented.copy()
+        oriented.thumbnail((max_side, max_side), Image.LANCZOS)
+    return _encode(oriented, quality, original_bytes)
+
+
+def _shrink(item: Dict[str, Any], ratio: float, quality: int) -> Dict[str, Any]:
+    """按目标大小比例缩小图片（面积与编码大小近似成正比）"""
+    image = Image.open(io.BytesIO(item["data"]))
+    scale = max(0.1, min(0.9, ratio ** 0.5))
+    size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+    resized = image.resize(size, Image.LANCZOS)
+    return _encode(resized, quality, item["original_bytes"])
+
+
+def _encode(image: Image.Image, quality: int, original_bytes: int) -> Dict[str, Any]:
+    """编码为 JPEG（带透明通道时为 PNG）"""
+    buffer = io.BytesIO()
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image.save(buffer, format="PNG", optimize=True)
+        mime_type = "image/png"
+    else:
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+        mime_type = "image/jpeg"
+    return {
+        "data": buffer.getvalue(),
+        "mime_type": mime_type,
+        "width": image.width,
+        "height": image.height,
+        "original_bytes": original_bytes
+    }
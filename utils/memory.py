@@ -0,0 +1,348 @@
+"""
+内存统计模块
+估算每个会话（聊天记录、图片预览、上传的图片）占用的内存，汇总到进程内共享的 MemoryAccountant；
+可选启用 tracemalloc 在后台定期采样分配最多的源文件。
+会话超出预算时先卸载折叠的历史消息（仍保存在会话存储中，可按需重新加载），
+再释放较早消息的图片预览，最后卸载较早的可见消息
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from utils.metrics import metrics
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+def estimate_size(obj: Any) -> int:
+    """
+    估算对象占用的内存（字节）
+
+    递归统计 dict / list / tuple / set 中的元素，bytes、str 和 BytesIO（含 Streamlit UploadedFile）
+    按实际大小计算，PIL Image 按解码后的像素数据计算；其他对象只计对象本身（不跟随属性，
+    避免把共享的连接池、缓存等计入每个会话）。
+
+    Args:
+        obj: 任意对象
+
+    Returns:
+        int: 字节数
+    """
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        if isinstance(item, Image.Image):
+            total += sys.getsizeof(item) + item.width * item.height * len(item.getbands())
+            continue
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return total
+
+
+def message_size(message: Dict[str, Any], cache: Optional[Dict[int, Tuple[int, int]]] = None) -> int:
+    """
+    单条消息的内存估算，按 seq 缓存（消息追加后不再变化，释放图片预览时由 trim_messages 更新）
+
+    Args:
+        message: 消息
+        cache: seq -> (id(消息), 字节数)；同一 seq 对应的消息对象变化时（清空会话后重新编号等）重新估算
+
+    Returns:
+        int: 字节数
+    """
+    seq = message.get("seq")
+    if cache is None or seq is None:
+        return estimate_size(message)
+    cached = cache.get(seq)
+    if cached is not None and cached[0] == id(message):
+        return cached[1]
+    size = estimate_size(message)
+    cache[seq] = (id(message), size)
+    return size
+
+
+def messages_size(messages: List[Dict[str, Any]], cache: Optional[Dict[int, Tuple[int, int]]] = None) -> int:
+    """
+    聊天记录的内存估算，只估算新增的消息
+
+    Args:
+        messages: 会话中的消息列表
+        cache: message_size 的缓存，已不在列表中的消息会被移除
+
+    Returns:
+        int: 字节数
+    """
+    total = sum(message_size(message, cache) for message in messages)
+    if cache is not None and len(cache) > len(messages):
+        current = {message.get("seq") for message in messages}
+        for seq in [seq for seq in cache if seq not in current]:
+            del cache[seq]
+    return total
+
+
+def trim_messages(messages: List[Dict[str, Any]],
+                  budget: int,
+                  reserved: int = 0,
+                  visible: Optional[int] = None,
+                  keep_last: int = 4,
+                  size_cache: Optional[Dict[int, Tuple[int, int]]] = None) -> Dict[str, int]:
+    """
+    将聊天记录裁剪到预算以内（原地修改）
+
+    依次：卸载折叠（不在可见范围内）的消息 -> 从最早的消息开始释放图片预览
+    （保留最后 keep_last 条）-> 卸载较早的可见消息（至少保留 keep_last 条）。
+
+    Args:
+        messages: 会话中的消息列表
+        budget: 会话内存预算（字节）
+        reserved: 不可释放部分（上传的图片等）占用的字节数
+        visible: 当前可见的消息条数，None 表示全部可见
+        keep_last: 始终保留的最近消息数
+        size_cache: message_size 的缓存
+
+    Returns:
+        Dict 包含 unloaded（从列表头部移除的消息数）、previews（释放的图片预览数）和 freed（释放的字节数）
+    """
+    sizes = [message_size(message, size_cache) for message in messages]
+    total = reserved + sum(sizes)
+    result = {"unloaded": 0, "previews": 0, "freed": 0}
+    if total <= budget:
+        return result
+
+    def unload(count):
+        freed = sum(sizes[:count])
+        del messages[:count]
+        del sizes[:count]
+        result["unloaded"] += count
+        result["freed"] += freed
+        return freed
+
+    def oldest(limit):
+        """为回到预算以内需要从头部移除的消息数（不超过 limit）"""
+        count, remaining = 0, total
+        while count < limit and remaining > budget:
+            remaining -= sizes[count]
+            count += 1
+        return count
+
+    # 1. 折叠的消息
+    folded = max(0, len(messages) - visible) if visible is not None else 0
+    count = oldest(min(folded, max(0, len(messages) - keep_last)))
+    if count:
+        total -= unload(count)
+
+    # 2. 图片预览（从最早的消息开始）
+    for i in range(max(0, len(messages) - keep_last)):
+        if total <= budget:
+            break
+        if messages[i].get("image_preview"):
+            messages[i]["image_preview"] = None
+            messages[i]["image_evicted"] = True
+            if size_cache is not None:
+                size_cache.pop(messages[i].get("seq"), None)
+            size = message_size(messages[i], size_cache)
+            total -= sizes[i] - size
+            result["freed"] += sizes[i] - size
+            result["previews"] += 1
+            sizes[i] = size
+
+    # 3. 较早的可见消息
+    count = oldest(max(0, len(messages) - keep_last))
+    if count:
+        unload(count)
+
+    metrics.increment("memory.unloaded_messages", result["unloaded"])
+    metrics.increment("memory.evicted_previews", result["previews"])
+    logger.info(f"会话内存超出预算 {budget / MB:.0f}MB：卸载 {result['unloaded']} 条消息，"
+                f"释放 {result['previews']} 个图片预览，约 {result['freed'] / MB:.1f}MB")
+    return result
+
+
+def process_rss() -> Optional[int]:
+    """当前进程的常驻内存（字节），无法获取时为 None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # 非 Linux 平台只能取到峰值（macOS 单位为字节）
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+
+class MemoryAccountant:
+    """进程内共享的内存统计与预算"""
+
+    def __init__(self,
+                 session_budget: Optional[int] = None,
+                 worker_budget: Optional[int] = None,
+                 trace: bool = False,
+                 sample_interval: float = 60.0,
+                 session_ttl: float = 3600.0,
+                 top: int = 10):
+        """
+        初始化统计器
+
+        Args:
+            session_budget: 单个会话的内存预算（字节），None 表示不限制
+            worker_budget: 整个进程的内存预算（字节），超出时按会话数均分作为每个会话的预算
+            trace: 是否启用 tracemalloc 采样（约增加 10%~30% 的分配开销）
+            sample_interval: tracemalloc 采样间隔（秒）
+            session_ttl: 超过该时间未上报的会话视为已关闭
+            top: 保留分配最多的源文件数
+        """
+        self.session_budget = session_budget
+        self.worker_budget = worker_budget
+        self.sample_interval = sample_interval
+        self.session_ttl = session_ttl
+        self.top = top
+        self._sessions: Dict[str, Dict[str, Any]] = {}
+        self._top_allocations: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        if trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(1)
+            self._thread = threading.Thread(target=self._run, daemon=True, name="memory-sampler")
+            self._thread.start()
+
+    @property
+    def tracing(self) -> bool:
+        return self._thread is not None
+
+    def record_session(self, session_id: str, sizes: Dict[str, int]):
+        """
+        上报会话的内存估算
+
+        Args:
+            session_id: 会话 ID
+            sizes: 各部分（messages、current_images 等）的字节数
+        """
+        now = time.time()
+        with self._lock:
+            self._sessions[session_id] = {"sizes": dict(sizes), "total": sum(sizes.values()), "last_seen": now}
+            self._expire(now)
+            metrics.set_gauge("memory.sessions_bytes", sum(item["total"] for item in self._sessions.values()))
+            metrics.set_gauge("memory.sessions", len(self._sessions))
+
+    def forget_session(self, session_id: str):
+        """移除会话"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def budget_for(self) -> Optional[int]:
+        """
+        会话当前的有效预算
+
+        进程常驻内存超出 worker_budget 时，扣除会话以外的内存（解释器、模块和共享资源）后
+        按活跃会话数均分，与 session_budget 取较小值。
+
+        Returns:
+            Optional[int]: 字节数，None 表示不限制
+        """
+        budget = self.session_budget
+        if self.worker_budget:
+            rss = process_rss()
+            if rss is not None and rss > self.worker_budget:
+                with self._lock:
+                    sessions = max(1, len(self._sessions))
+                    sessions_bytes = sum(item["total"] for item in self._sessions.values())
+                share = max(MB, (self.worker_budget - (rss - sessions_bytes)) // sessions)
+                budget = share if budget is None else min(budget, share)
+        return budget
+
+    def sessions(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        各会话的内存估算（按占用从大到小）
+
+        Args:
+            limit: 最多返回的会话数
+
+        Returns:
+            List[Dict]: 每个会话包含 session_id、total、sizes 和 last_seen
+        """
+        with self._lock:
+            self._expire(time.time())
+            items = [dict(item, session_id=session_id) for session_id, item in self._sessions.items()]
+        items.sort(key=lambda item: item["total"], reverse=True)
+        return items[:limit] if limit else items
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        进程内存概况
+
+        Returns:
+            Dict 包含 rss_bytes、sessions、sessions_bytes、worker_budget、over_budget，
+            启用 tracemalloc 时另有 traced_bytes、traced_peak_bytes 和 top_allocations
+        """
+        rss = process_rss()
+        with self._lock:
+            self._expire(time.time())
+            result = {
+                "rss_bytes": rss,
+                "sessions": len(self._sessions),
+                "sessions_bytes": sum(item["total"] for item in self._sessions.values()),
+                "worker_budget": self.worker_budget,
+                "over_budget": bool(self.worker_budget and rss and rss > self.worker_budget),
+            }
+            if self.tracing:
+                result["traced_bytes"], result["traced_peak_bytes"] = tracemalloc.get_traced_memory()
+                result["top_allocations"] = list(self._top_allocations)
+        return result
+
+    def close(self):
+        """停止后台采样"""
+        self._stop.set()
+
+    def _expire(self, now: float):
+        for session_id in [sid for sid, item in self._sessions.items() if now - item["last_seen"] > self.session_ttl]:
+            del self._sessions[session_id]
+
+    def _run(self):
+        while not self._stop.wait(self.sample_interval):
+            try:
+                self._sample()
+            except Exception as e:
+                logger.warning(f"内存采样失败: {e}")
+
+    def _sample(self):
+        start = time.perf_counter()
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().statistics("filename")[:self.top]
+        top = [
+            {"file": str(stat.traceback[0].filename), "size": stat.size, "count": stat.count}
+            for stat in statistics
+        ]
+        with self._lock:
+            self._top_allocations = top
+        metrics.set_gauge("memory.traced_bytes", current)
+        metrics.set_gauge("memory.traced_peak_bytes", peak)
+        rss = process_rss()
+        if rss is not None:
+            metrics.set_gauge("memory.rss_bytes", rss)
+        logger.debug(f"内存采样完成，耗时 {(time.perf_counter() - start) * 1000:.0f}ms")
@@ -0,0 +1,115 @@
+"""
+运行指标模块
+进程内的轻量级计数器、仪表和统计摘要，供各客户端和工具模块上报
+"""
+
+import threading
+from typing import Dict, Any, Optional
+
+
+def _metric_key(name: str, labels: Optional[Dict[str, str]] = None) -> str:
+    """生成带标签的指标键，例如 retry.retries{provider=feishu}"""
+    if not labels:
+        return name
+    label_text = ",".join(f"{k}={v}" for k, v in sorted(labels.items()))
+    return f"{name}{{{label_text}}}"
+
+
+class MetricsRegistry:
+    """线程安全的指标注册表"""
+
+    def __init__(self):
+        """初始化指标注册表"""
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._summaries: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1, labels: Optional[Dict[str, str]] = None):
+        """
+        累加计数器
+
+        Args:
+            name: 指标名称
+            value: 增量
+            labels: 指标标签
+        """
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        """
+        设置仪表值
+
+        Args:
+            name: 指标名称
+            value: 当前值
+            labels: 指标标签
+        """
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        """
+        记录一次观测值（统计次数、总和、最小值、最大值）
+
+        Args:
+            name: 指标名称
+            value: 观测值
+            labels: 指标标签
+        """
+        key = _metric_key(name, labels)
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                self._summaries[key] = {"count": 1, "sum": value, "min": value, "max": value}
+            else:
+                summary["count"] += 1
+                summary["sum"] += value
+                summary["min"] = min(summary["min"], value)
+                summary["max"] = max(summary["max"], value)
+
+    def get(self, name: str, labels: Optional[Dict[str, str]] = None, default: float = 0) -> float:
+        """
+        读取计数器或仪表的当前值
+
+        Args:
+            name: 指标名称
+            labels: 指标标签
+            default: 指标不存在时的默认值
+
+        Returns:
+            float: 指标值
+        """
+        key = _metric_key(name, labels)
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            return self._gauges.get(key, default)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        获取所有指标的快照
+
+        Returns:
+            Dict 包含 counters、gauges 和 summaries
+        """
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "summaries": {key: dict(value) for key, value in self._summaries.items()}
+            }
+
+    def reset(self):
+        """清空所有指标"""
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._summaries.clear()
+
+
+# 全局指标注册表
+metrics = MetricsRegistry()
@@ -0,0 +1,441 @@
+"""
+飞书写入发件箱模块
+保存到飞书的记录先落盘到本地 SQLite（WAL 模式），再由后台线程按批次投递，
+飞书不可用时按退避策略重试，进程重启后继续投递
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Any, Optional, List
+
+from utils.metrics import metrics
+from utils.retry import RetryPolicy
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 合并多条待投递记录时生成 client_token 的命名空间（批次首次投递时固定，重试沿用同一令牌）
+_BATCH_NAMESPACE = uuid.UUID("0b5e9c27-8d1a-5f36-b4e2-7a9c3d6f1e08")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    app_token TEXT NOT NULL,
+    table_id TEXT NOT NULL,
+    section_id TEXT NOT NULL,
+    client_token TEXT NOT NULL UNIQUE,
+    records TEXT NOT NULL,
+    record_count INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    batch_token TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (status, app_token, id);
+"""
+
+
+class FeishuOutbox:
+    """持久化的飞书写入发件箱"""
+
+    def __init__(self,
+                 path: str,
+                 batch_size: int = 500,
+                 max_attempts: int = 20,
+                 backoff_policy: Optional[RetryPolicy] = None,
+                 lease_seconds: float = 300.0):
+        """
+        初始化发件箱
+
+        Args:
+            path: SQLite 数据库文件路径
+            batch_size: 单次 batch_create 请求的最大记录数（飞书上限 500）
+            max_attempts: 单条记录最大投递次数，超过后转入死信状态
+            backoff_policy: 投递失败后的退避策略（仅使用其 backoff 计算）
+            lease_seconds: 认领批次后的租约时长（秒），进程在投递中途退出时，租约到期后由其他进程接手
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_policy = backoff_policy or RetryPolicy(base_delay=2.0, max_delay=300.0, name="feishu_outbox")
+        self.lease_seconds = lease_seconds
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")}
+        if "batch_token" not in columns:
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN batch_token TEXT")
+        self._lock = threading.RLock()
+
+        # 后台投递线程
+        self._clients: Dict[str, Any] = {}
+        self._wakeup = threading.Event()
+        self._delivered = threading.Condition()
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+
+        self._report_depth()
+
+    def enqueue(self, app_token: str, table_id: str, records: List[Dict[str, Any]], client_token: str) -> Dict[str, Any]:
+        """
+        将一组记录写入发件箱（同一 client_token 只会入队一次）
+
+        Args:
+            app_token: 多维表格 App Token
+            table_id: 表格 ID
+            records: 记录字段列表（同一 sectionID）
+            client_token: 幂等写入令牌
+
+        Returns:
+            Dict 包含 id、queued（是否为新入队）和 depth
+        """
+        section_id = str(records[0].get("sectionID", "")) if records else ""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO outbox "
+                "(app_token, table_id, section_id, client_token, records, record_count, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (app_token, table_id, section_id, client_token,
+                 json.dumps(records, ensure_ascii=False), len(records), time.time())
+            )
+            queued = cursor.rowcount == 1
+            row = self._conn.execute(
+                "SELECT id FROM outbox WHERE client_token = ?", (client_token,)
+            ).fetchone()
+
+        if queued:
+            metrics.increment("feishu_outbox.enqueued")
+        depth = self._report_depth()
+        return {"id": row[0] if row else None, "queued": queued, "depth": depth}
+
+    def drain(self, client, max_batches: Optional[int] = None) -> Dict[str, Any]:
+        """
+        投递到期的待发送记录（按 id 顺序，同一 sectionID 保持先后顺序）
+
+        遇到投递失败时停止本轮投递，等待退避后再试。批次首次投递前固定成员和 client_token，
+        重试时按原批次整体发送，超时后实际已写入的批次不会因重新分组而重复写入。
+        多个进程共享同一数据库时，批次投递前先在事务中认领，同一批次只会由一个进程发送。
+
+        Args:
+            client: FeishuClient 实例，只投递其 app_token 对应的记录
+            max_batches: 本轮最多发送的批次数
+
+        Returns:
+            Dict 包含 sent（成功投递的条目数）、failed 和 depth
+        """
+        sent = 0
+        failed = 0
+        batches = 0
+
+        with self._lock:
+            rows = self._due_rows(client.app_token)
+
+        for table_id, batch, client_token in self._group_batches(rows):
+            if max_batches is not None and batches >= max_batches:
+                break
+
+            ids = [row["id"] for row in batch]
+            if client_token is None:
+                tokens = [row["client_token"] for row in batch]
+                client_token = tokens[0] if len(tokens) == 1 else str(uuid.uuid5(_BATCH_NAMESPACE, "\n".join(tokens)))
+                if not self._claim_batch(ids, client_token, frozen=False):
+                    # 其他进程已认领其中的条目，停止本轮投递以保持顺序
+                    break
+            elif not self._claim_batch(ids, client_token, frozen=True):
+                # 批次中部分条目暂缓投递（同一 sectionID 有更早的条目在退避）或正由其他进程投递，整批等待下一轮
+                continue
+            batches += 1
+
+            fields = [record for row in batch for record in json.loads(row["records"])]
+
+            try:
+                result = client.add_record_to_bitable(table_id, fields, client_token=client_token)
+            except Exception as e:
+                result = {"success": False, "error": str(e)}
+
+            if result.get("success"):
+                with self._lock:
+                    self._conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+                sent += len(ids)
+                metrics.increment("feishu_outbox.delivered", len(ids))
+            else:
+                self._mark_failed(batch, result.get("error"))
+                failed += len(ids)
+                metrics.increment("feishu_outbox.failed_batches")
+                logger.warning(f"发件箱投递失败，{len(ids)} 条待重试: {result.get('error')}")
+                break
+
+        with self._delivered:
+            self._delivered.notify_all()
+
+        depth = self._report_depth()
+        return {"sent": sent, "failed": failed, "depth": depth}
+
+    def depth(self, app_token: Optional[str] = None) -> int:
+        """
+        待投递的条目数
+
+        Args:
+            app_token: 仅统计指定 App Token 的条目（可选）
+
+        Returns:
+            int: 待投递条目数
+        """
+        with self._lock:
+            if app_token is None:
+                row = self._conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()
+            else:
+                row = self._conn.execute(
+                    "SELECT COUNT(*) FROM outbox WHERE status = 'pending' AND app_token = ?", (app_token,)
+                ).fetchone()
+        return row[0]
+
+    def entry_state(self, entry_id: int) -> Optional[Dict[str, Any]]:
+        """
+        查询条目的投递状态
+
+        Args:
+            entry_id: enqueue 返回的条目 ID
+
+        Returns:
+            Optional[Dict]: 包含 status、attempts 和 last_error；已投递（已删除）时返回 None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, attempts, last_error FROM outbox WHERE id = ?", (entry_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"status": row[0], "attempts": row[1], "last_error": row[2]}
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        发件箱状态统计
+
+        Returns:
+            Dict 包含 depth、dead 和 oldest_age_seconds
+        """
+        with self._lock:
+            depth, oldest = self._conn.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM outbox WHERE status = 'pending'"
+            ).fetchone()
+            dead = self._conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'dead'").fetchone()[0]
+        return {
+            "depth": depth,
+            "dead": dead,
+            "oldest_age_seconds": time.time() - oldest if oldest else 0.0
+        }
+
+    # ==================== 后台投递 ====================
+
+    def register_client(self, client):
+        """
+        注册用于后台投递的飞书客户端（按 app_token 区分），新注册时唤醒后台线程投递该表格积压的记录
+
+        Args:
+            client: FeishuClient 实例
+        """
+        if self._clients.get(client.app_token) is not client:
+            self._clients[client.app_token] = client
+            self.wake()
+
+    def start(self, interval: float = 10.0):
+        """
+        启动后台投递线程（重复调用无副作用）
+
+        Args:
+            interval: 无新记录时的轮询间隔（秒）
+        """
+        if self._worker and self._worker.is_alive():
+            return
+        self._stop.clear()
+        # 启动后立即投递重启前积压的记录
+        self._wakeup.set()
+        self._worker = threading.Thread(target=self._run, args=(interval,), name="feishu-outbox", daemon=True)
+        self._worker.start()
+        logger.info("飞书发件箱后台投递已启动")
+
+    def stop(self):
+        """停止后台投递线程"""
+        self._stop.set()
+        self._wakeup.set()
+
+    def wake(self):
+        """唤醒后台线程立即投递"""
+        self._wakeup.set()
+
+    def wait_delivered(self, entry_id: int, timeout: float) -> bool:
+        """
+        等待指定条目投递完成（投递失败进入退避时立即返回）
+
+        Args:
+            entry_id: enqueue 返回的条目 ID
+            timeout: 最长等待时间（秒）
+
+        Returns:
+            bool: 是否已投递
+        """
+        deadline = time.monotonic() + timeout
+        with self._delivered:
+            while True:
+                state = self.entry_state(entry_id)
+                if state is None:
+                    return True
+                remaining = deadline - time.monotonic()
+                if state["attempts"] > 0 or remaining <= 0:
+                    return False
+                self._delivered.wait(remaining)
+
+    def _run(self, interval: float):
+        """后台投递循环"""
+        while not self._stop.is_set():
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            for client in list(self._clients.values()):
+                try:
+                    # 持续投递直到积压清空或遇到失败
+                    while True:
+                        result = self.drain(client)
+                        if not result["sent"] or result["failed"]:
+                            break
+                except Exception as e:
+                    logger.error(f"发件箱后台投递异常: {e}")
+
+    # ==================== 内部方法 ====================
+
+    def _due_rows(self, app_token: str) -> List[sqlite3.Row]:
+        """
+        查询到期可投递的条目
+
+        同一 sectionID 中存在仍在退避的更早条目时，后续条目也暂缓投递，以保持顺序。
+        """
+        now = time.time()
+        self._conn.row_factory = sqlite3.Row
+        try:
+            blocked = dict(self._conn.execute(
+                "SELECT section_id, MIN(id) FROM outbox "
+                "WHERE status = 'pending' AND app_token = ? AND next_attempt_at > ? GROUP BY section_id",
+                (app_token, now)
+            ).fetchall())
+            rows = self._conn.execute(
+                "SELECT * FROM outbox WHERE status = 'pending' AND app_token = ? AND next_attempt_at <= ? "
+                "ORDER BY id",
+                (app_token, now)
+            ).fetchall()
+        finally:
+            self._conn.row_factory = None
+        return [row for row in rows if row["id"] < blocked.get(row["section_id"], float("inf"))]
+
+    def _group_batches(self, rows: List[sqlite3.Row]) -> List[tuple]:
+        """
+        按表格和批次大小切分条目（保持 id 顺序）
+
+        已尝试投递过的条目按固定的批次令牌分组，成员不变；新条目按表格和批次大小组成新批次。
+
+        Returns:
+            List[tuple]: (table_id, 条目列表, 批次令牌)，新批次的令牌为 None
+        """
+        batches: List[tuple] = []
+        frozen: Dict[str, List[sqlite3.Row]] = {}
+        batch: List[sqlite3.Row] = []
+        batch_table = None
+        batch_records = 0
+        for row in rows:
+            if row["batch_token"]:
+                if batch:
+                    batches.append((batch_table, batch, None))
+                    batch, batch_records = [], 0
+                if row["batch_token"] not in frozen:
+                    frozen[row["batch_token"]] = []
+                    batches.append((row["table_id"], frozen[row["batch_token"]], row["batch_token"]))
+                frozen[row["batch_token"]].append(row)
+                continue
+            if batch and (row["table_id"] != batch_table or batch_records + row["record_count"] > self.batch_size):
+                batches.append((batch_table, batch, None))
+                batch, batch_records = [], 0
+            batch.append(row)
+            batch_table = row["table_id"]
+            batch_records += row["record_count"]
+        if batch:
+            batches.append((batch_table, batch, None))
+        return batches
+
+    def _claim_batch(self, ids: List[int], batch_token: str, frozen: bool) -> bool:
+        """
+        在事务中认领批次：固定批次令牌并设置租约（next_attempt_at），租约期间其他进程不会投递这些条目
+
+        Args:
+            ids: 批次中的条目 ID
+            batch_token: 批次令牌
+            frozen: 是否为已固定成员的重试批次（需要批次内全部待投递条目均已到期）
+
+        Returns:
+            bool: 是否认领成功
+        """
+        now = time.time()
+        placeholders = ",".join("?" * len(ids))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if frozen:
+                    due, total = self._conn.execute(
+                        "SELECT COALESCE(SUM(next_attempt_at <= ?), 0), COUNT(*) FROM outbox "
+                        "WHERE status = 'pending' AND batch_token = ?",
+                        (now, batch_token)
+                    ).fetchone()
+                    claimed = due == total == len(ids)
+                else:
+                    due = self._conn.execute(
+                        f"SELECT COUNT(*) FROM outbox WHERE id IN ({placeholders}) "
+                        "AND status = 'pending' AND batch_token IS NULL AND next_attempt_at <= ?",
+                        (*ids, now)
+                    ).fetchone()[0]
+                    claimed = due == len(ids)
+                if claimed:
+                    self._conn.execute(
+                        f"UPDATE outbox SET batch_token = ?, next_attempt_at = ? WHERE id IN ({placeholders})",
+                        (batch_token, now + self.lease_seconds, *ids)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return claimed
+
+    def _mark_failed(self, batch: List[sqlite3.Row], error: Optional[str]):
+        """记录投递失败并安排退避重试，超过最大次数的条目转入死信"""
+        now = time.time()
+        updates = []
+        for row in batch:
+            attempts = row["attempts"] + 1
+            status = "dead" if attempts >= self.max_attempts else "pending"
+            next_attempt_at = now + max(self.backoff_policy.base_delay, self.backoff_policy.backoff(attempts))
+            updates.append((attempts, status, next_attempt_at, error, row["id"]))
+            if status == "dead":
+                logger.error(f"发件箱条目 {row['id']} 超过最大投递次数，已转入死信")
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE outbox SET attempts = ?, status = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                updates
+            )
+
+    def _report_depth(self) -> int:
+        """上报积压指标"""
+        stats = self.stats()
+        metrics.set_gauge("feishu_outbox.depth", stats["depth"])
+        metrics.set_gauge("feishu_outbox.dead", stats["dead"])
+        metrics.set_gauge("feishu_outbox.oldest_age_seconds", stats["oldest_age_seconds"])
+        return stats["depth"]
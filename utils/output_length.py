@@ -0,0 +1,207 @@
+"""
+输出长度预测模块
+按提示词特征（模型、问题类型、问题长度）统计历史请求的实际输出 token 数，
+为每次请求估算 max_tokens：简短问题预留较少的输出额度，长回答按历史分布预留足够的额度；
+被截断（finish_reason == "length"）的请求由客户端自动续写，续写后的总长度也计入统计
+"""
+
+import logging
+import re
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from utils.metrics import metrics
+from utils.shared_cache import SharedCache
+from utils.tokens import estimate_tokens
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 各模型单次请求允许的最大输出 token 数（deepseek-reasoner 包含思维链）
+MODEL_MAX_OUTPUT = {
+    "deepseek-chat": 8192,
+    "deepseek-reasoner": 65536,
+}
+DEFAULT_MAX_OUTPUT = 8192
+
+# 输出额度包含思维链的推理模型：思维链长度与回答长度无关，不按问题特征预测，
+# 使用不低于该值的固定 max_tokens，避免额度被思维链耗尽后正文为空
+REASONING_MODELS = {"deepseek-reasoner"}
+REASONING_MIN_TOKENS = 8192
+
+# 样本不足时各问题类型的默认 max_tokens
+KIND_DEFAULTS = {
+    "short": 512,
+    "general": 1500,
+    "long": 3000,
+    "code": 4000,
+}
+
+# 问题类型的判断规则（按顺序匹配）
+_KIND_PATTERNS = (
+    ("code", re.compile(r"```|代码|函数|脚本|实现|编程|\bdef\b|\bclass\b|\bcode\b|\bfunction\b|\bscript\b|\bSQL\b", re.I)),
+    ("long", re.compile(r"详细|展开|全面|完整|文章|报告|方案|教程|步骤|列出|总结|翻译|\bexplain\b|\bdetail|\bwrite\b|\blist\b", re.I)),
+    ("short", re.compile(r"^.{0,30}(吗|么|是否|是不是|多少|几个|哪个|谁|何时|什么时候)[？?]?$|^.{0,30}[？?]$", re.S)),
+)
+
+# 共享缓存中样本的有效期（秒）
+_SHARED_TTL = 30 * 24 * 3600
+
+
+def question_kind(message: str) -> str:
+    """
+    问题类型：code（代码）/ long（需要较长回答）/ short（简短问答）/ general
+
+    Args:
+        message: 用户输入的消息
+
+    Returns:
+        str: 问题类型
+    """
+    text = (message or "").strip()
+    for kind, pattern in _KIND_PATTERNS:
+        if pattern.search(text):
+            return kind
+    return "general"
+
+
+def model_max_output(model: str) -> int:
+    """模型单次请求允许的最大输出 token 数"""
+    return MODEL_MAX_OUTPUT.get(model, DEFAULT_MAX_OUTPUT)
+
+
+def includes_reasoning(model: str) -> bool:
+    """模型的输出 token 是否包含思维链"""
+    return model in REASONING_MODELS
+
+
+class OutputLengthPredictor:
+    """按提示词特征预测输出长度（进程内共享，可选通过共享缓存在多个工作进程之间共用样本）"""
+
+    def __init__(self,
+                 quantile: float = 0.9,
+                 headroom: float = 1.2,
+                 min_tokens: int = 256,
+                 min_samples: int = 5,
+                 max_samples: int = 200,
+                 cache: Optional[SharedCache] = None):
+        """
+        初始化预测器
+
+        Args:
+            quantile: 按历史输出长度的该分位数预留额度
+            headroom: 在分位数基础上的放大系数
+            min_tokens: max_tokens 的下限
+            min_samples: 样本数不少于该值时才按历史分布预测，否则使用问题类型的默认值
+            max_samples: 每组特征保留的最近样本数
+            cache: 跨进程共享缓存
+        """
+        self.quantile = quantile
+        self.headroom = headroom
+        self.min_tokens = min_tokens
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.cache = cache
+        self._samples: Dict[str, Deque[int]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def features(message: str, model: str = "deepseek-chat", context: Optional[str] = None) -> Dict[str, Any]:
+        """
+        提取提示词特征
+
+        Args:
+            message: 用户输入的消息
+            model: 模型名称
+            context: 本轮附加的上下文（知识库检索结果等），有上下文时回答通常更长
+
+        Returns:
+            Dict 包含 model、kind、size（问题长度分段）、context 和 key
+        """
+        tokens = estimate_tokens(message or "")
+        size = "xs" if tokens < 16 else "s" if tokens < 64 else "m" if tokens < 256 else "l"
+        kind = question_kind(message)
+        with_context = bool(context)
+        return {
+            "model": model,
+            "kind": kind,
+            "size": size,
+            "context": with_context,
+            "key": f"{model}:{kind}:{size}:{int(with_context)}",
+        }
+
+    def predict(self, features: Dict[str, Any]) -> int:
+        """
+        预测本次请求的 max_tokens
+
+        Args:
+            features: features() 的返回值
+
+        Returns:
+            int: max_tokens
+        """
+        samples = self._load(features["key"])
+        if len(samples) >= self.min_samples:
+            ordered = sorted(samples)
+            value = ordered[min(len(ordered) - 1, int(len(ordered) * self.quantile))] * self.headroom
+            source = "history"
+        else:
+            value = KIND_DEFAULTS.get(features["kind"], KIND_DEFAULTS["general"])
+            source = "default"
+        max_tokens = int(min(model_max_output(features["model"]), max(self.min_tokens, value)))
+        metrics.observe("output_length.predicted", max_tokens, labels={"kind": features["kind"], "source": source})
+        return max_tokens
+
+    def observe(self, features: Dict[str, Any], completion_tokens: int, truncated: bool = False):
+        """
+        记录一次请求的实际输出长度
+
+        Args:
+            features: features() 的返回值
+            completion_tokens: 实际输出 token 数（续写时为各段之和）
+            truncated: 是否发生过截断（用于统计预测偏小的比例）
+        """
+        if completion_tokens <= 0:
+            return
+        key = features["key"]
+        samples = self._load(key)
+        with self._lock:
+            samples.append(int(completion_tokens))
+            snapshot = list(samples)
+        labels = {"kind": features["kind"]}
+        metrics.observe("output_length.actual", completion_tokens, labels=labels)
+        if truncated:
+            metrics.increment("output_length.truncated", labels=labels)
+        if self.cache is not None:
+            self.cache.set_json(f"output_length:{key}", snapshot, ttl=_SHARED_TTL)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        各组特征的样本概况
+
+        Returns:
+            Dict: 特征键 -> {"samples", "median", "max"}
+        """
+        with self._lock:
+            items = {key: sorted(samples) for key, samples in self._samples.items() if samples}
+        return {
+            key: {"samples": len(values), "median": values[len(values) // 2], "max": values[-1]}
+            for key, values in items.items()
+        }
+
+    def _load(self, key: str) -> Deque[int]:
+        """本进程的样本，首次使用时从共享缓存加载其他进程记录的样本"""
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is not None:
+                return samples
+        shared = self.cache.get_json(f"output_length:{key}") if self.cache is not None else None
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(
+                    (int(value) for value in shared or [] if isinstance(value, (int, float))),
+                    maxlen=self.max_samples
+                )
+            return samples
@@ -0,0 +1,180 @@
+"""
+性能分析模块
+按请求采样（或由侧边栏开关、?profile=1 强制）捕获 cProfile / pyinstrument 性能数据，
+写入本地目录供火焰图工具查看（.prof 可用 snakeviz / flameprof / tuna 打开，
+.speedscope.json 可直接拖入 https://www.speedscope.app）。
+未命中采样时只有一次比较，开销可以忽略
+"""
+
+import contextlib
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from utils.metrics import metrics
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+ENGINES = ("cprofile", "pyinstrument")
+
+# 同一线程内只保留最外层的分析（cProfile 不支持嵌套启用）
+_local = threading.local()
+
+
+def pyinstrument_available() -> bool:
+    """是否安装了 pyinstrument（pip install pyinstrument）"""
+    try:
+        import pyinstrument  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class Profiler:
+    """按请求采样的性能分析器（进程内共享）"""
+
+    def __init__(self,
+                 directory: str,
+                 sample_rate: float = 0.0,
+                 engine: str = "cprofile",
+                 max_files: int = 200):
+        """
+        初始化分析器
+
+        Args:
+            directory: 性能数据的输出目录
+            sample_rate: 采样率（0 ~ 1），0 表示只分析被强制的请求
+            engine: cprofile（确定性，记录每次函数调用）或 pyinstrument（统计采样，开销更低，需要单独安装）
+            max_files: 目录中最多保留的文件数，超出时删除最早的
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"不支持的分析引擎: {engine}")
+        if engine == "pyinstrument" and not pyinstrument_available():
+            logger.info("未安装 pyinstrument，使用 cProfile")
+            engine = "cprofile"
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.engine = engine
+        self.max_files = max_files
+
+    def should_profile(self, force: bool = False) -> bool:
+        """
+        本次请求是否需要分析
+
+        Args:
+            force: 强制分析（侧边栏开关或 ?profile=1）
+
+        Returns:
+            bool
+        """
+        return force or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    @staticmethod
+    def new_request_id() -> str:
+        """生成请求标识，同一请求在不同线程中的分析文件使用相同的标识"""
+        return uuid.uuid4().hex[:8]
+
+    def profile(self, name: str, active: bool = True, request_id: Optional[str] = None):
+        """
+        分析一段代码
+
+        Args:
+            name: 分析对象名称（process_message / router 等），写入文件名
+            active: 是否分析；为 False 或当前线程已在分析时返回空上下文
+            request_id: 请求标识，默认生成新的标识
+
+        Returns:
+            上下文管理器
+        """
+        if not active or getattr(_local, "active", False):
+            return contextlib.nullcontext()
+        return self._capture(name, request_id or self.new_request_id())
+
+    def recent(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        最近写入的分析文件
+
+        Args:
+            limit: 最多返回的文件数
+
+        Returns:
+            List[Dict]: 每个文件包含 name、path、size 和 mtime，按时间倒序
+        """
+        return self._files()[:limit]
+
+    @contextlib.contextmanager
+    def _capture(self, name: str, request_id: str):
+        profiler = self._start()
+        if profiler is None:
+            yield
+            return
+        _local.active = True
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _local.active = False
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            try:
+                path = self._stop(profiler, name, request_id)
+                metrics.increment("profile.captured", labels={"name": name})
+                metrics.observe("profile.ms", elapsed_ms, labels={"name": name})
+                logger.info(f"已保存性能分析: {path}（{elapsed_ms:.0f}ms）")
+                self._prune()
+            except Exception as e:
+                logger.warning(f"保存性能分析失败: {e}")
+
+    def _start(self):
+        try:
+            if self.engine == "pyinstrument":
+                from pyinstrument import Profiler as InstrumentProfiler
+                profiler = InstrumentProfiler(async_mode="disabled")
+                profiler.start()
+            else:
+                profiler = cProfile.Profile()
+                profiler.enable()
+            return profiler
+        except (RuntimeError, ValueError) as e:
+            # Python 3.12 起同一时间只能有一个 cProfile 处于启用状态
+            metrics.increment("profile.skipped")
+            logger.debug(f"跳过性能分析: {e}")
+            return None
+
+    def _stop(self, profiler, name: str, request_id: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{request_id}-{name}")
+        if self.engine == "pyinstrument":
+            from pyinstrument.renderers import SpeedscopeRenderer
+            session = profiler.stop()
+            path = prefix + ".speedscope.json"
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(SpeedscopeRenderer().render(session))
+        else:
+            profiler.disable()
+            path = prefix + ".prof"
+            profiler.dump_stats(path)
+        return path
+
+    def _files(self) -> List[Dict[str, Any]]:
+        if not os.path.isdir(self.directory):
+            return []
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith((".prof", ".speedscope.json")):
+                stat = entry.stat()
+                files.append({"name": entry.name, "path": entry.path, "size": stat.st_size, "mtime": stat.st_mtime})
+        files.sort(key=lambda item: item["mtime"], reverse=True)
+        return files
+
+    def _prune(self):
+        for item in self._files()[self.max_files:]:
+            try:
+                os.remove(item["path"])
+            except OSError:
+                pass
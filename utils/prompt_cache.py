@@ -0,0 +1,193 @@
+"""
+提示词缓存模块
+- PrefixMessageBuilder: 构建前缀稳定的消息列表，命中 DeepSeek 的前缀缓存
+- GeminiCacheManager: 管理 Gemini 显式上下文缓存（cached content），按 TTL 复用
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from typing import Dict, Any, Optional, List
+
+from utils.metrics import metrics
+from utils.tokens import estimate_tokens
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+
+class PrefixMessageBuilder:
+    """
+    前缀稳定的消息构建器
+
+    DeepSeek 的上下文硬盘缓存按请求前缀匹配，只要系统提示词和历史消息逐字节一致即可命中。
+    因此：
+    - 系统提示词和历史消息原样保留，不做任何改写；
+    - 检索上下文等每次都会变化的内容只拼接在最后一条用户消息中；
+    - 历史过长时按块整体丢弃最早的消息，而不是每轮滑动一条，避免前缀每轮都变化。
+    """
+
+    def __init__(self, max_history_messages: int = 40):
+        """
+        初始化消息构建器
+
+        Args:
+            max_history_messages: 保留的最大历史消息数
+        """
+        self.max_history_messages = max_history_messages
+
+    def build(self,
+              message: str,
+              system_prompt: Optional[str] = None,
+              history: Optional[List[Dict[str, Any]]] = None,
+              context: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        构建消息列表
+
+        Args:
+            message: 当前用户消息
+            system_prompt: 系统提示词
+            history: 历史消息（按时间顺序，每项包含 role 和 content）
+            context: 仅本轮使用的附加上下文（例如知识库检索结果）
+
+        Returns:
+            List[Dict]: OpenAI 兼容的消息列表
+        """
+        messages = []
+
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+
+        for item in self._window(history or []):
+            if item.get("role") in ("user", "assistant") and isinstance(item.get("content"), str):
+                messages.append({"role": item["role"], "content": item["content"]})
+
+        if context:
+            message = f"{context}\n\n---\n\n{message}"
+        messages.append({"role": "user", "content": message})
+
+        return messages
+
+    def _window(self, history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        按块截断历史，保证相邻几轮请求的历史前缀保持一致
+
+        窗口起点只由历史长度决定（每次整体前移半个窗口），不保存状态：
+        同一个客户端被多个会话并发使用时，各会话的窗口互不影响。
+        """
+        if len(history) <= self.max_history_messages:
+            return history
+
+        # 一次丢弃半个窗口，之后的若干轮都复用同一个前缀
+        step = max(1, self.max_history_messages // 2)
+        offset = ((len(history) - self.max_history_messages - 1) // step + 1) * step
+        # 从用户消息开始，避免以孤立的助手回复开头
+        while offset < len(history) and history[offset].get("role") != "user":
+            offset += 1
+        return history[offset:]
+
+
+class GeminiCacheManager:
+    """
+    Gemini 显式上下文缓存管理器
+
+    服务端缓存属于 API Key，同一 Key 的所有会话应共用一个管理器，避免每个会话各自创建（并计费）
+    相同系统提示词的缓存。
+    """
+
+    def __init__(self,
+                 client=None,
+                 ttl_seconds: int = 3600,
+                 min_tokens: int = 1024,
+                 refresh_margin: int = 60,
+                 failure_backoff: int = 600):
+        """
+        初始化缓存管理器
+
+        Args:
+            client: google.genai.Client 实例（也可以在 get_cached_content 中按调用传入）
+            ttl_seconds: 缓存有效期（秒）
+            min_tokens: 系统提示词低于该 token 数时不创建缓存（Gemini 对缓存内容有最小长度要求）
+            refresh_margin: 距离过期不足该秒数时创建新缓存
+            failure_backoff: 创建失败后在该时间内不再重试（秒）
+        """
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+        self.refresh_margin = refresh_margin
+        self.failure_backoff = failure_backoff
+
+        # 缓存键 -> (cached content 名称, 过期时间戳)；名称为 None 表示创建失败
+        self._entries: Dict[str, tuple] = {}
+        # 正在创建缓存的键（创建期间其他请求直接携带系统提示词，不等待）
+        self._creating: set = set()
+        self._lock = threading.Lock()
+
+    def get_cached_content(self, model: str, system_prompt: str, client=None) -> Optional[str]:
+        """
+        获取（必要时创建）系统提示词对应的缓存
+
+        创建缓存的网络请求不持有锁，其他会话的请求不会被阻塞。
+
+        Args:
+            model: 模型名称
+            system_prompt: 系统提示词
+            client: 用于创建缓存的 google.genai.Client，默认为初始化时传入的实例
+
+        Returns:
+            Optional[str]: cached content 名称；不满足缓存条件、正在创建或创建失败时返回 None
+        """
+        if not system_prompt or estimate_tokens(system_prompt) < self.min_tokens:
+            return None
+        client = client or self.client
+        if client is None:
+            return None
+
+        key = hashlib.sha256(f"{model}\x1f{system_prompt}".encode("utf-8")).hexdigest()
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now < entry[1] - (self.refresh_margin if entry[0] else 0):
+                if entry[0]:
+                    metrics.increment("gemini_cache.reused")
+                return entry[0]
+            if key in self._creating:
+                return None
+            self._creating.add(key)
+
+        try:
+            from google.genai import types
+
+            cached = client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_prompt,
+                    ttl=f"{self.ttl_seconds}s",
+                    display_name=f"system-prompt-{key[:12]}"
+                )
+            )
+            entry = (cached.name, now + self.ttl_seconds)
+            metrics.increment("gemini_cache.created")
+            logger.info(f"已创建 Gemini 上下文缓存: {cached.name}")
+        except Exception as e:
+            entry = (None, now + self.failure_backoff)
+            metrics.increment("gemini_cache.create_failed")
+            logger.warning(f"创建 Gemini 上下文缓存失败，改为直接发送系统提示词: {e}")
+        with self._lock:
+            self._entries[key] = entry
+            self._creating.discard(key)
+        return entry[0]
+
+    def invalidate(self, name: str):
+        """
+        移除指定缓存（例如服务端提示缓存已过期或不存在）
+
+        Args:
+            name: cached content 名称
+        """
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry[0] == name:
+                    del self._entries[key]
@@ -0,0 +1,384 @@
+"""
+录制 / 回放模块
+在 HTTP 传输层录制 DeepSeek、Gemini 和飞书的请求与响应（包括流式分块及其时间间隔），
+回放时按原始或压缩后的时间节奏返回，使应用和基准测试可以在无网络时确定性地运行
+"""
+
+import base64
+import functools
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from utils.metrics import metrics
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+MODES = ("off", "record", "replay")
+TIMINGS = ("original", "compressed", "none")
+
+# 不参与请求匹配、也不写入录制文件的查询参数
+_SECRET_PARAMS = frozenset({"key", "api_key", "access_token"})
+# 回放时需要丢弃的响应头（分块已按原样保存，长度和传输编码由回放重新确定）
+_DROP_HEADERS = frozenset({"content-length", "transfer-encoding", "connection", "set-cookie"})
+# 回放未命中时返回的状态码（不可重试，错误信息直接展示）
+MISS_STATUS = 501
+
+
+def request_key(method: str, url: str, body: bytes) -> str:
+    """
+    请求匹配键：方法 + 去除密钥参数的 URL + 请求体哈希（JSON 按键排序后计算，与字段顺序无关）
+
+    Args:
+        method: HTTP 方法
+        url: 完整 URL
+        body: 请求体
+
+    Returns:
+        str: 匹配键
+    """
+    parts = urlsplit(str(url))
+    query = urlencode(sorted((k, v) for k, v in parse_qsl(parts.query) if k not in _SECRET_PARAMS))
+    clean_url = urlunsplit((parts.scheme, parts.netloc, parts.path, query, ""))
+
+    try:
+        canonical = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False).encode("utf-8")
+    except (ValueError, UnicodeDecodeError):
+        canonical = body or b""
+    digest = hashlib.sha256(canonical).hexdigest()[:24]
+    return f"{method.upper()} {clean_url} {digest}"
+
+
+def _encode_chunk(chunk: bytes) -> Dict[str, str]:
+    """分块可读时保存为文本，便于人工检查和修改录制文件"""
+    try:
+        return {"text": chunk.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"b64": base64.b64encode(chunk).decode("ascii")}
+
+
+def _decode_chunk(chunk: Dict[str, str]) -> bytes:
+    if "b64" in chunk:
+        return base64.b64decode(chunk["b64"])
+    return chunk["text"].encode("utf-8")
+
+
+def httpx_module_of(client_class: type):
+    """
+    http_client 类型所基于的 httpx 模块（httpx 或兼容的分支实现）
+
+    Args:
+        client_class: 例如 openai.DefaultHttpxClient
+
+    Returns:
+        module: 提供 Client / BaseTransport / Response 等类型的模块
+    """
+    for cls in client_class.__mro__:
+        module = sys.modules.get(cls.__module__.split(".")[0])
+        if module is not None and hasattr(module, "BaseTransport") and hasattr(module, "SyncByteStream"):
+            return module
+    return httpx
+
+
+class Cassette:
+    """录制文件（JSONL，每行一次请求/响应），相同请求按录制顺序依次回放"""
+
+    def __init__(self, path: str):
+        """
+        初始化录制文件
+
+        Args:
+            path: 文件路径（不存在时在第一次录制时创建）
+        """
+        self.path = path
+        self._interactions: Dict[str, List[Dict[str, Any]]] = {}
+        self._cursors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        interaction = json.loads(line)
+                        self._interactions.setdefault(interaction["key"], []).append(interaction)
+                    except (json.JSONDecodeError, KeyError):
+                        continue
+
+    def __len__(self) -> int:
+        return sum(len(items) for items in self._interactions.values())
+
+    def append(self, interaction: Dict[str, Any]):
+        """追加一次录制的交互"""
+        with self._lock:
+            self._interactions.setdefault(interaction["key"], []).append(interaction)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(interaction, ensure_ascii=False) + "\n")
+
+    def next(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        取出下一条匹配的交互（全部用完后重复最后一条，便于基准测试循环执行）
+
+        Args:
+            key: request_key 计算的匹配键
+
+        Returns:
+            Optional[Dict]: 交互记录，未录制过该请求时返回 None
+        """
+        with self._lock:
+            items = self._interactions.get(key)
+            if not items:
+                return None
+            cursor = self._cursors.get(key, 0)
+            self._cursors[key] = cursor + 1
+            return items[min(cursor, len(items) - 1)]
+
+    def rewind(self):
+        """回到起点，重新按录制顺序回放"""
+        with self._lock:
+            self._cursors.clear()
+
+
+class ProviderRecorder:
+    """
+    录制 / 回放控制器
+
+    - record：请求照常发往上游，同时把请求键、状态码、响应头和每个响应分块（含距上一分块的间隔）写入录制文件；
+    - replay：不访问网络，按请求键从录制文件返回响应，timing 决定时间节奏：
+      original 按原始间隔、compressed 按 speedup 倍速、none 不等待；
+    - off：不做任何处理。
+
+    通过 httpx_transport()（DeepSeek / Gemini SDK）和 requests_adapter()（飞书）接入客户端。
+    """
+
+    def __init__(self, path: str, mode: str = "replay", timing: str = "compressed", speedup: float = 10.0):
+        """
+        初始化控制器
+
+        Args:
+            path: 录制文件路径
+            mode: off / record / replay
+            timing: 回放时间节奏 original / compressed / none
+            speedup: compressed 模式的加速倍数
+        """
+        if mode not in MODES:
+            raise ValueError(f"不支持的录制模式: {mode}")
+        if timing not in TIMINGS:
+            raise ValueError(f"不支持的回放节奏: {timing}")
+        self.mode = mode
+        self.timing = timing
+        self.speedup = max(1.0, speedup)
+        self.cassette = Cassette(path)
+        logger.info(f"录制/回放模式: {mode}（{path}，已有 {len(self.cassette)} 条记录）")
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def httpx_transport(self, inner=None, module=httpx):
+        """
+        包装 httpx 传输层（用于 openai / google-genai 的 http_client）
+
+        Args:
+            inner: 实际发送请求的传输层，默认 module.HTTPTransport()
+            module: http_client 所属的 httpx 模块（见 httpx_module_of）
+
+        Returns:
+            BaseTransport: off 模式下直接返回 inner
+        """
+        inner = inner or module.HTTPTransport()
+        if self.mode == "off":
+            return inner
+        return _transport_class(module)(self, inner)
+
+    def requests_adapter(self, inner: Optional[HTTPAdapter] = None) -> HTTPAdapter:
+        """
+        包装 requests 适配器（挂载到飞书客户端的 Session）
+
+        Args:
+            inner: 实际发送请求的适配器，默认 HTTPAdapter()
+
+        Returns:
+            HTTPAdapter: off 模式下直接返回 inner
+        """
+        inner = inner or HTTPAdapter()
+        if self.mode == "off":
+            return inner
+        return _RecordingAdapter(self, inner)
+
+    # ==================== 内部方法 ====================
+
+    def _sleep(self, seconds: float):
+        """按回放节奏等待"""
+        if self.timing == "none" or seconds <= 0:
+            return
+        time.sleep(seconds if self.timing == "original" else seconds / self.speedup)
+
+    def _replay(self, method: str, url: str, body: bytes) -> Tuple[Dict[str, Any], bool]:
+        """查找录制的交互，未命中时返回合成的错误响应"""
+        key = request_key(method, url, body)
+        interaction = self.cassette.next(key)
+        if interaction is not None:
+            metrics.increment("recorder.replayed")
+            return interaction, True
+
+        metrics.increment("recorder.missed")
+        logger.warning(f"录制文件中没有匹配的请求: {key}")
+        error = {"error": {"code": MISS_STATUS, "message": f"录制文件中没有匹配的请求: {key}"}}
+        return {
+            "key": key,
+            "status": MISS_STATUS,
+            "headers": [["content-type", "application/json"]],
+            "first_byte": 0.0,
+            "chunks": [[0.0, _encode_chunk(json.dumps(error, ensure_ascii=False).encode("utf-8"))]]
+        }, False
+
+    def _replay_chunks(self, interaction: Dict[str, Any]) -> Iterator[bytes]:
+        for delay, chunk in interaction["chunks"]:
+            self._sleep(delay)
+            yield _decode_chunk(chunk)
+
+    def _record(self, method: str, url: str, body: bytes, status: int,
+                headers: List[Tuple[str, str]], first_byte: float, chunks: List[Tuple[float, bytes]]):
+        key = request_key(method, url, body)
+        self.cassette.append({
+            "key": key,
+            "status": status,
+            "headers": [[k, v] for k, v in headers if k.lower() not in _DROP_HEADERS],
+            "first_byte": round(first_byte, 4),
+            "chunks": [[round(delay, 4), _encode_chunk(chunk)] for delay, chunk in chunks],
+            "recorded_at": time.time()
+        })
+        metrics.increment("recorder.recorded")
+
+
+@functools.lru_cache(maxsize=None)
+def _transport_class(module) -> type:
+    """
+    按 httpx 模块构建传输层类型（新版 openai SDK 基于 httpx 的分支实现，
+    传输层和响应必须与 http_client 使用同一模块的类型）
+    """
+
+    class RecordingStream(module.SyncByteStream):
+        """边读取上游响应边记录分块，响应读完或关闭时写入录制文件"""
+
+        def __init__(self, recorder: ProviderRecorder, request, response, first_byte: float):
+            self._recorder = recorder
+            self._request = request
+            self._response = response
+            self._first_byte = first_byte
+            self._chunks: List[Tuple[float, bytes]] = []
+            self._saved = False
+
+        def __iter__(self) -> Iterator[bytes]:
+            last = time.monotonic()
+            for chunk in self._response.stream:
+                now = time.monotonic()
+                self._chunks.append((now - last, chunk))
+                last = now
+                yield chunk
+
+        def close(self):
+            try:
+                self._response.close()
+            finally:
+                # 中途取消的流也会被记录（只包含已收到的分块）
+                if not self._saved:
+                    self._saved = True
+                    self._recorder._record(self._request.method, str(self._request.url), self._request.content,
+                                           self._response.status_code, list(self._response.headers.items()),
+                                           self._first_byte, self._chunks)
+
+    class ReplayStream(module.SyncByteStream):
+        def __init__(self, chunks: Iterator[bytes]):
+            self._chunks = chunks
+
+        def __iter__(self) -> Iterator[bytes]:
+            yield from self._chunks
+
+    class RecordingTransport(module.BaseTransport):
+        """httpx 录制 / 回放传输层"""
+
+        def __init__(self, recorder: ProviderRecorder, inner):
+            self._recorder = recorder
+            self._inner = inner
+
+        def handle_request(self, request):
+            body = request.read()
+            if self._recorder.mode == "replay":
+                interaction, _ = self._recorder._replay(request.method, str(request.url), body)
+                self._recorder._sleep(interaction.get("first_byte", 0.0))
+                return module.Response(
+                    interaction["status"],
+                    headers=[(k, v) for k, v in interaction["headers"] if k.lower() not in _DROP_HEADERS],
+                    stream=ReplayStream(self._recorder._replay_chunks(interaction)),
+                    request=request
+                )
+
+            start = time.monotonic()
+            response = self._inner.handle_request(request)
+            return module.Response(
+                response.status_code,
+                headers=response.headers,
+                stream=RecordingStream(self._recorder, request, response, time.monotonic() - start),
+                request=request,
+                extensions=response.extensions
+            )
+
+        def close(self):
+            self._inner.close()
+
+    return RecordingTransport
+
+
+class _RecordingAdapter(HTTPAdapter):
+    """requests 录制 / 回放适配器（飞书接口均为非流式响应，整体作为一个分块记录）"""
+
+    def __init__(self, recorder: ProviderRecorder, inner: HTTPAdapter):
+        super().__init__()
+        self._recorder = recorder
+        self._inner = inner
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        if self._recorder.mode == "replay":
+            interaction, _ = self._recorder._replay(request.method, request.url, body)
+            self._recorder._sleep(interaction.get("first_byte", 0.0))
+            response = requests.Response()
+            response.status_code = interaction["status"]
+            response.headers = CaseInsensitiveDict(
+                {k: v for k, v in interaction["headers"] if k.lower() not in _DROP_HEADERS}
+            )
+            response._content = b"".join(self._recorder._replay_chunks(interaction))
+            response.url = request.url
+            response.request = request
+            response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+            return response
+
+        start = time.monotonic()
+        response = self._inner.send(request, **kwargs)
+        content = response.content
+        # response.content 已解压，不再保留 Content-Encoding
+        headers = [(k, v) for k, v in response.headers.items() if k.lower() != "content-encoding"]
+        self._recorder._record(request.method, request.url, body, response.status_code,
+                               headers, time.monotonic() - start, [(0.0, content)])
+        return response
+
+    def close(self):
+        self._inner.close()
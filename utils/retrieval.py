@@ -0,0 +1,447 @@
+"""
+知识库检索模块
+基于已归档到飞书多维表格的问答记录构建本地索引（BM25 + 可选向量索引），
+在调用大模型前检索相关历史问答
+"""
+
+import logging
+import math
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from typing import Dict, Any, Optional, List, Callable, Sequence, Iterable
+
+from utils.tokens import estimate_tokens, truncate_to_tokens
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 归档回答末尾附带的模型标记，例如 "\n\n---\n*使用模型: deepseek*"
+_MODEL_FOOTER_RE = re.compile(r'\n*---\n\*使用模型: [^*]*\*\s*$')
+_WORD_RE = re.compile(r'[a-z0-9_]+')
+_CJK_RUN_RE = re.compile(r'[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]+')
+_NORMALIZE_RE = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    分词：英文/数字按单词切分，中日韩文本按字符二元组切分
+
+    Args:
+        text: 待分词的文本
+
+    Returns:
+        List[str]: 词项列表
+    """
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKC", text).lower()
+    terms = _WORD_RE.findall(text)
+    for run in _CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def normalize_question(text: str) -> str:
+    """
+    归一化问题文本，用于精确匹配（忽略大小写、空白和标点）
+
+    Args:
+        text: 问题文本
+
+    Returns:
+        str: 归一化后的文本
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return _NORMALIZE_RE.sub("", text)
+
+
+class KnowledgeIndex:
+    """已归档问答的本地检索索引"""
+
+    def __init__(self,
+                 k1: float = 1.5,
+                 b: float = 0.75,
+                 embed_fn: Optional[Callable[[str], Sequence[float]]] = None,
+                 max_df_ratio: float = 0.2,
+                 max_query_terms: int = 24,
+                 vector_exact_threshold: float = 0.97):
+        """
+        初始化索引
+
+        Args:
+            k1: BM25 词频饱和参数
+            b: BM25 文档长度归一化参数
+            embed_fn: 可选的文本向量化函数，提供后启用向量重排
+            max_df_ratio: 文档频率超过该比例的词项视为停用词（仅在语料较大时生效）
+            max_query_terms: 每次查询最多使用的词项数（按 IDF 从高到低）
+            vector_exact_threshold: 向量相似度达到该值时视为高置信度命中
+        """
+        self.k1 = k1
+        self.b = b
+        self.embed_fn = embed_fn
+        self.max_df_ratio = max_df_ratio
+        self.max_query_terms = max_query_terms
+        self.vector_exact_threshold = vector_exact_threshold
+
+        # 文档存储
+        self._questions: List[str] = []
+        self._answers: List[str] = []
+        self._record_ids: List[Optional[str]] = []
+        self._doc_lengths = array('I')
+        self._total_length = 0
+
+        # 倒排索引：词项 -> (文档ID数组, 词频数组)
+        self._postings: Dict[str, tuple] = {}
+        # 精确匹配：归一化问题 -> 文档ID
+        self._exact: Dict[str, int] = {}
+        # 向量索引：文档ID -> 归一化向量
+        self._vectors: Dict[int, List[float]] = {}
+
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._questions)
+
+    def add(self, question: str, answer: str, record_id: Optional[str] = None) -> Optional[int]:
+        """
+        添加一条问答到索引
+
+        Args:
+            question: 用户问题
+            answer: AI 回答
+            record_id: 飞书记录 ID（可选）
+
+        Returns:
+            Optional[int]: 文档 ID；问题或回答为空时返回 None
+        """
+        question = (question or "").strip()
+        answer = _MODEL_FOOTER_RE.sub("", answer or "").strip()
+        if not question or not answer:
+            return None
+
+        key = normalize_question(question)
+        terms = tokenize(question) + tokenize(answer)
+
+        with self._lock:
+            # 相同问题只保留最新的回答：先移除旧回答的倒排和长度，再按新内容重建
+            doc_id = self._exact.get(key)
+            if doc_id is not None:
+                old_terms = tokenize(self._questions[doc_id]) + tokenize(self._answers[doc_id])
+                self._unindex_terms(doc_id, old_terms)
+                self._total_length -= self._doc_lengths[doc_id]
+                self._questions[doc_id] = question
+                self._answers[doc_id] = answer
+                self._record_ids[doc_id] = record_id or self._record_ids[doc_id]
+                self._doc_lengths[doc_id] = len(terms)
+            else:
+                doc_id = len(self._questions)
+                self._questions.append(question)
+                self._answers.append(answer)
+                self._record_ids.append(record_id)
+                self._doc_lengths.append(len(terms))
+                if key:
+                    self._exact[key] = doc_id
+            self._total_length += len(terms)
+            self._index_terms(doc_id, terms)
+
+        if self.embed_fn:
+            try:
+                self._vectors[doc_id] = _normalize_vector(self.embed_fn(question))
+            except Exception as e:
+                logger.warning(f"问答向量化失败，仅使用 BM25: {e}")
+
+        return doc_id
+
+    def _index_terms(self, doc_id: int, terms: List[str]):
+        """将文档的词项写入倒排索引（需持有锁）"""
+        term_freqs: Dict[str, int] = {}
+        for term in terms:
+            term_freqs[term] = term_freqs.get(term, 0) + 1
+        for term, freq in term_freqs.items():
+            posting = self._postings.get(term)
+            if posting is None:
+                posting = (array('I'), array('I'))
+                self._postings[term] = posting
+            posting[0].append(doc_id)
+            posting[1].append(freq)
+
+    def _unindex_terms(self, doc_id: int, terms: List[str]):
+        """从倒排索引中移除文档的词项（需持有锁）"""
+        for term in set(terms):
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            doc_ids, freqs = posting
+            try:
+                i = doc_ids.index(doc_id)
+            except ValueError:
+                continue
+            del doc_ids[i]
+            del freqs[i]
+            if not doc_ids:
+                del self._postings[term]
+
+    def add_records(self, records: Iterable[Dict[str, Any]]) -> int:
+        """
+        从飞书多维表格记录批量构建索引
+
+        归档时一轮对话会写入两条记录（user / assistant），通过 sectionID 配对。
+
+        Args:
+            records: 飞书记录列表，每项包含 "fields" 和可选的 "record_id"
+
+        Returns:
+            int: 新增（或更新）的问答数量
+        """
+        pending: Dict[str, Dict[str, Any]] = {}
+        for record in records:
+            fields = record.get("fields", record)
+            section_id = _field_text(fields.get("sectionID"))
+            if not section_id:
+                continue
+            pair = pending.setdefault(section_id, {})
+            role = _field_text(fields.get("role"))
+            if role == "user":
+                pair["question"] = _field_text(fields.get("user_question"))
+            elif role == "assistant":
+                pair["answer"] = _field_text(fields.get("AI_answer"))
+                pair["record_id"] = record.get("record_id")
+
+        added = 0
+        for pair in pending.values():
+            if pair.get("question") and pair.get("answer"):
+                if self.add(pair["question"], pair["answer"], pair.get("record_id")) is not None:
+                    added += 1
+
+        logger.info(f"知识库索引新增 {added} 条问答，当前共 {len(self)} 条")
+        return added
+
+    def lookup_exact(self, query: str) -> Optional[Dict[str, Any]]:
+        """
+        精确匹配已归档的问题
+
+        Args:
+            query: 用户问题
+
+        Returns:
+            Optional[Dict]: 命中的问答，未命中返回 None
+        """
+        doc_id = self._exact.get(normalize_question(query))
+        if doc_id is None:
+            return None
+        return self._hit(doc_id, score=float("inf"), exact=True)
+
+    def search(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
+        """
+        BM25 检索（启用向量索引时对候选结果重排）
+
+        Args:
+            query: 查询文本
+            top_k: 返回结果数量
+
+        Returns:
+            List[Dict]: 按相关度降序排列的问答
+        """
+        n_docs = len(self._questions)
+        if n_docs == 0 or top_k <= 0:
+            return []
+
+        query_terms = set(tokenize(query))
+        avg_length = self._total_length / n_docs
+        max_df = max(1, int(n_docs * self.max_df_ratio)) if n_docs >= 1000 else n_docs
+
+        # 按 IDF 从高到低挑选词项，跳过过于常见的词项
+        weighted_terms = []
+        for term in query_terms:
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            df = len(posting[0])
+            if df > max_df:
+                continue
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            weighted_terms.append((idf, term))
+        weighted_terms.sort(reverse=True)
+        weighted_terms = weighted_terms[:self.max_query_terms]
+
+        scores: Dict[int, float] = {}
+        k1, b = self.k1, self.b
+        doc_lengths = self._doc_lengths
+        for idf, term in weighted_terms:
+            doc_ids, freqs = self._postings[term]
+            for doc_id, freq in zip(doc_ids, freqs):
+                norm = k1 * (1 - b + b * doc_lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * freq * (k1 + 1) / (freq + norm)
+
+        if not scores:
+            return []
+
+        candidate_count = top_k * 5 if self._vectors else top_k
+        candidates = [
+            (doc_id, score, None)
+            for doc_id, score in sorted(scores.items(), key=lambda item: item[1], reverse=True)[:candidate_count]
+        ]
+
+        if self._vectors and self.embed_fn:
+            candidates = self._rerank_with_vectors(query, candidates)
+
+        return [
+            self._hit(doc_id, score, similarity=similarity)
+            for doc_id, score, similarity in candidates[:top_k]
+        ]
+
+    def retrieve(self, query: str, top_k: int = 3, token_budget: int = 1200) -> Dict[str, Any]:
+        """
+        完整检索流程：精确匹配 -> BM25/向量检索 -> 按 token 预算组装上下文
+
+        Args:
+            query: 用户问题
+            top_k: 最多注入的问答数量
+            token_budget: 注入上下文的 token 预算
+
+        Returns:
+            Dict 包含 exact（高置信度命中）、hits、context 和 elapsed_ms
+        """
+        start = time.perf_counter()
+        with self._lock:
+            exact = self.lookup_exact(query)
+            hits = [] if exact else self.search(query, top_k=top_k)
+        if not exact and hits and hits[0].get("similarity", 0.0) >= self.vector_exact_threshold:
+            exact = dict(hits[0], exact=True)
+
+        context = "" if exact else self.build_context(hits, token_budget)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        logger.debug(f"知识库检索完成，命中 {len(hits)} 条，用时 {elapsed_ms:.2f}ms")
+
+        return {
+            "exact": exact,
+            "hits": hits,
+            "context": context,
+            "elapsed_ms": elapsed_ms
+        }
+
+    @staticmethod
+    def build_context(hits: List[Dict[str, Any]], token_budget: int) -> str:
+        """
+        将检索结果组装为上下文文本，总长度不超过 token 预算
+
+        Args:
+            hits: 检索结果
+            token_budget: token 预算
+
+        Returns:
+            str: 上下文文本（无结果时为空字符串）
+        """
+        parts = []
+        remaining = token_budget
+        for i, hit in enumerate(hits, 1):
+            header = f"[参考 {i}] 问: {hit['question']}\n答: "
+            header_tokens = estimate_tokens(header)
+            if remaining - header_tokens <= 0:
+                break
+            answer = truncate_to_tokens(hit["answer"], remaining - header_tokens)
+            if not answer:
+                break
+            parts.append(header + answer)
+            remaining -= header_tokens + estimate_tokens(answer)
+        return "\n\n".join(parts)
+
+    def _rerank_with_vectors(self, query: str, candidates: List[tuple]) -> List[tuple]:
+        """使用向量相似度对 BM25 候选结果重排"""
+        try:
+            query_vector = _normalize_vector(self.embed_fn(query))
+        except Exception as e:
+            logger.warning(f"查询向量化失败，跳过向量重排: {e}")
+            return candidates
+
+        top_score = candidates[0][1] or 1.0
+        reranked = []
+        for doc_id, score, _ in candidates:
+            vector = self._vectors.get(doc_id)
+            similarity = _dot(query_vector, vector) if vector else 0.0
+            reranked.append((doc_id, 0.5 * score / top_score + 0.5 * similarity, similarity))
+        reranked.sort(key=lambda item: item[1], reverse=True)
+        return reranked
+
+    def _hit(self,
+             doc_id: int,
+             score: float,
+             exact: bool = False,
+             similarity: Optional[float] = None) -> Dict[str, Any]:
+        """构造检索结果"""
+        hit = {
+            "question": self._questions[doc_id],
+            "answer": self._answers[doc_id],
+            "record_id": self._record_ids[doc_id],
+            "score": score,
+            "exact": exact
+        }
+        if similarity is not None:
+            hit["similarity"] = similarity
+        return hit
+
+
+def _field_text(value: Any) -> str:
+    """提取飞书字段的文本值（文本字段可能以富文本片段列表返回）"""
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return "".join(
+            item.get("text", "") if isinstance(item, dict) else str(item)
+            for item in value
+        )
+    return str(value)
+
+
+def _normalize_vector(vector: Sequence[float]) -> List[float]:
+    """L2 归一化"""
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def _dot(a: Sequence[float], b: Sequence[float]) -> float:
+    """向量点积"""
+    return sum(x * y for x, y in zip(a, b))
+
+
+# 测试代码
+if __name__ == "__main__":
+    import random
+
+    logging.basicConfig(level=logging.INFO)
+
+    def test_retrieval():
+        """测试知识库检索"""
+        print("=== 知识库检索测试 ===")
+
+        index = KnowledgeIndex()
+        index.add("Python 如何读取 JSON 文件？", "使用 json.load 读取文件对象即可。\n\n---\n*使用模型: deepseek*")
+        index.add("飞书多维表格怎么批量写入？", "调用 batch_create 接口，一次最多 500 条。")
+
+        print("1. 精确匹配:")
+        result = index.retrieve("python如何读取json文件")
+        print(f"   {result['exact']}")
+
+        print("\n2. BM25 检索:")
+        result = index.retrieve("多维表格写入", top_k=2)
+        print(f"   {result['context']}")
+
+        print("\n3. 10 万条记录检索耗时:")
+        vocabulary = [chr(0x4e00 + i) for i in range(3000)]
+        for i in range(100000):
+            question = "".join(random.choices(vocabulary, k=20))
+            index.add(question, "".join(random.choices(vocabulary, k=80)))
+        start = time.perf_counter()
+        for _ in range(100):
+            index.retrieve("".join(random.choices(vocabulary, k=20)))
+        print(f"   平均 {(time.perf_counter() - start) * 10:.2f}ms/次")
+
+        print("\n=== 测试完成 ===")
+
+    test_retrieval()
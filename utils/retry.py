@@ -0,0 +1,213 @@
+"""
+重试策略模块
+统一的可重试错误分类、全抖动指数退避、总时长预算和 Retry-After 支持
+"""
+
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Optional, Tuple
+
+from utils.metrics import metrics
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 默认可重试的 HTTP 状态码（409 冲突通常重试也不会成功，需要的调用方通过 retryable_status_codes 单独开启）
+RETRYABLE_STATUS_CODES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+
+class RetryableError(Exception):
+    """显式标记为可重试的错误（例如飞书返回的限流错误码）"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Any) -> Optional[float]:
+    """
+    解析 Retry-After 头（秒数或 HTTP 日期）
+
+    Args:
+        value: 头部取值
+
+    Returns:
+        Optional[float]: 需要等待的秒数，无法解析时返回 None
+    """
+    if value is None or value == "":
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(str(value)).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _response_headers(exc: Exception) -> Any:
+    """从异常中提取 HTTP 响应头（兼容 requests / httpx / openai / google-genai）"""
+    response = getattr(exc, "response", None)
+    return getattr(response, "headers", None) or {}
+
+
+def _status_code(exc: Exception) -> Optional[int]:
+    """从异常中提取 HTTP 状态码"""
+    for candidate in (getattr(exc, "status_code", None),
+                      getattr(exc, "code", None),
+                      getattr(getattr(exc, "response", None), "status_code", None)):
+        if isinstance(candidate, int) and 100 <= candidate < 600:
+            return candidate
+    return None
+
+
+def _is_transport_error(exc: Exception) -> bool:
+    """判断是否为连接/超时类错误（按异常类名匹配，避免依赖各 SDK 的异常类型）"""
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    for cls in type(exc).__mro__:
+        name = cls.__name__
+        if "Timeout" in name or "Connection" in name or name in ("TransportError", "RemoteProtocolError"):
+            return True
+    return False
+
+
+class RetryPolicy:
+    """可复用的重试策略"""
+
+    def __init__(self,
+                 max_attempts: int = 3,
+                 base_delay: float = 0.5,
+                 max_delay: float = 8.0,
+                 total_timeout: Optional[float] = 30.0,
+                 max_retry_after: float = 30.0,
+                 retryable_status_codes: frozenset = RETRYABLE_STATUS_CODES,
+                 name: str = "default",
+                 sleep: Callable[[float], None] = time.sleep):
+        """
+        初始化重试策略
+
+        Args:
+            max_attempts: 最大尝试次数（包含首次请求）
+            base_delay: 退避基准时长（秒）
+            max_delay: 单次退避上限（秒）
+            total_timeout: 总时长预算（秒），超出预算不再重试；None 表示不限制
+            max_retry_after: 可接受的 Retry-After 上限（秒），超过则放弃重试
+            retryable_status_codes: 可重试的 HTTP 状态码
+            name: 策略名称，用于指标标签
+            sleep: 等待函数（便于测试替换）
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.total_timeout = total_timeout
+        self.max_retry_after = max_retry_after
+        self.retryable_status_codes = retryable_status_codes
+        self.name = name
+        self._sleep = sleep
+
+    def is_retryable_status(self, status_code: int) -> bool:
+        """判断 HTTP 状态码是否可重试"""
+        return status_code in self.retryable_status_codes
+
+    def classify(self, exc: Exception) -> Tuple[bool, Optional[float]]:
+        """
+        判断异常是否可重试
+
+        Args:
+            exc: 捕获到的异常
+
+        Returns:
+            Tuple[bool, Optional[float]]: (是否可重试, 服务端要求的等待秒数)
+        """
+        if isinstance(exc, RetryableError):
+            return True, exc.retry_after
+
+        status_code = _status_code(exc)
+        if status_code is not None:
+            if not self.is_retryable_status(status_code):
+                return False, None
+            return True, parse_retry_after(_response_headers(exc).get("retry-after"))
+
+        return _is_transport_error(exc), None
+
+    def backoff(self, attempt: int) -> float:
+        """
+        计算全抖动指数退避时长
+
+        Args:
+            attempt: 已失败的次数（从 0 开始）
+
+        Returns:
+            float: 等待秒数
+        """
+        cap = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(0, cap)
+
+    def call(self, operation: Callable[[], Any]) -> Any:
+        """
+        按策略执行操作，可重试的错误会在退避后重试
+
+        不可重试的错误、重试次数用尽或超出总时长预算时，抛出最后一次的异常。
+
+        Args:
+            operation: 无参可调用对象
+
+        Returns:
+            operation 的返回值
+        """
+        labels = {"policy": self.name}
+        start = time.monotonic()
+        deadline = start + self.total_timeout if self.total_timeout is not None else None
+
+        for attempt in range(self.max_attempts):
+            try:
+                result = operation()
+                if attempt:
+                    metrics.increment("retry.recovered", labels=labels)
+                return result
+            except Exception as e:
+                retryable, retry_after = self.classify(e)
+                if not retryable or attempt >= self.max_attempts - 1:
+                    if retryable:
+                        metrics.increment("retry.exhausted", labels=labels)
+                    raise
+
+                if retry_after is not None:
+                    if retry_after > self.max_retry_after:
+                        logger.warning(f"[{self.name}] Retry-After={retry_after:.1f}s 超出上限，放弃重试")
+                        metrics.increment("retry.exhausted", labels=labels)
+                        raise
+                    delay = retry_after
+                else:
+                    delay = self.backoff(attempt)
+
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    logger.warning(f"[{self.name}] 超出总时长预算 {self.total_timeout}s，放弃重试")
+                    metrics.increment("retry.deadline_exceeded", labels=labels)
+                    raise
+
+                logger.warning(
+                    f"[{self.name}] 请求失败 (尝试 {attempt + 1}/{self.max_attempts})，"
+                    f"{delay:.2f}s 后重试: {e}"
+                )
+                metrics.increment("retry.retries", labels=labels)
+                metrics.observe("retry.sleep_seconds", delay, labels=labels)
+                self._sleep(delay)
+
+    def remaining(self, start: float) -> Optional[float]:
+        """
+        计算从 start（time.monotonic()）起剩余的时长预算
+
+        Args:
+            start: 开始时间
+
+        Returns:
+            Optional[float]: 剩余秒数；未设置总时长预算时返回 None
+        """
+        if self.total_timeout is None:
+            return None
+        return max(0.0, self.total_timeout - (time.monotonic() - start))
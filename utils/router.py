@@ -1,13 +1,27 @@
 """
 路由逻辑模块
-根据输入类型决定调用哪个 AI 模型
+根据输入类型、提示词复杂度和各模型近期表现决定调用哪个 AI 模型
 """
 
+import asyncio
 import logging
-from typing import Dict, Any, Optional, Union
+import hashlib
+import json
+import time
+from typing import Dict, Any, Optional, Union, Iterator
 from PIL import Image
 import io
 
+from utils.singleflight import SingleFlight
+from utils.routing_policy import RoutingPolicy, AdaptiveRoutingPolicy, ProviderStats
+from utils.governor import RequestGovernor, key_fingerprint
+from utils.cancellation import CancelToken, partial_usage
+from utils.images import as_image_list, image_digest, IMAGE_TOKENS
+from utils.tokens import estimate_tokens
+from utils.usage_ledger import UsageLedger
+from utils.profiling import Profiler
+from utils.retrieval import normalize_question
+
 # 配置日志
 logger = logging.getLogger(__name__)
 
@@ -15,9 +29,45 @@ logger = logging.getLogger(__name__)
 class Router:
     """AI 模型路由器"""
     
-    def __init__(self):
-        """初始化路由器"""
+    # 注入检索上下文时使用的提示词模板（拼接在本轮用户消息前，不改动系统提示词以保持前缀缓存）
+    RETRIEVAL_PROMPT = (
+        "以下是知识库中与用户问题相关的历史问答，可作为参考。"
+        "如果与问题无关请忽略，不要编造其中没有的信息。\n\n{context}"
+    )
+    
+    # 归一化后短于该长度的问题（"为什么？"、"继续" 等追问）不直接复用归档回答
+    MIN_EXACT_QUESTION_CHARS = 6
+    
+    def __init__(self, 
+                 singleflight: Optional[SingleFlight] = None,
+                 policy: Optional[RoutingPolicy] = None,
+                 stats: Optional[ProviderStats] = None,
+                 governor: Optional[RequestGovernor] = None,
+                 ledger: Optional[UsageLedger] = None,
+                 profiler: Optional[Profiler] = None):
+        """
+        初始化路由器
+        
+        Args:
+            singleflight: 请求合并器，多个会话共享同一实例时可合并相同的并发请求
+            policy: 路由策略，默认为成本与延迟感知的 AdaptiveRoutingPolicy
+            stats: 各模型延迟与错误率统计，多个会话可共享同一实例
+            governor: 配额与并发控制器（可选），请求携带 session_id 时生效
+            ledger: 用量台账（可选），记录每次请求的 token、延迟和估算费用
+            profiler: 性能分析器（可选），按采样率或 profile=True 分析实际调用上游的线程
+        """
         self.clients = {}
+        self.singleflight = singleflight or SingleFlight(name="router")
+        self.policy = policy or AdaptiveRoutingPolicy()
+        self.stats = stats or ProviderStats()
+        self.governor = governor
+        self.ledger = ledger
+        self.profiler = profiler
+        
+        # 知识库检索配置
+        self.knowledge_index = None
+        self.retrieval_top_k = 3
+        self.retrieval_token_budget = 1200
     
     def register_client(self, client_type: str, client):
         """
@@ -30,6 +80,19 @@ class Router:
         self.clients[client_type] = client
         logger.info(f"已注册 {client_type} 客户端")
     
+    def set_knowledge_index(self, index, top_k: int = 3, token_budget: int = 1200):
+        """
+        设置知识库检索索引
+        
+        Args:
+            index: KnowledgeIndex 实例，传入 None 关闭检索
+            top_k: 最多注入的历史问答数量
+            token_budget: 注入上下文的 token 预算
+        """
+        self.knowledge_index = index
+        self.retrieval_top_k = top_k
+        self.retrieval_token_budget = token_budget
+    
     def route(self, 
               message: str, 
               image_input: Optional[Union[str, bytes, Image.Image]] = None,
@@ -37,21 +100,509 @@ class Router:
         """
         路由请求到合适的 AI 模型
         
+        相同的并发请求（消息、图片、参数和凭证均相同）只会向上游发起一次。
+        配置了 governor 且传入 session_id 时，先按会话和 API Key 的并发与配额排队准入。
+        
         Args:
             message: 用户输入的消息
-            image_input: 图片输入，可以是文件路径、字节数据或 PIL Image 对象
-            **kwargs: 其他参数
+            image_input: 图片输入，可以是文件路径、字节数据、PIL Image 对象或它们的列表
+            **kwargs: 其他参数（use_retrieval=False 可跳过知识库检索；
+                      session_id、priority、on_wait 用于配额控制，见 RequestGovernor.acquire；
+                      cancel_token 可中止生成，此时内部以流式方式调用；
+                      profile=True 强制分析本次请求，传入字符串时作为分析文件的请求标识，False 禁止分析）
+            
+        Returns:
+            Dict 包含响应内容和路由信息（排队时附带 queue 信息，被取消时 cancelled=True）
+        """
+        image_input = _normalize_image_input(image_input)
+        if kwargs.get("cancel_token") is not None:
+            return self._collect_stream(self.route_stream(message, image_input, **kwargs))
+        
+        profile_id = self._profile_id(kwargs)
+        admission = self._admit(message, image_input, kwargs)
+        if not admission["success"]:
+            return admission
+        
+        result, shared = None, False
+        try:
+            key = self._coalesce_key(message, image_input, kwargs)
+            result, shared = self.singleflight.do(
+                key, self._profiled(profile_id, lambda: self._route(message, image_input, **kwargs))
+            )
+            return dict(result, coalesced=shared, **self._queue_info(admission))
+        finally:
+            self._release(admission, result, shared)
+    
+    async def aroute(self, 
+                     message: str, 
+                     image_input: Optional[Union[str, bytes, Image.Image]] = None,
+                     **kwargs) -> Dict[str, Any]:
+        """
+        route 的异步版本，与同步调用共享进行中的请求
+        
+        Args:
+            参数同 route
+            
+        Returns:
+            Dict 包含响应内容和路由信息
+        """
+        image_input = _normalize_image_input(image_input)
+        profile_id = self._profile_id(kwargs)
+        admission = await asyncio.to_thread(self._admit, message, image_input, kwargs)
+        if not admission["success"]:
+            return admission
+        
+        result, shared = None, False
+        try:
+            key = self._coalesce_key(message, image_input, kwargs)
+            result, shared = await self.singleflight.do_async(
+                key, self._profiled(profile_id, lambda: self._route(message, image_input, **kwargs))
+            )
+            return dict(result, coalesced=shared, **self._queue_info(admission))
+        finally:
+            self._release(admission, result, shared)
+    
+    def route_stream(self, 
+                     message: str, 
+                     image_input: Optional[Union[str, bytes, Image.Image]] = None,
+                     **kwargs) -> Iterator[Dict[str, Any]]:
+        """
+        流式路由请求，相同的并发请求共享同一个上游流
+        
+        cancel_token 被取消时当前调用方立即结束并收到 cancelled 事件（含部分内容和估算用量）；
+        共享该上游流的调用方都离开后，上游连接随即关闭。
+        
+        Args:
+            参数同 route
+            
+        Yields:
+            Dict 事件：delta（文本片段）、done（完整结果）、cancelled 或 error
+        """
+        image_input = _normalize_image_input(image_input)
+        cancel_token = kwargs.pop("cancel_token", None)
+        profile_id = self._profile_id(kwargs)
+        admission = self._admit(message, image_input, kwargs)
+        if not admission["success"]:
+            yield {"type": "error", "error": admission["error"], "retry_after": admission.get("retry_after")}
+            return
+        
+        result, shared = None, False
+        parts = []
+        try:
+            key = self._coalesce_key(message, image_input, kwargs)
+            events, shared = self.singleflight.do_stream(
+                key,
+                self._profiled_stream(
+                    profile_id,
+                    lambda upstream_cancel: self._route_stream(message, image_input, cancel_token=upstream_cancel, **kwargs)
+                ),
+                cancel_token=cancel_token
+            )
+            for event in events:
+                if event["type"] == "delta":
+                    parts.append(event["content"])
+                elif event["type"] in ("done", "cancelled"):
+                    result = event
+                    event = dict(event, coalesced=shared, **self._queue_info(admission))
+                elif event["type"] == "error":
+                    result = event
+                yield dict(event)
+            
+            if result is None and cancel_token is not None and cancel_token.cancelled:
+                content = "".join(parts)
+                result = {
+                    "type": "cancelled",
+                    "content": content,
+                    "usage": partial_usage(self._prompt_tokens(message, kwargs), content),
+                    "success": False,
+                    "cancelled": True
+                }
+                logger.info(f"已停止生成，已输出 {len(content)} 字符")
+                yield dict(result, **self._queue_info(admission))
+        finally:
+            self._release(admission, result, shared)
+    
+    def _profile_id(self, kwargs: Dict[str, Any]) -> Optional[str]:
+        """
+        取出 profile 参数并决定是否分析本次请求
+        
+        Returns:
+            Optional[str]: 分析文件的请求标识，不分析时为 None
+        """
+        profile = kwargs.pop("profile", None)
+        if self.profiler is None or profile is False:
+            return None
+        if isinstance(profile, str):
+            return profile
+        return self.profiler.new_request_id() if self.profiler.should_profile(bool(profile)) else None
+    
+    def _profiled(self, profile_id: Optional[str], fn):
+        """在执行 fn 的线程中分析（合并到其他请求时不执行 fn，也就不产生分析文件）"""
+        if profile_id is None:
+            return fn
+        
+        def call():
+            with self.profiler.profile("router", request_id=profile_id):
+                return fn()
+        return call
+    
+    def _profiled_stream(self, profile_id: Optional[str], stream_fn):
+        """流式版本：上游流在 SingleFlight 的后台线程中消费，分析也在该线程中进行"""
+        if profile_id is None:
+            return stream_fn
+        
+        def call(upstream_cancel):
+            with self.profiler.profile("router", request_id=profile_id):
+                yield from stream_fn(upstream_cancel)
+        return call
+    
+    @staticmethod
+    def _collect_stream(events: Iterator[Dict[str, Any]]) -> Dict[str, Any]:
+        """将流式事件汇总为与 route 相同格式的结果"""
+        for event in events:
+            if event["type"] == "done":
+                return {k: v for k, v in event.items() if k != "type"}
+            if event["type"] == "cancelled":
+                result = {k: v for k, v in event.items() if k != "type"}
+                return dict(result, success=False, cancelled=True, error="已停止生成")
+            if event["type"] == "error":
+                return {"success": False, "error": event["error"], "content": None, "routed": False}
+        return {"success": False, "error": "未收到响应", "content": None, "routed": False}
+    
+    def _admit(self, 
+               message: str, 
+               image_input: Optional[Union[str, bytes, Image.Image]],
+               kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        配额与并发准入（会从 kwargs 中取出 session_id、priority 和 on_wait）
+        
+        Args:
+            message: 用户输入的消息
+            image_input: 图片输入
+            kwargs: 其他参数
+            
+        Returns:
+            Dict: 准入结果，被拒绝时为可直接返回给调用方的错误结果
+        """
+        session_id = kwargs.pop("session_id", None)
+        priority = kwargs.pop("priority", 0)
+        on_wait = kwargs.pop("on_wait", None)
+        if self.governor is None or session_id is None:
+            return {"success": True, "ticket": None, "session_id": session_id, "started": time.monotonic()}
+        
+        # 按最可能使用的服务商的 API Key 计算 Key 维度的配额
+        provider = "gemini" if image_input is not None or "deepseek" not in self.clients else "deepseek"
+        client = self.clients.get(provider)
+        key_id = f"{provider}:{key_fingerprint(getattr(client, 'api_key', None))}"
+        estimated_tokens = (self._prompt_tokens(message, kwargs) +
+                            IMAGE_TOKENS * len(as_image_list(image_input)) +
+                            min(kwargs.get("max_tokens", 2000), 1000))
+        
+        admission = self.governor.acquire(
+            session_id, key_id,
+            priority=priority,
+            estimated_tokens=estimated_tokens,
+            on_wait=on_wait
+        )
+        if not admission["success"]:
+            return dict(admission, model="governor", routed=False)
+        return dict(admission, session_id=session_id, started=time.monotonic())
+    
+    def _release(self, admission: Dict[str, Any], result: Optional[Dict[str, Any]], shared: bool):
+        """释放准入名额，并将实际 token 用量记入配额和用量台账（合并的请求未消耗上游额度）"""
+        self._record_usage(admission, result, shared)
+        ticket = admission.get("ticket")
+        if ticket is None:
+            return
+        tokens = None
+        if shared:
+            tokens = 0
+        elif result and result.get("usage"):
+            tokens = result["usage"].get("total_tokens")
+        self.governor.release(ticket, tokens)
+    
+    def _record_usage(self, admission: Dict[str, Any], result: Optional[Dict[str, Any]], shared: bool):
+        """记入用量台账（延迟不含排队时间）"""
+        if self.ledger is None or not result or not result.get("model"):
+            return
+        if result.get("cancelled") or result.get("type") == "cancelled":
+            status = "cancelled"
+        elif result.get("success") and result.get("type") != "error":
+            status = "ok"
+        else:
+            status = "error"
+        self.ledger.record(
+            admission.get("session_id"),
+            provider=result["model"],
+            model=result.get("model_name"),
+            usage=result.get("usage"),
+            latency=time.monotonic() - admission["started"],
+            status=status,
+            coalesced=shared
+        )
+    
+    @staticmethod
+    def _queue_info(admission: Dict[str, Any]) -> Dict[str, Any]:
+        """排队信息（仅在实际排队时附加到结果中）"""
+        ticket = admission.get("ticket")
+        if ticket is None or admission.get("position") == 0:
+            return {}
+        return {"queue": {"waited": round(ticket.waited, 2)}}
+    
+    def _route(self, 
+               message: str, 
+               image_input: Optional[Union[str, bytes, Image.Image]] = None,
+               **kwargs) -> Dict[str, Any]:
+        """
+        实际执行路由（未合并）
+        
+        Args:
+            参数同 route
             
         Returns:
             Dict 包含响应内容和路由信息
         """
-        # 判断输入类型
-        if image_input is not None:
-            # 有图片输入，使用 Gemini
-            return self._call_gemini(message, image_input, **kwargs)
+        use_retrieval = kwargs.pop("use_retrieval", True)
+        retrieval = None
+        
+        if image_input is None:
+            # 纯文本输入，先检索知识库
+            retrieval = self._retrieve(message) if use_retrieval else None
+            if retrieval and self._can_reuse_exact(message, retrieval, kwargs):
+                # 高置信度命中，直接复用已归档的回答
+                return self._answer_from_knowledge(retrieval)
+            if retrieval and retrieval["context"]:
+                kwargs["context"] = self.RETRIEVAL_PROMPT.format(context=retrieval["context"])
+        
+        # 由路由策略选择服务商和模型
+        decision = self._decide(message, image_input, kwargs)
+        if decision.get("model"):
+            kwargs.setdefault("model", decision["model"])
+        
+        start = time.perf_counter()
+        if decision["provider"] == "gemini":
+            result = self._call_gemini(message, image_input, **kwargs)
+        else:
+            result = self._call_deepseek(message, **kwargs)
+        self._record_outcome(decision, start, result.get("success", False))
+        
+        result["model_name"] = kwargs.get("model") or result.get("model_name")
+        result["route"] = {"model": decision.get("model"), "reason": decision["reason"]}
+        if retrieval:
+            result["retrieval"] = self._retrieval_summary(retrieval)
+        return result
+    
+    def _route_stream(self, 
+                      message: str, 
+                      image_input: Optional[Union[str, bytes, Image.Image]] = None,
+                      cancel_token: Optional[CancelToken] = None,
+                      **kwargs) -> Iterator[Dict[str, Any]]:
+        """
+        实际执行流式路由（未合并）
+        
+        Args:
+            参数同 route
+            cancel_token: 上游取消令牌（所有订阅方离开时触发）
+            
+        Yields:
+            Dict 事件
+        """
+        use_retrieval = kwargs.pop("use_retrieval", True)
+        retrieval = None
+        
+        if image_input is None:
+            retrieval = self._retrieve(message) if use_retrieval else None
+            if retrieval and self._can_reuse_exact(message, retrieval, kwargs):
+                result = self._answer_from_knowledge(retrieval)
+                yield {"type": "delta", "content": result["content"]}
+                yield dict(result, type="done")
+                return
+            if retrieval and retrieval["context"]:
+                kwargs["context"] = self.RETRIEVAL_PROMPT.format(context=retrieval["context"])
         else:
-            # 纯文本输入，使用 DeepSeek
-            return self._call_deepseek(message, **kwargs)
+            kwargs["image_input"] = image_input
+        
+        decision = self._decide(message, image_input, kwargs)
+        provider = decision["provider"]
+        if decision.get("model"):
+            kwargs.setdefault("model", decision["model"])
+        
+        client = self.clients.get(provider)
+        if client is None:
+            yield {"type": "error", "error": f"{'DeepSeek' if provider == 'deepseek' else 'Gemini'} 客户端未注册"}
+            return
+        
+        start = time.perf_counter()
+        for event in client.stream_response(message, cancel_token=cancel_token, **kwargs):
+            if event["type"] == "cancelled":
+                event = dict(event, model=provider, model_name=kwargs.get("model"),
+                             success=False, cancelled=True)
+            elif event["type"] == "done":
+                self._record_outcome(decision, start, True)
+                event = dict(
+                    event,
+                    model=provider,
+                    model_name=kwargs.get("model"),
+                    routed=True,
+                    success=True,
+                    route={"model": decision.get("model"), "reason": decision["reason"]}
+                )
+                if retrieval:
+                    event["retrieval"] = self._retrieval_summary(retrieval)
+            elif event["type"] == "error":
+                self._record_outcome(decision, start, False)
+                event = dict(event, model=provider, model_name=kwargs.get("model"))
+            yield event
+    
+    def _decide(self, 
+                message: str, 
+                image_input: Optional[Union[str, bytes, Image.Image]],
+                kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        调用路由策略做出决策
+        
+        Args:
+            message: 用户输入的消息
+            image_input: 图片输入
+            kwargs: 其他参数（用于估算完整提示词的 token 数）
+            
+        Returns:
+            Dict 路由决策
+        """
+        return self.policy.decide(
+            message,
+            has_image=image_input is not None,
+            available=self.clients.keys(),
+            stats=self.stats,
+            prompt_tokens=self._prompt_tokens(message, kwargs)
+        )
+    
+    @staticmethod
+    def _prompt_tokens(message: str, kwargs: Dict[str, Any]) -> int:
+        """估算完整提示词（消息、系统提示词、检索上下文和历史）的 token 数"""
+        prompt_parts = [message, kwargs.get("system_prompt") or "", kwargs.get("context") or ""]
+        prompt_parts.extend(
+            item.get("content", "") for item in kwargs.get("history") or []
+            if isinstance(item.get("content"), str)
+        )
+        return sum(estimate_tokens(part) for part in prompt_parts)
+    
+    def _record_outcome(self, decision: Dict[str, Any], start: float, success: bool):
+        """记录调用耗时和结果，供路由策略参考"""
+        self.stats.record(decision.get("model") or decision["provider"], time.perf_counter() - start, success)
+    
+    def _coalesce_key(self, 
+                      message: str, 
+                      image_input: Optional[Union[str, bytes, Image.Image]],
+                      kwargs: Dict[str, Any]) -> str:
+        """
+        生成请求合并键：消息、图片内容、参数、知识库和客户端凭证都相同才会合并
+        
+        Args:
+            message: 用户输入的消息
+            image_input: 图片输入
+            kwargs: 其他参数
+            
+        Returns:
+            str: 合并键
+        """
+        digest = hashlib.sha256()
+        digest.update(message.encode("utf-8"))
+        digest.update(b"\x1f" + _image_digest(image_input).encode("ascii"))
+        digest.update(b"\x1f" + json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+        digest.update(b"\x1f" + str(id(self.knowledge_index)).encode("ascii"))
+        for client_type in sorted(self.clients):
+            api_key = getattr(self.clients[client_type], "api_key", "") or ""
+            digest.update(f"\x1f{client_type}:{api_key}".encode("utf-8"))
+        return digest.hexdigest()
+    
+    def _retrieve(self, message: str) -> Optional[Dict[str, Any]]:
+        """
+        在知识库中检索与消息相关的历史问答
+        
+        Args:
+            message: 用户输入的消息
+            
+        Returns:
+            Optional[Dict]: 检索结果，未配置索引或检索失败时返回 None
+        """
+        if self.knowledge_index is None or len(self.knowledge_index) == 0:
+            return None
+        
+        try:
+            return self.knowledge_index.retrieve(
+                message,
+                top_k=self.retrieval_top_k,
+                token_budget=self.retrieval_token_budget
+            )
+        except Exception as e:
+            logger.warning(f"知识库检索失败，跳过检索: {e}")
+            return None
+    
+    def _can_reuse_exact(self, message: str, retrieval: Dict[str, Any], kwargs: Dict[str, Any]) -> bool:
+        """
+        精确命中能否直接作为回答
+        
+        有对话历史（追问依赖上文）或问题过短时，精确命中只作为参考上下文注入（原地修改 retrieval）
+        
+        Args:
+            message: 用户输入的消息
+            retrieval: 检索结果
+            kwargs: 其他参数（检查 history）
+            
+        Returns:
+            bool: 是否直接复用归档的回答
+        """
+        hit = retrieval["exact"]
+        if not hit:
+            return False
+        if not kwargs.get("history") and len(normalize_question(message)) >= self.MIN_EXACT_QUESTION_CHARS:
+            return True
+        hits = [hit] + [item for item in retrieval["hits"] if item.get("record_id") != hit.get("record_id")]
+        retrieval.update(
+            exact=None,
+            hits=hits,
+            context=self.knowledge_index.build_context(hits, self.retrieval_token_budget)
+        )
+        return False
+    
+    def _answer_from_knowledge(self, retrieval: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        使用知识库中的高置信度命中直接作答
+        
+        Args:
+            retrieval: 检索结果
+            
+        Returns:
+            Dict 包含响应内容
+        """
+        hit = retrieval["exact"]
+        logger.info(f"知识库精确命中，跳过模型调用 (record_id={hit.get('record_id')})")
+        return {
+            "success": True,
+            "content": hit["answer"],
+            "model": "knowledge_base",
+            "routed": True,
+            "usage": {
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0
+            },
+            "retrieval": {
+                "hits": 1,
+                "exact": True,
+                "record_id": hit.get("record_id"),
+                "elapsed_ms": retrieval["elapsed_ms"]
+            }
+        }
+    
+    @staticmethod
+    def _retrieval_summary(retrieval: Dict[str, Any]) -> Dict[str, Any]:
+        """检索结果摘要（附加在响应中）"""
+        return {
+            "hits": len(retrieval["hits"]),
+            "elapsed_ms": retrieval["elapsed_ms"]
+        }
     
     def _call_deepseek(self, message: str, **kwargs) -> Dict[str, Any]:
         """
@@ -91,14 +642,14 @@ class Router:
     
     def _call_gemini(self, 
                     prompt: str, 
-                    image_input: Union[str, bytes, Image.Image],
+                    image_input: Optional[Union[str, bytes, Image.Image]],
                     **kwargs) -> Dict[str, Any]:
         """
-        调用 Gemini 处理图片
+        调用 Gemini 处理图片（DeepSeek 不可用时也用于纯文本）
         
         Args:
             prompt: 用户输入的提示词
-            image_input: 图片输入
+            image_input: 图片输入（纯文本时为 None）
             **kwargs: 其他参数
             
         Returns:
@@ -131,32 +682,73 @@ class Router:
     
     def get_route_info(self, 
                       message: str, 
-                      image_input: Optional[Union[str, bytes, Image.Image]] = None) -> Dict[str, Any]:
+                      image_input: Optional[Union[str, bytes, Image.Image]] = None,
+                      **kwargs) -> Dict[str, Any]:
         """
         获取路由信息（不实际调用）
         
         Args:
             message: 用户输入的消息
             image_input: 图片输入
+            **kwargs: 其他参数（system_prompt、history 等，用于估算 token 数）
             
         Returns:
-            Dict 包含路由决策信息
+            Dict 包含路由决策信息及其依据
         """
-        if image_input is not None:
-            model = "gemini"
-            reason = "检测到图片输入，使用 Gemini 进行图片理解"
-        else:
-            model = "deepseek"
-            reason = "纯文本输入，使用 DeepSeek 进行文本对话"
+        image_input = _normalize_image_input(image_input)
+        decision = self._decide(message, image_input, kwargs)
         
         return {
-            "model": model,
-            "reason": reason,
+            "model": decision["provider"],
+            "model_name": decision.get("model"),
+            "reason": decision["reason"],
             "has_image": image_input is not None,
-            "message_length": len(message)
+            "image_count": len(as_image_list(image_input)),
+            "message_length": len(message),
+            "decision": decision
         }
 
 
+def _normalize_image_input(image_input):
+    """
+    规范化图片输入：空列表视为无图片，单元素列表视为单张图片
+    
+    Args:
+        image_input: 单张图片、图片列表或 None
+        
+    Returns:
+        单张图片、图片列表或 None
+    """
+    images = as_image_list(image_input)
+    if not images:
+        return None
+    return images[0] if len(images) == 1 else images
+
+
+def _image_digest(image_input) -> str:
+    """
+    计算图片输入的摘要，用于生成请求合并键
+    
+    Args:
+        image_input: 图片输入（单张或列表）
+        
+    Returns:
+        str: 摘要字符串（无图片时为空字符串）
+    """
+    if image_input is None:
+        return ""
+    if isinstance(image_input, (list, tuple)):
+        return hashlib.sha256("".join(_image_digest(image) for image in image_input).encode("ascii")).hexdigest()
+    if isinstance(image_input, (bytes, bytearray)):
+        return hashlib.sha256(image_input).hexdigest()
+    if isinstance(image_input, dict):
+        # 预处理结果按原图摘要计算，预上传与否不影响合并
+        return image_digest(image_input)
+    if isinstance(image_input, Image.Image):
+        return hashlib.sha256(image_input.tobytes()).hexdigest()
+    return hashlib.sha256(str(image_input).encode("utf-8")).hexdigest()
+
+
 def should_use_gemini(image_input: Optional[Union[str, bytes, Image.Image]] = None) -> bool:
     """
     判断是否应该使用 Gemini
@@ -203,6 +795,10 @@ if __name__ == "__main__":
         route_info = router.get_route_info("你好")
         print(f"   纯文本输入: {route_info}")
         
+        # 需要推理的文本
+        route_info = router.get_route_info("请逐步推导这个算法的时间复杂度")
+        print(f"   推理类输入: {route_info['model_name']} - {route_info['reason']}")
+        
         # 模拟图片输入
         route_info = router.get_route_info("描述这张图片", image_input="test.jpg")
         print(f"   图片输入: {route_info}")
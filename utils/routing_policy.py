@@ -0,0 +1,336 @@
+"""
+路由策略模块
+根据提示词长度、估算 token 数、各服务商近期延迟/错误率和价格表选择服务商与模型
+"""
+
+import logging
+import re
+import threading
+import time
+from typing import Dict, Any, Optional, Iterable
+
+from utils.tokens import estimate_tokens
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 价格表（美元 / 百万 token）：input 为未命中缓存的输入，cached_input 为命中缓存的输入
+COST_TABLE: Dict[str, Dict[str, float]] = {
+    "deepseek-chat": {"input": 0.27, "cached_input": 0.07, "output": 1.10},
+    "deepseek-reasoner": {"input": 0.55, "cached_input": 0.14, "output": 2.19},
+    "gemini-2.0-flash": {"input": 0.10, "cached_input": 0.025, "output": 0.40},
+    "gemini-2.5-pro": {"input": 1.25, "cached_input": 0.31, "output": 10.00},
+}
+
+# 尚无观测数据时使用的延迟先验（秒）
+DEFAULT_LATENCY = {
+    "deepseek-chat": 4.0,
+    "deepseek-reasoner": 25.0,
+    "gemini-2.0-flash": 3.0,
+    "gemini-2.5-pro": 20.0,
+}
+
+# 需要推理能力的提示词特征：明确要求多步推导，或数学 / 证明类问题（不含"为什么""分析"等日常用语）
+_REASONING_RE = re.compile(
+    r"证明|推导|逐步|一步一步|分步骤?|反证|归纳法|解方程|方程组|不等式|求解|积分|导数|微分|极限|概率|"
+    r"时间复杂度|空间复杂度|动态规划|"
+    r"\bprove\b|\bproof\b|\bderive\b|\bderivation\b|step[- ]by[- ]step|\btheorem\b|\blemma\b|"
+    r"\bequations?\b|\bintegral\b|\bderivative\b|\bprobability\b|\btime complexity\b|\bdynamic programming\b",
+    re.IGNORECASE
+)
+# 题目结构：算式、LaTeX 公式或分条列出的多个小问
+_STRUCTURE_RE = re.compile(
+    r"\d\s*[-+*/^=<>≤≥]\s*[\d(a-zA-Z]|[a-zA-Z]\^\d|\\(?:frac|sum|int|sqrt|lim)\b|\$[^$]+\$|"
+    r"(?:^|\n)\s*(?:\(?\d+[).、]|[（(][一二三四五六七八九十\d]+[)）])\s*\S[^\n]*\n\s*(?:\(?\d+[).、]|[（(][一二三四五六七八九十\d]+[)）])"
+)
+_CODE_RE = re.compile(r"```|def |class |function |SELECT |\bimport\b|Traceback")
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int, cached_tokens: int = 0) -> float:
+    """
+    按价格表估算一次请求的费用
+
+    Args:
+        model: 模型名称
+        input_tokens: 输入 token 数（含缓存命中部分）
+        output_tokens: 输出 token 数
+        cached_tokens: 输入中命中缓存的 token 数
+
+    Returns:
+        float: 估算费用（美元），未知模型返回 0
+    """
+    price = COST_TABLE.get(model)
+    if not price:
+        return 0.0
+    uncached = max(0, input_tokens - cached_tokens)
+    return (uncached * price["input"] +
+            cached_tokens * price["cached_input"] +
+            output_tokens * price["output"]) / 1_000_000
+
+
+class ProviderStats:
+    """各模型的延迟和错误率指数加权移动平均（EWMA）"""
+
+    def __init__(self, alpha: float = 0.3, error_half_life: float = 300.0):
+        """
+        初始化统计
+
+        Args:
+            alpha: EWMA 平滑系数，越大越偏向最近的观测
+            error_half_life: 错误率的衰减半衰期（秒），避免被降级的模型因没有新请求而永远无法恢复
+        """
+        self.alpha = alpha
+        self.error_half_life = error_half_life
+        self._latency: Dict[str, float] = {}
+        self._error_rate: Dict[str, float] = {}
+        self._updated_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, latency: float, success: bool):
+        """
+        记录一次调用结果
+
+        Args:
+            model: 模型名称
+            latency: 耗时（秒）
+            success: 是否成功
+        """
+        with self._lock:
+            error = 0.0 if success else 1.0
+            if model not in self._latency:
+                self._latency[model] = latency
+                self._error_rate[model] = error
+            else:
+                # 失败请求的耗时不代表正常延迟，只更新错误率
+                if success:
+                    self._latency[model] += self.alpha * (latency - self._latency[model])
+                current = self._decayed_error_rate(model)
+                self._error_rate[model] = current + self.alpha * (error - current)
+            self._updated_at[model] = time.time()
+
+    def latency(self, model: str) -> float:
+        """最近的延迟估计（秒），无观测时使用先验值"""
+        with self._lock:
+            return self._latency.get(model, DEFAULT_LATENCY.get(model, 5.0))
+
+    def error_rate(self, model: str) -> float:
+        """最近的错误率估计（0~1），随时间衰减"""
+        with self._lock:
+            return self._decayed_error_rate(model)
+
+    def _decayed_error_rate(self, model: str) -> float:
+        """按距上次观测的时间衰减错误率（调用方需持有锁）"""
+        rate = self._error_rate.get(model, 0.0)
+        if not rate or not self.error_half_life:
+            return rate
+        elapsed = time.time() - self._updated_at.get(model, time.time())
+        return rate * 0.5 ** (elapsed / self.error_half_life)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """
+        获取所有模型的统计快照
+
+        Returns:
+            Dict: 模型 -> {latency, error_rate, updated_at}
+        """
+        with self._lock:
+            return {
+                model: {
+                    "latency": self._latency[model],
+                    "error_rate": self._decayed_error_rate(model),
+                    "updated_at": self._updated_at.get(model, 0.0)
+                }
+                for model in self._latency
+            }
+
+
+class RoutingPolicy:
+    """路由策略基类"""
+
+    def decide(self,
+               message: str,
+               has_image: bool,
+               available: Iterable[str],
+               stats: ProviderStats,
+               prompt_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """
+        选择服务商和模型
+
+        Args:
+            message: 用户输入的消息
+            has_image: 是否包含图片
+            available: 已注册的服务商（'deepseek' / 'gemini'）
+            stats: 延迟与错误率统计
+            prompt_tokens: 完整提示词（含系统提示词和历史）的估算 token 数
+
+        Returns:
+            Dict 包含 provider、model、reason 以及决策依据
+        """
+        raise NotImplementedError
+
+
+class StaticRoutingPolicy(RoutingPolicy):
+    """固定规则：文本用 DeepSeek，图片用 Gemini"""
+
+    def __init__(self, deepseek_model: str = "deepseek-chat", gemini_model: Optional[str] = None):
+        self.deepseek_model = deepseek_model
+        self.gemini_model = gemini_model
+
+    def decide(self, message, has_image, available, stats, prompt_tokens=None):
+        if has_image:
+            return {
+                "provider": "gemini",
+                "model": self.gemini_model,
+                "reason": "检测到图片输入，使用 Gemini 进行图片理解"
+            }
+        return {
+            "provider": "deepseek",
+            "model": self.deepseek_model,
+            "reason": "纯文本输入，使用 DeepSeek 进行文本对话"
+        }
+
+
+class AdaptiveRoutingPolicy(RoutingPolicy):
+    """
+    成本与延迟感知的路由策略
+
+    - 图片输入只能由 Gemini 处理，复杂或较长的提示词使用 pro 模型，否则使用 flash；
+    - 文本输入默认使用 deepseek-chat，需要推理的提示词使用 deepseek-reasoner；
+    - 候选模型近期错误率过高、延迟超出预算或估算费用超出上限时降级到下一个候选；
+    - DeepSeek 不可用时，文本请求回退到 Gemini flash。
+    """
+
+    def __init__(self,
+                 gemini_fast_model: str = "gemini-2.0-flash",
+                 gemini_pro_model: str = "gemini-2.5-pro",
+                 complexity_threshold: float = 2.0,
+                 long_prompt_tokens: int = 1500,
+                 reasoning_min_chars: int = 40,
+                 expected_output_tokens: int = 600,
+                 reasoning_overhead_tokens: int = 1500,
+                 max_error_rate: float = 0.5,
+                 latency_budget: float = 60.0,
+                 max_cost_per_request: float = 0.02):
+        """
+        初始化策略
+
+        Args:
+            gemini_fast_model: Gemini 快速模型
+            gemini_pro_model: Gemini 高质量模型
+            complexity_threshold: 复杂度得分达到该值时选择推理/pro 模型
+            long_prompt_tokens: 提示词达到该 token 数记 1 分复杂度
+            reasoning_min_chars: 短于该字符数且没有题目结构（算式、公式、分条小问）的消息，推理特征最多记 1 分
+            expected_output_tokens: 估算费用时假设的输出 token 数
+            reasoning_overhead_tokens: 推理模型额外的思考 token 数
+            max_error_rate: 错误率超过该值的模型视为不健康
+            latency_budget: 延迟 EWMA 超过该值（秒）的模型降级
+            max_cost_per_request: 单次请求估算费用上限（美元）
+        """
+        self.gemini_fast_model = gemini_fast_model
+        self.gemini_pro_model = gemini_pro_model
+        self.complexity_threshold = complexity_threshold
+        self.long_prompt_tokens = long_prompt_tokens
+        self.reasoning_min_chars = reasoning_min_chars
+        self.expected_output_tokens = expected_output_tokens
+        self.reasoning_overhead_tokens = reasoning_overhead_tokens
+        self.max_error_rate = max_error_rate
+        self.latency_budget = latency_budget
+        self.max_cost_per_request = max_cost_per_request
+
+    def complexity(self, message: str, prompt_tokens: int) -> float:
+        """
+        估算提示词复杂度得分
+
+        Args:
+            message: 用户输入的消息
+            prompt_tokens: 完整提示词的估算 token 数
+
+        Returns:
+            float: 复杂度得分
+        """
+        score = min(3, len(_REASONING_RE.findall(message)))
+        structured = bool(_STRUCTURE_RE.search(message))
+        if structured:
+            score += 1
+        elif len(message.strip()) < self.reasoning_min_chars:
+            # 简短的一句话提问只凭关键词不足以判定需要推理模型
+            score = min(1, score)
+        if _CODE_RE.search(message):
+            score += 1
+        score += min(2.0, prompt_tokens / self.long_prompt_tokens)
+        return score
+
+    def decide(self, message, has_image, available, stats, prompt_tokens=None):
+        available = set(available)
+        prompt_tokens = prompt_tokens if prompt_tokens is not None else estimate_tokens(message)
+        complexity = self.complexity(message, prompt_tokens)
+        complex_prompt = complexity >= self.complexity_threshold
+
+        if has_image:
+            candidates = [("gemini", self.gemini_pro_model), ("gemini", self.gemini_fast_model)]
+            if not complex_prompt:
+                candidates = candidates[1:]
+        else:
+            candidates = [("deepseek", "deepseek-chat"), ("gemini", self.gemini_fast_model)]
+            if complex_prompt:
+                candidates.insert(0, ("deepseek", "deepseek-reasoner"))
+
+        evaluated = [self._evaluate(provider, model, prompt_tokens, stats, available)
+                     for provider, model in candidates]
+        chosen = next((c for c in evaluated if not c["rejected"]), None)
+        if chosen is None:
+            # 全部候选都不理想时，选择第一个已注册的候选
+            chosen = next((c for c in evaluated if c["provider"] in available), evaluated[0])
+
+        reason = self._explain(chosen, evaluated, has_image, complexity, complex_prompt)
+        return {
+            "provider": chosen["provider"],
+            "model": chosen["model"],
+            "reason": reason,
+            "complexity": round(complexity, 2),
+            "prompt_tokens": prompt_tokens,
+            "estimated_cost": chosen["estimated_cost"],
+            "expected_latency": chosen["latency"],
+            "candidates": evaluated
+        }
+
+    def _evaluate(self, provider, model, prompt_tokens, stats, available) -> Dict[str, Any]:
+        """评估单个候选模型"""
+        output_tokens = self.expected_output_tokens
+        if model == "deepseek-reasoner":
+            output_tokens += self.reasoning_overhead_tokens
+        candidate = {
+            "provider": provider,
+            "model": model,
+            "estimated_cost": round(estimate_cost(model, prompt_tokens, output_tokens), 6),
+            "latency": round(stats.latency(model), 2),
+            "error_rate": round(stats.error_rate(model), 2),
+            "rejected": None
+        }
+        if provider not in available:
+            candidate["rejected"] = "未注册"
+        elif candidate["error_rate"] > self.max_error_rate:
+            candidate["rejected"] = f"近期错误率 {candidate['error_rate']:.0%} 过高"
+        elif candidate["latency"] > self.latency_budget:
+            candidate["rejected"] = f"近期延迟 {candidate['latency']:.1f}s 超出预算"
+        elif candidate["estimated_cost"] > self.max_cost_per_request:
+            candidate["rejected"] = f"估算费用 ${candidate['estimated_cost']:.4f} 超出上限"
+        return candidate
+
+    @staticmethod
+    def _explain(chosen, evaluated, has_image, complexity, complex_prompt) -> str:
+        """生成决策说明"""
+        if has_image:
+            parts = ["检测到图片输入，使用 Gemini 进行图片理解"]
+        else:
+            parts = ["纯文本输入"]
+        parts.append(f"复杂度 {complexity:.1f}（{'需要推理' if complex_prompt else '简单问题'}）")
+        for candidate in evaluated:
+            if candidate is chosen:
+                break
+            if candidate["rejected"]:
+                parts.append(f"跳过 {candidate['model']}：{candidate['rejected']}")
+        parts.append(
+            f"选择 {chosen['model']}（预计 {chosen['latency']:.1f}s，约 ${chosen['estimated_cost']:.4f}）"
+        )
+        return "；".join(parts)
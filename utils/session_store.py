@@ -0,0 +1,247 @@
+"""
+会话持久化模块
+聊天消息按会话 ID 写入本地 SQLite（WAL 模式），写入由后台线程批量异步完成；
+恢复时只按页读取最近的消息，更早的消息按需加载
+"""
+
+import atexit
+import base64
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.metrics import metrics
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    meta TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+"""
+
+# 二进制字段（图片缩略图）在 JSON 中的标记
+_BYTES_MARKER = "__b64__"
+
+
+def _encode_meta(message: Dict[str, Any]) -> Optional[str]:
+    """将 role / content 以外的字段序列化为 JSON（bytes 转为 base64）"""
+    def encode(value):
+        if isinstance(value, (bytes, bytearray)):
+            return {_BYTES_MARKER: base64.b64encode(value).decode("ascii")}
+        if isinstance(value, list):
+            return [encode(item) for item in value]
+        if isinstance(value, dict):
+            return {k: encode(v) for k, v in value.items()}
+        return value
+
+    meta = {k: encode(v) for k, v in message.items() if k not in ("role", "content", "seq") and v is not None}
+    return json.dumps(meta, ensure_ascii=False, default=str) if meta else None
+
+
+def _decode_meta(meta: Optional[str]) -> Dict[str, Any]:
+    """反序列化 meta 字段"""
+    def decode(value):
+        if isinstance(value, dict):
+            if set(value) == {_BYTES_MARKER}:
+                return base64.b64decode(value[_BYTES_MARKER])
+            return {k: decode(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [decode(item) for item in value]
+        return value
+
+    return decode(json.loads(meta)) if meta else {}
+
+
+class SessionStore:
+    """按会话 ID 持久化聊天消息"""
+
+    def __init__(self, path: str, flush_interval: float = 0.5, batch_size: int = 200):
+        """
+        初始化会话存储
+
+        Args:
+            path: SQLite 数据库文件路径
+            flush_interval: 后台线程批量写入的最长间隔（秒）
+            batch_size: 单次批量写入的最大消息数
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+        # 待写入队列：("put", 行) 或 ("delete", session_id)
+        self._queue: "queue.Queue[Tuple[str, Any]]" = queue.Queue()
+        self._idle = threading.Condition()
+        self._pending = 0
+        self._worker = threading.Thread(target=self._run, name="session-store", daemon=True)
+        self._worker.start()
+        atexit.register(self.flush)
+
+    def append(self, session_id: str, seq: int, message: Dict[str, Any]):
+        """
+        异步写入一条消息（同一 seq 重复写入时覆盖）
+
+        Args:
+            session_id: 会话 ID
+            seq: 消息在会话中的序号（从 0 开始）
+            message: 消息字典（包含 role 和 content）
+        """
+        row = (session_id, seq, message["role"], message.get("content") or "",
+               _encode_meta(message), time.time())
+        self._submit(("put", row))
+
+    def delete_session(self, session_id: str):
+        """
+        异步删除会话的全部消息
+
+        Args:
+            session_id: 会话 ID
+        """
+        self._submit(("delete", session_id))
+
+    def count(self, session_id: str) -> int:
+        """
+        会话的消息总数（已落盘部分，按最大序号计算）
+
+        Args:
+            session_id: 会话 ID
+
+        Returns:
+            int: 消息数
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MAX(seq) FROM messages WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return row[0] + 1 if row[0] is not None else 0
+
+    def load_page(self, session_id: str, before: Optional[int] = None, limit: int = 40) -> List[Dict[str, Any]]:
+        """
+        按页读取消息（按时间顺序返回）
+
+        Args:
+            session_id: 会话 ID
+            before: 只读取序号小于该值的消息；None 表示读取最新的一页
+            limit: 每页消息数
+
+        Returns:
+            List[Dict]: 消息列表，每条消息带有 seq 字段
+        """
+        start = time.perf_counter()
+        with self._lock:
+            if before is None:
+                rows = self._conn.execute(
+                    "SELECT seq, role, content, meta FROM messages WHERE session_id = ? "
+                    "ORDER BY seq DESC LIMIT ?", (session_id, limit)
+                ).fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT seq, role, content, meta FROM messages WHERE session_id = ? AND seq < ? "
+                    "ORDER BY seq DESC LIMIT ?", (session_id, before, limit)
+                ).fetchall()
+
+        messages = []
+        for seq, role, content, meta in reversed(rows):
+            message = {"role": role, "content": content}
+            message.update(_decode_meta(meta))
+            message["seq"] = seq
+            messages.append(message)
+
+        metrics.observe("session_store.load_page_ms", (time.perf_counter() - start) * 1000)
+        return messages
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """
+        等待已提交的写入全部落盘
+
+        Args:
+            timeout: 最长等待时间（秒）
+
+        Returns:
+            bool: 是否已全部写入
+        """
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def _submit(self, item: Tuple[str, Any]):
+        with self._idle:
+            self._pending += 1
+        self._queue.put(item)
+        metrics.set_gauge("session_store.pending", self._pending)
+
+    def _run(self):
+        """后台批量写入循环"""
+        while True:
+            try:
+                batch = [self._queue.get()]
+            except Exception:
+                return
+            # 短暂等待以合并同一时间段内的写入
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch: List[Tuple[str, Any]]):
+        """在一个事务中写入一批操作（保持提交顺序）"""
+        start = time.perf_counter()
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN")
+                try:
+                    for kind, payload in batch:
+                        if kind == "put":
+                            self._conn.execute(
+                                "INSERT OR REPLACE INTO messages (session_id, seq, role, content, meta, created_at) "
+                                "VALUES (?, ?, ?, ?, ?, ?)", payload
+                            )
+                        else:
+                            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (payload,))
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            metrics.observe("session_store.write_ms", (time.perf_counter() - start) * 1000)
+            metrics.increment("session_store.written", len(batch))
+        except Exception as e:
+            metrics.increment("session_store.write_failed", len(batch))
+            logger.error(f"会话消息写入失败（{len(batch)} 条）: {e}")
+        finally:
+            with self._idle:
+                self._pending -= len(batch)
+                self._idle.notify_all()
+            metrics.set_gauge("session_store.pending", self._pending)
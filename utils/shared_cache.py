@@ -0,0 +1,389 @@
+"""
+跨进程共享缓存模块
+多个 Streamlit 工作进程共用的键值缓存（值为 bytes，可设置有效期），用于文档摘要、飞书访问令牌和图片
+（预处理结果与预上传的文件引用），新启动的进程也能直接命中其他进程写入的结果：
+    - SQLiteCache：本地 SQLite 文件（WAL 模式 + 内存映射读取），适用于同一台机器上的多个进程
+    - RedisCache：Redis 协议（RESP）适配器，适用于多台机器，兼容 Redis / Valkey / KeyDB 等服务
+缓存只用于加速：后端不可用时记录警告并按未命中处理，不影响正常请求
+"""
+
+import json
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import ssl
+import threading
+import time
+from typing import Any, Optional
+from urllib.parse import unquote, urlparse
+
+from utils.metrics import metrics
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires_at REAL,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_updated ON cache (updated_at);
+"""
+
+
+class SharedCache:
+    """共享缓存接口（子类实现 _get / _set / _delete）"""
+
+    backend = "base"
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        读取缓存
+
+        Args:
+            key: 缓存键
+
+        Returns:
+            Optional[bytes]: 值；不存在、已过期或后端不可用时为 None
+        """
+        try:
+            value = self._get(key)
+        except Exception as e:
+            self._failed("读取", e)
+            return None
+        metrics.increment("shared_cache.hit" if value is not None else "shared_cache.miss",
+                          labels={"backend": self.backend})
+        return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None, only_new: bool = False) -> bool:
+        """
+        写入缓存
+
+        Args:
+            key: 缓存键
+            value: 值
+            ttl: 有效期（秒），None 表示不过期
+            only_new: 只在键不存在时写入（多个进程同时写入同一结果时保留先写入的）
+
+        Returns:
+            bool: 是否写入
+        """
+        if ttl is not None and ttl <= 0:
+            return False
+        try:
+            return self._set(key, bytes(value), ttl, only_new)
+        except Exception as e:
+            self._failed("写入", e)
+            return False
+
+    def delete(self, key: str):
+        """删除缓存"""
+        try:
+            self._delete(key)
+        except Exception as e:
+            self._failed("删除", e)
+
+    def get_json(self, key: str) -> Any:
+        """读取 JSON 值（不存在时为 None）"""
+        value = self.get(key)
+        if value is None:
+            return None
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+
+    def set_json(self, key: str, value: Any, ttl: Optional[float] = None, only_new: bool = False) -> bool:
+        """写入 JSON 值"""
+        return self.set(key, json.dumps(value, ensure_ascii=False).encode("utf-8"), ttl=ttl, only_new=only_new)
+
+    def close(self):
+        """释放连接"""
+
+    def _failed(self, action: str, error: Exception):
+        metrics.increment("shared_cache.errors", labels={"backend": self.backend})
+        logger.warning(f"共享缓存{action}失败（{self.backend}）: {error}")
+
+    def _get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: bytes, ttl: Optional[float], only_new: bool) -> bool:
+        raise NotImplementedError
+
+    def _delete(self, key: str):
+        raise NotImplementedError
+
+
+class SQLiteCache(SharedCache):
+    """本地 SQLite 共享缓存（同一台机器上的多个进程打开同一个文件）"""
+
+    backend = "sqlite"
+
+    def __init__(self, path: str, max_entries: int = 10_000, mmap_size: int = 64 * 1024 * 1024):
+        """
+        初始化缓存
+
+        Args:
+            path: SQLite 数据库文件路径
+            max_entries: 最多保留的条目数，超出时删除最早写入的
+            mmap_size: 内存映射读取的大小上限（字节），0 表示不使用
+        """
+        self.path = path
+        self.max_entries = max_entries
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return bytes(row[0])
+
+    def _set(self, key: str, value: bytes, ttl: Optional[float], only_new: bool) -> bool:
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        with self._lock:
+            if only_new:
+                # 已过期的条目视为不存在
+                cursor = self._conn.execute(
+                    "INSERT INTO cache (key, value, expires_at, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at, "
+                    "updated_at = excluded.updated_at WHERE cache.expires_at IS NOT NULL AND cache.expires_at <= ?",
+                    (key, value, expires_at, now, now)
+                )
+            else:
+                cursor = self._conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, expires_at, updated_at) VALUES (?, ?, ?, ?)",
+                    (key, value, expires_at, now)
+                )
+            self._writes += 1
+            if self._writes % 200 == 0:
+                self._prune(now)
+        return cursor.rowcount > 0
+
+    def _delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _prune(self, now: float):
+        """删除过期条目，超出 max_entries 时删除最早写入的"""
+        self._conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        self._conn.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisError(Exception):
+    """Redis 服务返回的错误"""
+
+
+class RedisUnavailable(ConnectionError):
+    """连接失败后的暂停期内不再尝试连接"""
+
+
+class RedisCache(SharedCache):
+    """
+    Redis 协议（RESP2）共享缓存
+
+    只用到 GET / SET（PX、NX）/ DEL / PING，内置最小的协议实现，不依赖 redis-py。
+    连接失败后在 retry_interval 秒内直接按未命中处理，避免服务不可用时每次读写都等待超时。
+    """
+
+    backend = "redis"
+
+    def __init__(self,
+                 url: str = "redis://localhost:6379/0",
+                 prefix: str = "assistant:",
+                 timeout: float = 1.0,
+                 max_connections: int = 8,
+                 retry_interval: float = 30.0):
+        """
+        初始化缓存
+
+        Args:
+            url: 连接地址，redis://[:密码@]主机[:端口][/数据库]，TLS 使用 rediss://
+            prefix: 键前缀（多个应用共用同一个 Redis 时区分）
+            timeout: 连接和读写超时（秒）
+            max_connections: 空闲连接池大小
+            retry_interval: 连接失败后暂停使用的时间（秒）
+        """
+        parsed = urlparse(url)
+        if parsed.scheme not in ("redis", "rediss"):
+            raise ValueError(f"不支持的 Redis 地址: {url}")
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.strip("/") or 0)
+        self.tls = parsed.scheme == "rediss"
+        self.prefix = prefix
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._pool: "queue.LifoQueue[socket.socket]" = queue.LifoQueue(maxsize=max_connections)
+        self._down_until = 0.0
+
+    def ping(self) -> bool:
+        """服务是否可用"""
+        try:
+            return self._command("PING") == b"PONG"
+        except Exception as e:
+            self._failed("连接", e)
+            return False
+
+    def _get(self, key: str) -> Optional[bytes]:
+        return self._command("GET", self.prefix + key)
+
+    def _set(self, key: str, value: bytes, ttl: Optional[float], only_new: bool) -> bool:
+        args = ["SET", self.prefix + key, value]
+        if ttl is not None:
+            args += ["PX", max(1, int(ttl * 1000))]
+        if only_new:
+            args.append("NX")
+        return self._command(*args) is not None
+
+    def _delete(self, key: str):
+        self._command("DEL", self.prefix + key)
+
+    def _failed(self, action: str, error: Exception):
+        # 暂停期内只计数，失败原因已在首次连接失败时记录
+        if isinstance(error, RedisUnavailable):
+            metrics.increment("shared_cache.skipped", labels={"backend": self.backend})
+            return
+        super()._failed(action, error)
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _command(self, *args) -> Any:
+        if time.time() < self._down_until:
+            raise RedisUnavailable("Redis 暂不可用")
+        try:
+            sock = self._pool.get_nowait()
+        except queue.Empty:
+            sock = None
+        try:
+            if sock is None:
+                sock = self._connect()
+            reply = self._execute(sock, args)
+        except RedisError:
+            self._release(sock)
+            raise
+        except (OSError, ValueError) as e:
+            if sock is not None:
+                sock.close()
+            self._down_until = time.time() + self.retry_interval
+            raise ConnectionError(f"{self.host}:{self.port} {e}") from e
+        self._release(sock)
+        return reply
+
+    def _connect(self) -> socket.socket:
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.tls:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+        if self.password:
+            auth = ["AUTH", self.username, self.password] if self.username else ["AUTH", self.password]
+            self._execute(sock, auth)
+        if self.db:
+            self._execute(sock, ["SELECT", self.db])
+        return sock
+
+    def _release(self, sock: socket.socket):
+        try:
+            self._pool.put_nowait(sock)
+        except queue.Full:
+            sock.close()
+
+    def _execute(self, sock: socket.socket, args) -> Any:
+        sock.sendall(_encode_command(args))
+        return _read_reply(sock.makefile("rb"))
+
+
+def _encode_command(args) -> bytes:
+    """编码为 RESP 数组"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        elif isinstance(arg, int):
+            arg = str(arg).encode("ascii")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def _read_reply(reader) -> Any:
+    """读取一个 RESP 回复（错误回复抛出 RedisError）"""
+    line = reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ValueError("连接已关闭")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body
+    if kind == b"-":
+        raise RedisError(body.decode("utf-8", "replace"))
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise ValueError("连接已关闭")
+        return data[:-2]
+    if kind == b"*":
+        length = int(body)
+        return None if length < 0 else [_read_reply(reader) for _ in range(length)]
+    raise ValueError(f"无法解析的回复: {line[:20]!r}")
+
+
+def open_shared_cache(url: str, default_path: str) -> Optional[SharedCache]:
+    """
+    按配置创建共享缓存
+
+    Args:
+        url: redis:// 或 rediss:// 使用 RedisCache；sqlite:///路径 或空字符串（使用 default_path）使用 SQLiteCache；
+            off 表示不使用共享缓存
+        default_path: 默认的 SQLite 文件路径
+
+    Returns:
+        Optional[SharedCache]: 共享缓存，off 或创建失败时为 None
+    """
+    url = (url or "").strip()
+    if url.lower() == "off":
+        return None
+    try:
+        if url.startswith(("redis://", "rediss://")):
+            cache = RedisCache(url)
+            if not cache.ping():
+                logger.warning("Redis 共享缓存暂不可用，恢复前按未命中处理")
+            return cache
+        path = url[len("sqlite:///"):] if url.startswith("sqlite:///") else default_path
+        return SQLiteCache(path)
+    except (ValueError, OSError, sqlite3.Error) as e:
+        logger.warning(f"创建共享缓存失败，使用进程内缓存: {e}")
+        return None
@@ -0,0 +1,224 @@
+"""
+请求合并模块（single-flight）
+相同键的并发请求只向上游发起一次，其余调用方等待并共享结果；
+流式请求的分片会广播给所有等待方
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from utils.cancellation import CancelToken
+from utils.metrics import metrics
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+
+class _StreamCall:
+    """进行中的流式请求：由后台线程拉取上游分片，所有订阅方从缓冲区读取"""
+
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.abandoned = False
+        self.condition = threading.Condition()
+        # 所有订阅方离开时取消，用于立即关闭上游连接
+        self.cancel_token = CancelToken()
+
+
+class SingleFlight:
+    """按键合并进行中的请求"""
+
+    def __init__(self, name: str = "default"):
+        """
+        初始化请求合并器
+
+        Args:
+            name: 名称，用于指标标签
+        """
+        self.name = name
+        self._calls: Dict[str, concurrent.futures.Future] = {}
+        self._streams: Dict[str, _StreamCall] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        同步执行：相同键的并发调用只执行一次 fn
+
+        Args:
+            key: 合并键
+            fn: 实际发起请求的无参可调用对象
+
+        Returns:
+            Tuple[Any, bool]: (结果, 是否复用了其他调用方的请求)
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return future.result(), True
+
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self._leave(key, future)
+        return future.result(), False
+
+    async def do_async(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        异步执行：与同步调用共享同一批进行中的请求，fn 在线程池中运行
+
+        Args:
+            key: 合并键
+            fn: 实际发起请求的无参（同步）可调用对象
+
+        Returns:
+            Tuple[Any, bool]: (结果, 是否复用了其他调用方的请求)
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future), True
+
+        try:
+            future.set_result(await asyncio.to_thread(fn))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self._leave(key, future)
+        return future.result(), False
+
+    def do_stream(self,
+                  key: str,
+                  stream_fn: Callable[[CancelToken], Iterator[Any]],
+                  cancel_token: Optional[CancelToken] = None) -> Tuple[Iterator[Any], bool]:
+        """
+        流式执行：相同键的并发调用共享同一个上游流，每个调用方都会收到完整的分片序列
+
+        调用方的 cancel_token 被取消时只有该调用方退出；所有订阅方都退出后，
+        传给 stream_fn 的取消令牌被触发，上游流随即关闭。
+
+        Args:
+            key: 合并键
+            stream_fn: 接收取消令牌、返回上游分片迭代器的可调用对象
+            cancel_token: 当前调用方的取消令牌（可选）
+
+        Returns:
+            Tuple[Iterator[Any], bool]: (上游分片迭代器, 是否复用了其他调用方的请求)
+        """
+        with self._lock:
+            call = self._streams.get(key)
+            leader = call is None or call.abandoned
+            if leader:
+                call = _StreamCall()
+                self._streams[key] = call
+            with call.condition:
+                call.subscribers += 1
+
+        labels = {"name": self.name}
+        if leader:
+            metrics.increment("singleflight.streams", labels=labels)
+            threading.Thread(
+                target=self._pump, args=(key, call, stream_fn), name=f"singleflight-{self.name}", daemon=True
+            ).start()
+        else:
+            metrics.increment("singleflight.coalesced_streams", labels=labels)
+            logger.info(f"合并流式请求: {key[:12]}")
+        return self._subscribe(call, cancel_token), not leader
+
+    def _subscribe(self, call: _StreamCall, cancel_token: Optional[CancelToken]) -> Iterator[Any]:
+        """从缓冲区依次读取分片，调用方离开时减少订阅数"""
+        def wake():
+            with call.condition:
+                call.condition.notify_all()
+
+        unregister = cancel_token.add_callback(wake) if cancel_token else None
+        index = 0
+        try:
+            while True:
+                with call.condition:
+                    while not (cancel_token and cancel_token.cancelled):
+                        if index < len(call.chunks) or call.done:
+                            break
+                        call.condition.wait()
+                    else:
+                        return
+                    if index < len(call.chunks):
+                        chunk = call.chunks[index]
+                    elif call.error is not None:
+                        raise call.error
+                    else:
+                        return
+                index += 1
+                yield chunk
+        finally:
+            if unregister:
+                unregister()
+            with call.condition:
+                call.subscribers -= 1
+                abandoned = call.subscribers == 0 and not call.done
+                if abandoned:
+                    # 所有订阅方都已离开，通知后台线程停止拉取上游
+                    call.abandoned = True
+                    call.condition.notify_all()
+            if abandoned:
+                call.cancel_token.cancel()
+
+    def in_flight(self) -> int:
+        """进行中的请求数（含流式）"""
+        with self._lock:
+            return len(self._calls) + len(self._streams)
+
+    def _join(self, key: str) -> Tuple[concurrent.futures.Future, bool]:
+        """加入（或发起）一次请求"""
+        labels = {"name": self.name}
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                metrics.increment("singleflight.coalesced", labels=labels)
+                logger.info(f"合并请求: {key[:12]}")
+                return future, False
+            future = concurrent.futures.Future()
+            self._calls[key] = future
+            metrics.increment("singleflight.leaders", labels=labels)
+            metrics.set_gauge("singleflight.in_flight", len(self._calls) + len(self._streams), labels=labels)
+            return future, True
+
+    def _leave(self, key: str, future: concurrent.futures.Future):
+        """请求完成后移除，后续调用将重新发起请求"""
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+            metrics.set_gauge("singleflight.in_flight", len(self._calls) + len(self._streams),
+                              labels={"name": self.name})
+
+    def _pump(self, key: str, call: _StreamCall, stream_fn: Callable[[CancelToken], Iterator[Any]]):
+        """后台拉取上游流并写入缓冲区"""
+        stream = None
+        try:
+            stream = stream_fn(call.cancel_token)
+            for chunk in stream:
+                with call.condition:
+                    call.chunks.append(chunk)
+                    call.condition.notify_all()
+                    if call.abandoned:
+                        break
+        except BaseException as e:
+            call.error = e
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as e:
+                    logger.debug(f"关闭上游流失败: {e}")
+            with self._lock:
+                if self._streams.get(key) is call:
+                    del self._streams[key]
+            with call.condition:
+                call.done = True
+                call.condition.notify_all()
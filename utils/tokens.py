@@ -0,0 +1,56 @@
+"""
+Token 估算工具模块
+在不依赖分词器的情况下粗略估算文本的 token 数量
+"""
+
+import re
+
+# 中日韩字符（大致按 1 字 ≈ 0.6 token 计）
+_CJK_RE = re.compile(r'[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的 token 数量
+
+    中文按每字约 0.6 token，其余字符按每 4 个字符约 1 token 估算，
+    用于预算控制，不追求精确。
+
+    Args:
+        text: 待估算的文本
+
+    Returns:
+        int: 估算的 token 数
+    """
+    if not text:
+        return 0
+    cjk_count = len(_CJK_RE.findall(text))
+    other_count = len(text) - cjk_count
+    return max(1, int(cjk_count * 0.6 + other_count / 4 + 0.5))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    按估算的 token 数截断文本
+
+    Args:
+        text: 原始文本
+        max_tokens: 允许的最大 token 数
+
+    Returns:
+        str: 截断后的文本（未超出预算时原样返回）
+    """
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    # 二分查找满足预算的最长前缀
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
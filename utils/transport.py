@@ -0,0 +1,243 @@
+"""
+HTTP 传输层模块
+按代理地址复用连接池：每个代理地址对应一个 ClientTransport，持有共享的 httpx 客户端和 requests Session，
+各客户端通过 transport 参数使用，不再修改进程级的 http_proxy / https_proxy 环境变量。
+连接池上限、keep-alive 时长、超时和 HTTP/2 由 PoolSettings 统一配置
+"""
+
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.recorder import ProviderRecorder, httpx_module_of
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+
+def http2_available() -> bool:
+    """是否安装了 HTTP/2 支持（h2，pip install httpx[http2]）"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class PoolSettings:
+    """连接池与超时配置"""
+
+    def __init__(self,
+                 http2: bool = True,
+                 max_connections: int = 20,
+                 max_keepalive_connections: int = 10,
+                 keepalive_expiry: float = 60.0,
+                 connect_timeout: float = 5.0,
+                 read_timeout: float = 300.0,
+                 stream_read_timeout: float = 60.0,
+                 write_timeout: float = 30.0,
+                 pool_timeout: float = 10.0):
+        """
+        初始化配置
+
+        Args:
+            http2: 启用 HTTP/2 多路复用（未安装 h2 时自动回退到 HTTP/1.1）
+            max_connections: 每个传输层的最大连接数（HTTP/2 下每个连接可承载多个并发请求）
+            max_keepalive_connections: 保持空闲的最大连接数
+            keepalive_expiry: 空闲连接保持时长（秒），应大于界面两次提问之间的典型间隔
+            connect_timeout: 建立连接（含 TLS 握手）的超时（秒）
+            read_timeout: 非流式请求等待响应的超时（秒），需覆盖完整的生成时间
+            stream_read_timeout: 流式请求两个分块之间的最长间隔（秒）
+            write_timeout: 发送请求体（例如图片）的超时（秒）
+            pool_timeout: 等待连接池空闲连接的超时（秒）
+        """
+        self.http2 = http2 and http2_available()
+        if http2 and not self.http2:
+            logger.info("未安装 h2，HTTP/2 不可用，使用 HTTP/1.1")
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.stream_read_timeout = stream_read_timeout
+        self.write_timeout = write_timeout
+        self.pool_timeout = pool_timeout
+
+    def limits(self, module=httpx):
+        return module.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+
+    def timeout(self, module=httpx, stream: bool = False):
+        """
+        请求超时（流式请求使用较短的读超时：它限制的是分块间隔而不是总时长）
+
+        Args:
+            module: httpx 模块（见 httpx_module_of）
+            stream: 是否为流式请求
+
+        Returns:
+            module.Timeout
+        """
+        return module.Timeout(
+            connect=self.connect_timeout,
+            read=self.stream_read_timeout if stream else self.read_timeout,
+            write=self.write_timeout,
+            pool=self.pool_timeout
+        )
+
+
+def normalize_proxy(proxy: Optional[str]) -> Optional[str]:
+    """
+    规范化代理地址（空字符串视为直连）
+
+    Args:
+        proxy: 代理地址，例如 http://127.0.0.1:7890
+
+    Returns:
+        Optional[str]: 代理地址，直连时为 None
+    """
+    proxy = (proxy or "").strip()
+    return proxy or None
+
+
+class ClientTransport:
+    """
+    一个代理地址对应的传输层
+
+    httpx 客户端按类型（例如 openai.DefaultHttpxClient）各创建一个并复用，
+    requests Session 只创建一个；均不读取环境变量中的代理设置。
+    """
+
+    def __init__(self,
+                 proxy: Optional[str] = None,
+                 recorder: Optional[ProviderRecorder] = None,
+                 settings: Optional[PoolSettings] = None):
+        """
+        初始化传输层
+
+        Args:
+            proxy: 代理地址，None 表示直连
+            recorder: 录制/回放控制器（可选），包装在连接池外层
+            settings: 连接池与超时配置
+        """
+        self.proxy = normalize_proxy(proxy)
+        self.recorder = recorder if recorder is not None and recorder.enabled else None
+        self.settings = settings or PoolSettings()
+        self._httpx_clients: Dict[type, Any] = {}
+        self._session: Optional[requests.Session] = None
+        self._lock = threading.Lock()
+
+    def httpx_client(self, client_class: type = httpx.Client):
+        """
+        共享的 httpx 客户端
+
+        Args:
+            client_class: 客户端类型（httpx.Client 或其子类，例如 openai.DefaultHttpxClient）
+
+        Returns:
+            client_class 的实例（同一传输层内复用）
+        """
+        with self._lock:
+            client = self._httpx_clients.get(client_class)
+            if client is None:
+                module = httpx_module_of(client_class)
+                transport = module.HTTPTransport(
+                    proxy=self.proxy,
+                    http2=self.settings.http2,
+                    limits=self.settings.limits(module)
+                )
+                if self.recorder is not None:
+                    transport = self.recorder.httpx_transport(inner=transport, module=module)
+                client = client_class(transport=transport, timeout=self.settings.timeout(module), trust_env=False)
+                self._httpx_clients[client_class] = client
+            return client
+
+    def requests_session(self) -> requests.Session:
+        """
+        共享的 requests Session
+
+        Returns:
+            requests.Session: 同一传输层内复用
+        """
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                session.trust_env = False
+                if self.proxy:
+                    session.proxies = {"http": self.proxy, "https": self.proxy}
+                adapter = HTTPAdapter(pool_maxsize=self.settings.max_keepalive_connections)
+                if self.recorder is not None:
+                    adapter = self.recorder.requests_adapter(inner=adapter)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    def close(self):
+        """关闭全部连接"""
+        with self._lock:
+            for client in self._httpx_clients.values():
+                client.close()
+            self._httpx_clients.clear()
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+class TransportRegistry:
+    """按代理地址索引的传输层注册表（进程内共享，界面重新运行和会话之间复用已建立的连接）"""
+
+    def __init__(self,
+                 recorder: Optional[ProviderRecorder] = None,
+                 settings: Optional[PoolSettings] = None,
+                 max_transports: int = 8):
+        """
+        初始化注册表
+
+        Args:
+            recorder: 录制/回放控制器（可选），所有传输层共用
+            settings: 连接池与超时配置，所有传输层共用
+            max_transports: 最多保留的代理地址数量，超出时关闭并移除最久未使用的传输层
+        """
+        self.recorder = recorder
+        self.settings = settings or PoolSettings()
+        self.max_transports = max_transports
+        self._transports: Dict[Optional[str], ClientTransport] = {}
+        self._lock = threading.Lock()
+
+    def get(self, proxy: Optional[str] = None) -> ClientTransport:
+        """
+        获取代理地址对应的传输层（不存在时创建）
+
+        Args:
+            proxy: 代理地址，空值表示直连
+
+        Returns:
+            ClientTransport
+        """
+        proxy = normalize_proxy(proxy)
+        evicted = None
+        with self._lock:
+            transport = self._transports.pop(proxy, None)
+            if transport is None:
+                if len(self._transports) >= self.max_transports:
+                    evicted = self._transports.pop(next(iter(self._transports)))
+                transport = ClientTransport(proxy, recorder=self.recorder, settings=self.settings)
+                logger.info(f"创建传输层: {'直连' if proxy is None else proxy}")
+            # 重新插入到末尾，按最近使用顺序淘汰
+            self._transports[proxy] = transport
+
+        if evicted is not None:
+            logger.info(f"关闭传输层: {'直连' if evicted.proxy is None else evicted.proxy}")
+            evicted.close()
+        return transport
+
+    def __len__(self) -> int:
+        return len(self._transports)
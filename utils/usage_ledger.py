@@ -0,0 +1,316 @@
+"""
+用量台账模块
+按请求记录 token（含图片、缓存命中和推理 token）、延迟和估算费用，
+以列式数组保存在内存中（按会话和日期建立行索引，聚合查询只扫描相关行），可选落盘到 SQLite
+"""
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from datetime import date
+from itertools import compress
+from typing import Any, Dict, Iterable, List, Optional
+
+from utils.routing_policy import estimate_cost
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    ts REAL NOT NULL,
+    day INTEGER NOT NULL,
+    session_id TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    model TEXT NOT NULL,
+    status TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    cached_tokens INTEGER NOT NULL,
+    image_tokens INTEGER NOT NULL,
+    reasoning_tokens INTEGER NOT NULL,
+    latency_ms REAL NOT NULL,
+    cost REAL NOT NULL,
+    coalesced INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS usage_day ON usage (day);
+"""
+
+# 字符串列（会话、服务商、模型、状态）以编号存储
+_STRING_COLUMNS = ("session_id", "provider", "model", "status")
+# 整数列
+_TOKEN_COLUMNS = ("prompt_tokens", "completion_tokens", "cached_tokens", "image_tokens", "reasoning_tokens")
+
+
+def today() -> int:
+    """本地日期的序号（date.toordinal），作为按日聚合的键"""
+    return date.today().toordinal()
+
+
+class UsageLedger:
+    """列式用量台账"""
+
+    def __init__(self, path: Optional[str] = None, retention_days: int = 31, flush_every: int = 20):
+        """
+        初始化台账
+
+        Args:
+            path: SQLite 文件路径；为 None 时仅保存在内存中
+            retention_days: 启动时加载到内存中的天数（更早的记录只保留在文件中）
+            flush_every: 累积多少条记录后批量写入文件
+        """
+        self.path = path
+        self.flush_every = flush_every
+
+        self._ts = array("d")
+        self._day = array("l")
+        self._strings: Dict[str, array] = {name: array("l") for name in _STRING_COLUMNS}
+        self._tokens: Dict[str, array] = {name: array("q") for name in _TOKEN_COLUMNS}
+        self._latency_ms = array("d")
+        self._cost = array("d")
+        self._coalesced = array("b")
+
+        # 字符串编号表
+        self._names: List[str] = []
+        self._name_ids: Dict[str, int] = {}
+        # 行索引：会话 / 日期 -> 行号
+        self._by_session: Dict[int, array] = {}
+        self._by_day: Dict[int, array] = {}
+
+        self._lock = threading.Lock()
+        self._pending: List[tuple] = []
+        self._conn = None
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            self._load(today() - retention_days)
+            atexit.register(self.flush)
+
+    def __len__(self) -> int:
+        return len(self._ts)
+
+    def record(self,
+               session_id: Optional[str],
+               provider: str,
+               model: Optional[str],
+               usage: Optional[Dict[str, Any]],
+               latency: float,
+               status: str = "ok",
+               coalesced: bool = False,
+               ts: Optional[float] = None) -> float:
+        """
+        记录一次请求
+
+        Args:
+            session_id: 会话 ID（None 记为 "anonymous"）
+            provider: 服务商（deepseek / gemini / knowledge_base）
+            model: 实际使用的模型名称
+            usage: 客户端返回的 usage（prompt_tokens、completion_tokens、prompt_cache_hit_tokens、
+                   image_tokens、reasoning_tokens）
+            latency: 耗时（秒）
+            status: ok / error / cancelled
+            coalesced: 是否与其他请求合并（合并的请求不重复计 token 和费用）
+            ts: 时间戳，默认为当前时间
+
+        Returns:
+            float: 本次请求的估算费用（美元）
+        """
+        usage = {} if coalesced else (usage or {})
+        model = model or provider
+        tokens = {
+            "prompt_tokens": usage.get("prompt_tokens") or 0,
+            "completion_tokens": usage.get("completion_tokens") or 0,
+            "cached_tokens": usage.get("prompt_cache_hit_tokens") or 0,
+            "image_tokens": usage.get("image_tokens") or 0,
+            "reasoning_tokens": usage.get("reasoning_tokens") or 0,
+        }
+        cost = estimate_cost(model, tokens["prompt_tokens"], tokens["completion_tokens"], tokens["cached_tokens"])
+        ts = time.time() if ts is None else ts
+        row = (ts, date.fromtimestamp(ts).toordinal(), session_id or "anonymous", provider, model, status,
+               *tokens.values(), latency * 1000, cost, int(coalesced))
+
+        with self._lock:
+            self._append(row)
+            if self._conn is not None:
+                self._pending.append(row)
+                if len(self._pending) >= self.flush_every:
+                    self._flush_locked()
+        return cost
+
+    def summary(self,
+                session_id: Optional[str] = None,
+                day: Optional[int] = None,
+                since: Optional[float] = None,
+                provider: Optional[str] = None,
+                model: Optional[str] = None) -> Dict[str, Any]:
+        """
+        聚合用量
+
+        Args:
+            session_id: 只统计该会话
+            day: 只统计该日期（today() 格式）
+            since: 只统计该时间戳之后的请求
+            provider: 只统计该服务商
+            model: 只统计该模型
+
+        Returns:
+            Dict 包含 requests、errors、cancelled、各项 token 数、total_tokens、cost、
+            avg_latency_ms、p95_latency_ms 和 output_tokens_per_second
+        """
+        with self._lock:
+            return self._aggregate(self._select(session_id, day, since, provider, model))
+
+    def group_by(self,
+                 dimension: str,
+                 session_id: Optional[str] = None,
+                 day: Optional[int] = None,
+                 since: Optional[float] = None) -> Dict[Any, Dict[str, Any]]:
+        """
+        按维度分组聚合
+
+        Args:
+            dimension: session_id / provider / model / status / day
+            session_id, day, since: 过滤条件，同 summary
+
+        Returns:
+            Dict: 维度值 -> summary 格式的聚合结果
+        """
+        if dimension not in _STRING_COLUMNS and dimension != "day":
+            raise ValueError(f"不支持的分组维度: {dimension}")
+        with self._lock:
+            column = self._day if dimension == "day" else self._strings[dimension]
+            groups: Dict[int, List[int]] = {}
+            for i in self._select(session_id, day, since, None, None):
+                groups.setdefault(column[i], []).append(i)
+            return {
+                (key if dimension == "day" else self._names[key]): self._aggregate(rows)
+                for key, rows in groups.items()
+            }
+
+    def flush(self):
+        """将缓冲的记录写入文件"""
+        with self._lock:
+            self._flush_locked()
+
+    # ==================== 内部方法（调用方需持有锁） ====================
+
+    def _intern(self, name: str) -> int:
+        index = self._name_ids.get(name)
+        if index is None:
+            index = len(self._names)
+            self._names.append(name)
+            self._name_ids[name] = index
+        return index
+
+    def _append(self, row: tuple):
+        ts, day, session_id, provider, model, status, *tokens, latency_ms, cost, coalesced = row
+        index = len(self._ts)
+        self._ts.append(ts)
+        self._day.append(day)
+        for name, value in zip(_STRING_COLUMNS, (session_id, provider, model, status)):
+            self._strings[name].append(self._intern(value))
+        for name, value in zip(_TOKEN_COLUMNS, tokens):
+            self._tokens[name].append(value)
+        self._latency_ms.append(latency_ms)
+        self._cost.append(cost)
+        self._coalesced.append(coalesced)
+        self._by_session.setdefault(self._strings["session_id"][index], array("l")).append(index)
+        self._by_day.setdefault(day, array("l")).append(index)
+
+    def _select(self, session_id, day, since, provider, model) -> Iterable[int]:
+        """选出满足条件的行号（优先使用会话 / 日期索引）"""
+        if session_id is not None:
+            sid = self._name_ids.get(session_id)
+            rows = self._by_session.get(sid, array("l")) if sid is not None else array("l")
+            if day is not None:
+                rows = [i for i in rows if self._day[i] == day]
+        elif day is not None:
+            rows = self._by_day.get(day, array("l"))
+        else:
+            rows = range(len(self._ts))
+
+        filters = []
+        if since is not None:
+            filters.append(lambda i: self._ts[i] >= since)
+        for name, value in (("provider", provider), ("model", model)):
+            if value is not None:
+                target = self._name_ids.get(value, -1)
+                column = self._strings[name]
+                filters.append(lambda i, column=column, target=target: column[i] == target)
+        if filters:
+            rows = [i for i in rows if all(f(i) for f in filters)]
+        return rows
+
+    def _aggregate(self, rows: Iterable[int]) -> Dict[str, Any]:
+        rows = self._as_range(rows)
+        if isinstance(rows, range):
+            # 连续的行（例如按时间顺序写入的某一天）直接对列切片求和
+            def column_values(column):
+                return column[rows.start:rows.stop]
+        else:
+            def column_values(column):
+                return [column[i] for i in rows]
+
+        status = column_values(self._strings["status"])
+        result: Dict[str, Any] = {
+            "requests": len(rows),
+            "errors": status.count(self._name_ids.get("error", -1)),
+            "cancelled": status.count(self._name_ids.get("cancelled", -1)),
+        }
+        for name in _TOKEN_COLUMNS:
+            result[name] = sum(column_values(self._tokens[name]))
+        result["total_tokens"] = result["prompt_tokens"] + result["completion_tokens"]
+        result["cost"] = sum(column_values(self._cost))
+
+        # 延迟和吞吐只统计实际调用上游的请求
+        upstream = [not flag for flag in column_values(self._coalesced)]
+        latencies = sorted(compress(column_values(self._latency_ms), upstream))
+        result["avg_latency_ms"] = sum(latencies) / len(latencies) if latencies else 0.0
+        result["p95_latency_ms"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0
+        busy_seconds = sum(latencies) / 1000
+        output_tokens = sum(compress(column_values(self._tokens["completion_tokens"]), upstream))
+        result["output_tokens_per_second"] = output_tokens / busy_seconds if busy_seconds else 0.0
+        return result
+
+    @staticmethod
+    def _as_range(rows: Iterable[int]):
+        """行号连续时转换为 range"""
+        if isinstance(rows, range):
+            return rows
+        rows = rows if isinstance(rows, (list, array)) else list(rows)
+        if rows and rows[-1] - rows[0] + 1 == len(rows):
+            return range(rows[0], rows[-1] + 1)
+        return rows
+
+    def _load(self, min_day: int):
+        """启动时加载保留期内的记录"""
+        start = time.perf_counter()
+        rows = self._conn.execute(
+            "SELECT ts, day, session_id, provider, model, status, prompt_tokens, completion_tokens, "
+            "cached_tokens, image_tokens, reasoning_tokens, latency_ms, cost, coalesced "
+            "FROM usage WHERE day >= ? ORDER BY ts", (min_day,)
+        ).fetchall()
+        for row in rows:
+            self._append(row)
+        logger.info(f"已加载 {len(rows)} 条用量记录，耗时 {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    def _flush_locked(self):
+        if self._conn is None or not self._pending:
+            return
+        try:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._pending
+                )
+            self._pending = []
+        except sqlite3.Error as e:
+            logger.error(f"用量记录写入失败（{len(self._pending)} 条）: {e}")
@@ -0,0 +1,106 @@
+"""
+预热模块
+客户端注册后在后台线程中并发预热（建立连接池中的连接、预取飞书令牌、可选的极小模型请求），
+每个目标在进程内只预热一次，使部署后第一个请求的延迟与稳定状态一致
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional
+
+from utils.metrics import metrics
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+MODES = ("off", "connect", "probe")
+
+
+class WarmupManager:
+    """进程内共享的预热任务管理器"""
+
+    def __init__(self, max_workers: int = 4):
+        """
+        初始化管理器
+
+        Args:
+            max_workers: 并发预热的线程数
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="warmup")
+        self._futures: Dict[str, Future] = {}
+        self._results: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, name: str, key: str, warm_up: Callable[[], Dict[str, Any]]) -> bool:
+        """
+        提交预热任务（同一 key 只执行一次）
+
+        Args:
+            name: 目标名称（deepseek / gemini / feishu），用于展示和指标标签
+            key: 去重键（例如服务商 + Key 指纹 + 代理地址）
+            warm_up: 预热函数，返回 {"success", "steps", "error"}
+
+        Returns:
+            bool: 是否提交了新任务
+        """
+        with self._lock:
+            if key in self._futures:
+                return False
+            self._futures[key] = self._executor.submit(self._run, name, warm_up)
+            return True
+
+    def results(self) -> Dict[str, Dict[str, Any]]:
+        """
+        各目标最近一次完成的预热结果
+
+        Returns:
+            Dict: 目标名称 -> {"success", "elapsed_ms", "steps", "error", "finished_at"}
+        """
+        with self._lock:
+            return dict(self._results)
+
+    def pending(self) -> int:
+        """尚未完成的预热任务数"""
+        with self._lock:
+            return sum(1 for future in self._futures.values() if not future.done())
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待已提交的预热任务完成
+
+        Args:
+            timeout: 最长等待时间（秒）
+
+        Returns:
+            bool: 是否全部完成
+        """
+        with self._lock:
+            futures = list(self._futures.values())
+        _, not_done = wait(futures, timeout=timeout)
+        return not not_done
+
+    def _run(self, name: str, warm_up: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            result = warm_up()
+        except Exception as e:
+            result = {"success": False, "steps": {}, "error": str(e)}
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        result = dict(result, elapsed_ms=elapsed_ms, finished_at=time.time())
+        labels = {"target": name}
+        metrics.observe("warmup.ms", elapsed_ms, labels=labels)
+        for step, step_ms in (result.get("steps") or {}).items():
+            metrics.observe("warmup.step_ms", step_ms, labels=dict(labels, step=step))
+        if result.get("success"):
+            steps = "，".join(f"{step} {step_ms:.0f}ms" for step, step_ms in result["steps"].items())
+            logger.info(f"{name} 预热完成，耗时 {elapsed_ms:.0f}ms（{steps}）")
+        else:
+            metrics.increment("warmup.failed", labels=labels)
+            logger.warning(f"{name} 预热失败: {result.get('error')}")
+
+        with self._lock:
+            self._results[name] = result
+        return result